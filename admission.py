@@ -0,0 +1,134 @@
+"""
+Job sizing and memory-aware admission control.
+
+Every job's memory and time are estimated up front from the trip length
+(and, in graph mode, i.e. when the in-process router serves the trip, the
+bounding box area). The route and render stages run apart and are sized
+apart: the A* search state is held while routing, the route points and map
+while rendering. A stage over HEAVY_JOB_MEMORY_MB is sent to the dedicated
+heavy queue, jobs over MAX_JOB_MEMORY_MB are rejected right away, and
+workers only start a stage when the container has its estimated memory free
+on top of WORKER_MEMORY_WATERMARK_MB.
+"""
+import math
+import os
+
+from faster_rainy_road import LOCAL_ROUTING_ENABLED, get_sample_count
+
+HEAVY_JOB_MEMORY_MB = float(os.getenv("HEAVY_JOB_MEMORY_MB", "200"))
+MAX_JOB_MEMORY_MB = float(os.getenv("MAX_JOB_MEMORY_MB", "1500"))
+WORKER_MEMORY_WATERMARK_MB = float(os.getenv("WORKER_MEMORY_WATERMARK_MB", "256"))
+HEAVY_QUEUE = os.getenv("HEAVY_QUEUE", "heavy")
+
+# Rough linear model, calibrated on observed peaks. Road distance is about
+# 1.3x the straight line and OSRM full overviews carry ~10 points per km.
+ROAD_DETOUR_FACTOR = 1.3
+ROUTE_POINTS_PER_KM = 10
+BASE_MEMORY_MB = 80
+MEMORY_MB_PER_ROUTE_POINT = 0.004  # python tuples + folium polylines + HTML
+SECONDS_PER_SAMPLE = 0.4
+SECONDS_PER_ROUTE_POINT = 0.00002
+# Graph mode (routing_engine): bidirectional A* settles about the OSM drive
+# nodes inside the trip's bbox, keeping distances, parents, potentials and
+# heap entries (~0.5 KB) per node in Python dicts.
+GRAPH_NODES_PER_KM2 = 25
+GRAPH_MB_PER_NODE = 0.0005
+GRAPH_SECONDS_PER_NODE = 0.00002
+
+
+def _straight_line_km(start_latlng, end_latlng):
+    lat1, lon1, lat2, lon2 = map(math.radians, (start_latlng[0], start_latlng[1], end_latlng[0], end_latlng[1]))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _bbox_area_km2(start_latlng, end_latlng, buffer_deg=0.08):
+    mid_lat = math.radians((start_latlng[0] + end_latlng[0]) / 2)
+    height = (abs(start_latlng[0] - end_latlng[0]) + 2 * buffer_deg) * 111.32
+    width = (abs(start_latlng[1] - end_latlng[1]) + 2 * buffer_deg) * 111.32 * math.cos(mid_lat)
+    return height * width
+
+
+def uses_graph_routing(travel_mode="auto"):
+    """True when the trip is routed in-process over graph_store (LOCAL_ROUTING_ENABLED, driving)."""
+    return LOCAL_ROUTING_ENABLED and travel_mode == "auto"
+
+
+def estimate_job(start_latlng, end_latlng, travel_mode="auto", graph_mode=None):
+    """
+    Estimates a job's peak memory (MB) and run time (s). graph_mode defaults
+    to whether the local router serves the trip (uses_graph_routing).
+    Returns a dict with the inputs used, the memory of each stage
+    (route_memory_mb, render_memory_mb), the job's peak and the queues to use
+    (route_queue "io" or HEAVY_QUEUE, queue "render" or HEAVY_QUEUE for the
+    render), or rejected=True when it is too large.
+    """
+    if graph_mode is None:
+        graph_mode = uses_graph_routing(travel_mode)
+    distance_km = _straight_line_km(start_latlng, end_latlng) * ROAD_DETOUR_FACTOR
+    route_points = max(2, int(distance_km * ROUTE_POINTS_PER_KM))
+    samples = get_sample_count(route_points)
+
+    route_memory_mb = BASE_MEMORY_MB
+    render_memory_mb = BASE_MEMORY_MB + route_points * MEMORY_MB_PER_ROUTE_POINT
+    seconds = samples * SECONDS_PER_SAMPLE + route_points * SECONDS_PER_ROUTE_POINT
+    estimate = {"distance_km": round(distance_km, 1), "route_points": route_points, "samples": samples}
+
+    if graph_mode:
+        area_km2 = _bbox_area_km2(start_latlng, end_latlng)
+        graph_nodes = area_km2 * GRAPH_NODES_PER_KM2
+        route_memory_mb += graph_nodes * GRAPH_MB_PER_NODE
+        seconds += graph_nodes * GRAPH_SECONDS_PER_NODE
+        estimate["bbox_area_km2"] = round(area_km2, 1)
+
+    # The stages run one after the other, so the job peaks at the larger one
+    memory_mb = max(route_memory_mb, render_memory_mb)
+    estimate["route_memory_mb"] = round(route_memory_mb, 1)
+    estimate["render_memory_mb"] = round(render_memory_mb, 1)
+    estimate["memory_mb"] = round(memory_mb, 1)
+    estimate["seconds"] = round(seconds, 1)
+    estimate["route_queue"] = HEAVY_QUEUE if route_memory_mb > HEAVY_JOB_MEMORY_MB else "io"
+    estimate["queue"] = HEAVY_QUEUE if render_memory_mb > HEAVY_JOB_MEMORY_MB else "render"
+    estimate["rejected"] = memory_mb > MAX_JOB_MEMORY_MB
+    return estimate
+
+
+def check_job_size(estimate):
+    """Raises MemoryError with a user facing message for rejected jobs."""
+    if estimate["rejected"]:
+        raise MemoryError(
+            f"Rota muito longa para processar ({estimate['distance_km']:.0f} km, "
+            f"~{estimate['memory_mb']:.0f} MB). Tente dividir o trajeto em rotas mais curtas."
+        )
+
+
+def _cgroup_available_mb():
+    """Memory left under the container's cgroup limit, or None outside one."""
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        with open("/sys/fs/cgroup/memory.current") as f:
+            current = int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+    if limit == "max":
+        return None
+    return (int(limit) - current) / 1024 / 1024
+
+
+def available_memory_mb():
+    """Free memory for this worker, honouring container limits."""
+    import psutil
+
+    available = psutil.virtual_memory().available / 1024 / 1024
+    cgroup_available = _cgroup_available_mb()
+    if cgroup_available is not None:
+        available = min(available, cgroup_available)
+    return available
+
+
+def has_memory_for(estimate, stage="render"):
+    """True when the worker can run the job's stage ("route" or "render") and still keep the watermark free."""
+    estimate = estimate or {}
+    required = WORKER_MEMORY_WATERMARK_MB + estimate.get(f"{stage}_memory_mb", estimate.get("memory_mb", BASE_MEMORY_MB))
+    return available_memory_mb() >= required
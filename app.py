@@ -1,17 +1,71 @@
 # app_async.py
+import hmac
 import os
 import time
 import uuid
 from pathlib import Path
 
-from celery import Celery
+from celery import Celery, chain, chord, group
+from celery.schedules import crontab
+from celery.signals import worker_init
 from flask import Flask, Response, jsonify, request, send_file
 from flask_cors import CORS
 from markupsafe import escape
 
+from admission import check_job_size, estimate_job, has_memory_for, uses_graph_routing
+from cache import cache_get_json, cache_incr, cache_set_json
+from deadline import new_deadline, request_deadline
+from geo_routing import geo_queue
+from local_queue import LocalJobQueue, is_local_backend, local_celery_config
 from faster_rainy_road import (
+    build_segments,
+    decode_route_points,
+    encode_route_points,
+    evaluate_routes_weather,
+    geocode_location,
     get_coordinates,
+    get_alternatives_weather,
+    get_departure_windows,
+    get_route_alternatives,
+    get_route_data,
     get_route_map,
+    get_sample_plan,
+    get_samples_weather,
+    get_unresolved_statuses,
+    preload_heavy_modules,
+    render_map,
+)
+from prewarm import (
+    PREWARM_ENABLED,
+    PREWARM_HOURS,
+    PREWARM_MAP_TTL,
+    PREWARM_MAX_WEATHER_CALLS,
+    PREWARM_PRIORITY,
+    PREWARM_TOP_N,
+    corridor_key,
+    corridor_places,
+    get_prewarmed_map,
+    record_request,
+    set_prewarmed_map,
+    top_corridors,
+)
+from profiling import list_profiles, load_profile, new_profile_id, profile_stats_path, profiled
+from rate_budget import priority_cap
+from static_map import MIME_TYPES, STATIC_MAP_ENABLED, STATIC_MAP_FORMAT, render_static_map
+from utils import get_error_html, get_rain_color
+from watchlist import (
+    WATCHLIST_ENABLED,
+    WATCHLIST_INTERVAL_MINUTES,
+    WATCHLIST_PRIORITY,
+    WatchlistUnavailable,
+    add_watch,
+    all_watches,
+    class_changes,
+    departure_offset,
+    get_watch,
+    load_states,
+    publish_changes,
+    remove_watch,
 )
 
 app = Flask(__name__)
@@ -27,9 +81,34 @@ else:
 GENERATED_MAPS_DIR = os.getenv("GENERATED_MAPS_DIR", "generated_maps")
 MAP_MAX_AGE_SECONDS = int(os.getenv("MAP_MAX_AGE_SECONDS", "7200"))
 
+# Number of weather samples fetched by each parallel weather task
+WEATHER_CHUNK_SIZE = int(os.getenv("WEATHER_CHUNK_SIZE", "8"))
+# A chunk with unresolved samples is fetched again, backing off from this delay
+WEATHER_CHUNK_RETRY_SECONDS = float(os.getenv("WEATHER_CHUNK_RETRY_SECONDS", "2"))
+WEATHER_CHUNK_MAX_RETRIES = int(os.getenv("WEATHER_CHUNK_MAX_RETRIES", "3"))
+# A chunk redelivered this many times after its worker died (OOM, segfault)
+# is given up on, its samples left unresolved, instead of killing more workers
+WEATHER_CHUNK_MAX_DELIVERIES = int(os.getenv("WEATHER_CHUNK_MAX_DELIVERIES", "2"))
+# A render stage waits for free memory this many times before failing
+ADMISSION_RETRY_SECONDS = int(os.getenv("ADMISSION_RETRY_SECONDS", "15"))
+ADMISSION_MAX_RETRIES = int(os.getenv("ADMISSION_MAX_RETRIES", "8"))
+# Departure window mode: default range and step, and the longest range
+# the hourly forecasts can cover
+DEPARTURE_WINDOW_MINUTES = int(os.getenv("DEPARTURE_WINDOW_MINUTES", "720"))
+DEPARTURE_STEP_MINUTES = int(os.getenv("DEPARTURE_STEP_MINUTES", "30"))
+MAX_DEPARTURE_WINDOW_MINUTES = 1440
+# Route, samples and weather of finished maps are kept for /refresh as long
+# as the task results themselves
+JOB_META_TTL = int(os.getenv("CELERY_RESULT_EXPIRES", "7200"))
+# Batch API: trips per request and routes/weather chunks fetched at once
+BATCH_MAX_TRIPS = int(os.getenv("BATCH_MAX_TRIPS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Token for the /admin endpoints (sent as X-Admin-Token); unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 
 def cleanup_old_maps() -> int:
-    """Delete map files older than MAP_MAX_AGE_SECONDS. Returns count of deleted files."""
+    """Delete map files (HTML and images) older than MAP_MAX_AGE_SECONDS. Returns count of deleted files."""
     output_dir = Path(GENERATED_MAPS_DIR)
     if not output_dir.exists():
         return 0
@@ -37,7 +116,7 @@ def cleanup_old_maps() -> int:
     deleted_count = 0
     current_time = time.time()
 
-    for map_file in output_dir.glob("map_*.html"):
+    for map_file in output_dir.glob("map_*.*"):
         try:
             file_age = current_time - map_file.stat().st_mtime
             if file_age > MAP_MAX_AGE_SECONDS:
@@ -49,6 +128,26 @@ def cleanup_old_maps() -> int:
     return deleted_count
 
 
+def _beat_schedule() -> dict:
+    schedule = {}
+    if os.getenv("WEATHER_CUBE_ENABLED", "False").lower() in ("true", "1", "yes"):
+        schedule["refresh-weather-cube"] = {
+            "task": "refresh_weather_cube_task",
+            "schedule": int(os.getenv("WEATHER_CUBE_REFRESH_MINUTES", "180")) * 60,
+        }
+    if PREWARM_ENABLED:
+        schedule["prewarm-corridors"] = {
+            "task": "prewarm_corridors_task",
+            "schedule": crontab(minute=0, hour=PREWARM_HOURS),
+        }
+    if WATCHLIST_ENABLED:
+        schedule["evaluate-watchlist"] = {
+            "task": "watchlist_task",
+            "schedule": WATCHLIST_INTERVAL_MINUTES * 60,
+        }
+    return schedule
+
+
 def make_celery(flask_app: Flask) -> Celery:
     redis_url = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
     celery = Celery(
@@ -60,8 +159,34 @@ def make_celery(flask_app: Flask) -> Celery:
         task_track_started=True,
         result_expires=int(os.getenv("CELERY_RESULT_EXPIRES", "7200")),
         broker_connection_retry_on_startup=True,
+        # Workers only reserve what they run, so a task waiting for memory
+        # doesn't hold back others queued behind it on the same worker.
+        worker_prefetch_multiplier=1,
+        beat_schedule=_beat_schedule(),
+        # Network bound stages and the CPU bound render run on separate
+        # queues so each worker pool can be scaled on its own.
+        task_routes={
+            "generate_map_task": {"queue": "io"},
+            "generate_map_with_coordinates_task": {"queue": "io"},
+            "geocode_stage": {"queue": "io"},
+            "route_stage": {"queue": "io"},
+            "weather_fanout_stage": {"queue": "io"},
+            "weather_chunk_task": {"queue": "io"},
+            "render_stage": {"queue": "render"},
+            "refresh_weather_cube_task": {"queue": "io"},
+            "prewarm_corridors_task": {"queue": "render"},
+            "departure_windows_task": {"queue": "io"},
+            "alternatives_task": {"queue": "render"},
+            "batch_task": {"queue": "io"},
+            "refresh_weather_task": {"queue": "io"},
+            "watchlist_task": {"queue": "io"},
+        },
     )
 
+    if is_local_backend():
+        # Single-node mode: tasks run in the web process, see local_queue.py
+        celery.conf.update(local_celery_config())
+
     class ContextTask(celery.Task):
         def __call__(self, *args, **kwargs):  # pragma: no cover - Celery wiring
             with flask_app.app_context():
@@ -72,6 +197,14 @@ def make_celery(flask_app: Flask) -> Celery:
 
 
 celery_app = make_celery(app)
+# In-process job queue replacing the workers in single-node mode
+local_jobs = LocalJobQueue() if is_local_backend() else None
+
+
+@worker_init.connect
+def _preload_worker_modules(**kwargs):  # pragma: no cover - Celery wiring
+    # Loaded once in the worker's main process so the forked pool shares them
+    preload_heavy_modules()
 
 
 PROGRESS_PERCENT = {
@@ -83,6 +216,7 @@ PROGRESS_PERCENT = {
     "graph_full": 55,
     "graph_radius": 65,
     "route": 75,
+    "weather": 80,
     "map": 85,
     "saving": 97,
     "complete": 100,
@@ -90,7 +224,15 @@ PROGRESS_PERCENT = {
 }
 
 
-def _update_progress(task, stage: str, detail: str = "") -> None:
+def _enqueue(task, args=None, kwargs=None, **options):
+    """Starts a job on the Celery workers, or on the in-process queue in single-node mode."""
+    if local_jobs is not None:
+        return local_jobs.submit(task, args, kwargs)
+    return task.apply_async(args=args, kwargs=kwargs, **options)
+
+
+def _update_progress(task, stage: str, detail: str = "", task_id: str | None = None) -> None:
+    """Report progress on task_id (defaults to the running task's own id)."""
     if task is None:
         return
     payload = {
@@ -98,7 +240,7 @@ def _update_progress(task, stage: str, detail: str = "") -> None:
         "detail": detail,
         "percent": PROGRESS_PERCENT.get(stage, 0),
     }
-    task.update_state(state="PROGRESS", meta=payload)
+    task.update_state(task_id=task_id, state="PROGRESS", meta=payload)
 
 
 def _save_map_file(route_map) -> str:
@@ -116,14 +258,33 @@ def _save_map_file(route_map) -> str:
     return str(file_path)
 
 
-def create_map(start_location: str, end_location: str, travel_mode: str = "auto", task=None) -> str:
+def _image_path(map_file: str, image_format: str = STATIC_MAP_FORMAT) -> Path:
+    """The low-bandwidth image is cached next to its HTML map, under the same name."""
+    return Path(map_file).with_suffix(f".{image_format}")
+
+
+def _save_map_image(map_file: str, route_points, segment_data: list, start_latlng, end_latlng) -> None:
+    """Renders the static image of a map. Never fails the job; /result can still draw it later."""
+    if not STATIC_MAP_ENABLED:
+        return
+    try:
+        _image_path(map_file).write_bytes(render_static_map(route_points, segment_data, start_latlng, end_latlng))
+    except Exception as exc:
+        print(f"Warning: imagem estatica nao gerada - {exc}")
+
+
+def create_map(start_location: str, end_location: str, travel_mode: str = "auto", task=None, deadline: float | None = None) -> str:
     _update_progress(task, "coordinates", "Buscando coordenadas das cidades")
-    start_latlng, end_latlng = get_coordinates(start_location, end_location)
+    with request_deadline(deadline):
+        start_latlng, end_latlng = get_coordinates(start_location, end_location)
     travel_mode = travel_mode
+
+    _update_progress(task, "memory_check", "Estimando memoria necessaria")
+    check_job_size(estimate_job(start_latlng, end_latlng, travel_mode))
  
     _update_progress(task, "route", "Gerando rota com OSRM")
     _update_progress(task, "map", "Renderizando mapa com dados de chuva")
-    route_map = get_route_map(start_latlng, end_latlng, travel_mode)
+    route_map = get_route_map(start_latlng, end_latlng, travel_mode, deadline)
 
     _update_progress(task, "saving", "Salvando mapa em disco")
     map_file_path = _save_map_file(route_map)
@@ -131,10 +292,13 @@ def create_map(start_location: str, end_location: str, travel_mode: str = "auto"
     return map_file_path
 
 
-def create_map_with_coordinates(start_latlng: tuple[float], end_latlng: tuple[float], travel_mode: str = "auto", task=None) -> str:
+def create_map_with_coordinates(start_latlng: tuple[float], end_latlng: tuple[float], travel_mode: str = "auto", task=None, deadline: float | None = None) -> str:
+    _update_progress(task, "memory_check", "Estimando memoria necessaria")
+    check_job_size(estimate_job(start_latlng, end_latlng, travel_mode))
+
     _update_progress(task, "route", "Gerando rota com OSRM")
     _update_progress(task, "map", "Renderizando mapa com dados de chuva")
-    route_map = get_route_map(start_latlng, end_latlng, travel_mode)
+    route_map = get_route_map(start_latlng, end_latlng, travel_mode, deadline)
 
     _update_progress(task, "saving", "Salvando mapa em disco")
     map_file_path = _save_map_file(route_map)
@@ -142,27 +306,659 @@ def create_map_with_coordinates(start_latlng: tuple[float], end_latlng: tuple[fl
     return map_file_path
 
 
-@celery_app.task(bind=True, name="generate_map_task")
-def generate_map_task(self, start_location: str, end_location: str, travel_mode: str = "auto") -> dict:
+class StageTask(celery_app.Task):
+    """
+    A stage of the map workflow. Stages report progress on the job id the
+    client polls, and a stage that gives up marks that job as failed too.
+    """
+
+    def __call__(self, *args, **kwargs):  # pragma: no cover - Celery wiring
+        # Only jobs picked for profiling pay for it
+        profile_id = kwargs.get("profile_id")
+        if profile_id is None:
+            return super().__call__(*args, **kwargs)
+        with profiled(profile_id, self.name, self.request.id or ""):
+            return super().__call__(*args, **kwargs)
+
+    def on_failure(self, exc, task_id, args, kwargs, einfo):  # pragma: no cover - Celery wiring
+        job_id = kwargs.get("job_id")
+        if job_id and job_id != task_id:
+            self.backend.mark_as_failure(job_id, exc, traceback=einfo.traceback)
+
+
+def _size_job(task, endpoints: dict, travel_mode: str = "auto", job_id: str | None = None) -> dict:
+    """Attaches the job's memory/time estimate, rejecting oversized jobs early."""
+    _update_progress(task, "memory_check", "Estimando memoria necessaria", task_id=job_id)
+    estimate = estimate_job(endpoints["start"], endpoints["end"], travel_mode)
+    check_job_size(estimate)
+    endpoints["estimate"] = estimate
+    return endpoints
+
+
+def _wait_for_memory(task, estimate: dict | None, stage: str, job_id: str | None = None) -> None:
+    """Puts the stage back on the queue until the worker has its estimated memory free."""
+    if has_memory_for(estimate, stage):
+        return
+    # Put the job back on the queue instead of risking an OOM kill that
+    # would also take down the other tasks in this container.
+    if task.request.retries >= ADMISSION_MAX_RETRIES:
+        raise MemoryError("Servidor sem memoria livre para gerar o mapa agora. Tente novamente em instantes.")
+    _update_progress(task, "memory_check", "Aguardando memoria livre no servidor", task_id=job_id)
+    if task.request.is_eager:
+        # In-process retries run right away, so wait here instead
+        time.sleep(ADMISSION_RETRY_SECONDS)
+    raise task.retry(countdown=ADMISSION_RETRY_SECONDS, max_retries=ADMISSION_MAX_RETRIES)
+
+
+def _route_workflow(
+    endpoints: dict, travel_mode: str, job_id: str, deadline: float | None = None, profile_id: str | None = None
+):
+    """Routing and weather stages for sized endpoints, on the queues their estimate picks."""
+    start_latlng, end_latlng = endpoints["start"], endpoints["end"]
+    # Local A* over a large bbox routes on the heavy queue; with geo routing
+    # both stages go to the shard serving the trip's region
+    route_queue = geo_queue(endpoints["estimate"].get("route_queue", "io"), start_latlng, end_latlng)
+    io_queue = geo_queue("io", start_latlng, end_latlng)
+    return chain(
+        route_stage.s(endpoints, travel_mode, job_id=job_id, deadline=deadline, profile_id=profile_id).set(queue=route_queue),
+        weather_fanout_stage.s(job_id=job_id, deadline=deadline, profile_id=profile_id).set(queue=io_queue),
+    )
+
+
+@celery_app.task(bind=True, base=StageTask, name="geocode_stage")
+def geocode_stage(
+    self,
+    start_location: str,
+    end_location: str,
+    travel_mode: str = "auto",
+    job_id: str | None = None,
+    deadline: float | None = None,
+    profile_id: str | None = None,
+):
+    _update_progress(self, "coordinates", "Buscando coordenadas das cidades", task_id=job_id)
+    with request_deadline(deadline):
+        start_latlng, end_latlng = get_coordinates(start_location, end_location)
+    endpoints = _size_job(self, {"start": list(start_latlng)[:2], "end": list(end_latlng)[:2]}, travel_mode, job_id)
+    # Once sized, the job knows which queues its route and weather stages need
+    return self.replace(_route_workflow(endpoints, travel_mode, job_id, deadline, profile_id))
+
+
+@celery_app.task(bind=True, base=StageTask, name="route_stage")
+def route_stage(
+    self,
+    endpoints: dict,
+    travel_mode: str = "auto",
+    job_id: str | None = None,
+    deadline: float | None = None,
+    profile_id: str | None = None,
+) -> dict:
+    if uses_graph_routing(travel_mode):
+        # The in-process A* holds its search state here, not in the render
+        _wait_for_memory(self, endpoints.get("estimate"), "route", job_id)
+    _update_progress(self, "route", "Gerando rota com OSRM", task_id=job_id)
+    start_latlng = tuple(endpoints["start"])
+    end_latlng = tuple(endpoints["end"])
+    route = {"start": start_latlng, "end": end_latlng, "estimate": endpoints.get("estimate")}
     try:
-        map_path = create_map(start_location, end_location, travel_mode, task=self)
-        return {"map_file": map_path}
-    except Exception as exc:  # pragma: no cover - Celery handles logging
-        _update_progress(self, "failed", str(exc))
-        raise
+        with request_deadline(deadline):
+            route_data, trip_info = get_route_data(start_latlng, end_latlng, travel_mode)
+    except Exception as exc:
+        # Routing errors are shown to the user as an error page, not a failed task
+        route["error"] = str(exc)
+        return route
+    route.update(_route_meta(start_latlng, end_latlng, route_data, trip_info))
+    return route
+
+
+def _route_meta(start_latlng, end_latlng, route_data: dict, trip_info: dict) -> dict:
+    """The route as the stages pass it around and /refresh reads it back."""
+    return {
+        "start": tuple(start_latlng)[:2],
+        "end": tuple(end_latlng)[:2],
+        # polyline6 keeps the payload passed between stages small
+        "geometry": encode_route_points(route_data["route_points"]),
+        "duration": route_data["duration"],
+        "distance": route_data["distance"],
+        "trip_info": trip_info,
+    }
+
+
+@celery_app.task(bind=True, base=StageTask, name="weather_fanout_stage")
+def weather_fanout_stage(self, route: dict, job_id: str | None = None, deadline: float | None = None, profile_id: str | None = None):
+    """Splits the route's weather samples into chunks fetched in parallel, then renders."""
+    if route.get("error"):
+        error_html = get_error_html(route["error"], route["start"], route["end"])
+        return {"map_file": _save_map_file(error_html)}
+
+    samples = get_sample_plan(decode_route_points(route["geometry"]), route["duration"])
+    _update_progress(self, "weather", f"Consultando clima em {len(samples)} pontos", task_id=job_id)
+    # Oversized jobs render on the dedicated heavy queue; with geo routing
+    # the render and every chunk go to the shard serving the route's region
+    render_queue = geo_queue((route.get("estimate") or {}).get("queue", "render"), route["start"], route["end"])
+    io_queue = geo_queue("io", route["start"], route["end"])
+    if not samples:
+        return self.replace(render_stage.s([], route, samples, job_id=job_id, profile_id=profile_id).set(queue=render_queue))
+
+    chunks = [samples[i : i + WEATHER_CHUNK_SIZE] for i in range(0, len(samples), WEATHER_CHUNK_SIZE)]
+    header = group(
+        weather_chunk_task.s(chunk, job_id=job_id, deadline=deadline, profile_id=profile_id).set(queue=io_queue)
+        for chunk in chunks
+    )
+    render = render_stage.s(route, samples, job_id=job_id, profile_id=profile_id).set(queue=render_queue)
+    return self.replace(chord(header, render))
+
+
+@celery_app.task(
+    bind=True,
+    base=StageTask,
+    name="weather_chunk_task",
+    max_retries=WEATHER_CHUNK_MAX_RETRIES,
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def weather_chunk_task(
+    self, samples: list, job_id: str | None = None, deadline: float | None = None, profile_id: str | None = None
+) -> list:
+    # Deliveries of this attempt; acks_late redelivers it when its worker dies
+    deliveries = cache_incr(f"rr:chunk:{self.request.id}:{self.request.retries}", JOB_META_TTL)
+    if deliveries is not None and deliveries > WEATHER_CHUNK_MAX_DELIVERIES:
+        print(f"Warning: bloco de clima {self.request.id} abandonado apos {deliveries - 1} entregas")
+        return get_unresolved_statuses(samples)
+
+    # Past the deadline this returns at once, leaving the samples unresolved
+    with request_deadline(deadline):
+        statuses = get_samples_weather(samples)
+
+    # Provider failures come back as unresolved samples rather than errors, so
+    # an incomplete chunk is retried on its own while the deadline allows it.
+    # Points already answered are served from the weather cache on the retry.
+    countdown = WEATHER_CHUNK_RETRY_SECONDS * 2**self.request.retries
+    has_time = deadline is None or deadline - time.time() > countdown + 1
+    incomplete = any(status.get("unresolved") for status in statuses)
+    if incomplete and has_time and self.request.retries < WEATHER_CHUNK_MAX_RETRIES:
+        if self.request.is_eager:
+            # In-process retries run right away, so wait here instead
+            time.sleep(countdown)
+        raise self.retry(countdown=countdown)
+    return statuses
+
+
+@celery_app.task(bind=True, base=StageTask, name="render_stage")
+def render_stage(
+    self, chunk_statuses: list, route: dict, samples: list, job_id: str | None = None, profile_id: str | None = None
+) -> dict:
+    _wait_for_memory(self, route.get("estimate"), "render", job_id)
+
+    _update_progress(self, "map", "Renderizando mapa com dados de chuva", task_id=job_id)
+    statuses = [status for chunk in chunk_statuses for status in chunk]
+    route_points = decode_route_points(route["geometry"])
+    segment_data = build_segments(route_points, samples, statuses)
+    route_map = render_map(route_points, segment_data, route["start"], route["end"], route["trip_info"])
+
+    _update_progress(self, "saving", "Salvando mapa em disco", task_id=job_id)
+    _save_job_meta(job_id or self.request.id, route, samples, statuses)
+    result = {"map_file": _save_map_file(route_map)}
+    _save_map_image(result["map_file"], route_points, segment_data, route["start"], route["end"])
+    unresolved = sum(1 for status in statuses if status and status.get("unresolved"))
+    if unresolved:
+        # The deadline passed before every sample had weather
+        result.update({"partial": True, "unresolved_samples": unresolved})
+    return result
+
+
+def _save_job_meta(job_id: str, route: dict, samples: list, statuses: list, ttl: int = JOB_META_TTL) -> None:
+    """Keeps what /refresh and /result?format=image need to redo a finished map."""
+    cache_set_json(f"rr:job:{job_id}", {"route": route, "samples": samples, "statuses": statuses}, ttl)
+
+
+def _segment_diff(old_segments: list, new_segments: list) -> list:
+    """
+    Segments of the new map (build_segments output, interpolated or not)
+    whose color changed, matched to the old map by their route indexes.
+    """
+    old_by_span = {(segment["start_index"], segment["end_index"]): segment for segment in old_segments}
+    changed = []
+    for position, new in enumerate(new_segments):
+        # Unresolved segments (no provider answer) count as having no color
+        if new.get("unresolved"):
+            continue
+        old = old_by_span.get((new["start_index"], new["end_index"]))
+        old = None if old and old.get("unresolved") else old
+        old_key = (get_rain_color(old["volume"]), old["is_rainy"], old["prob"]) if old else None
+        new_key = (get_rain_color(new["volume"]), new["is_rainy"], new["prob"])
+        if new_key != old_key:
+            changed.append({
+                "segment": position,
+                "start_index": new["start_index"],
+                "end_index": new["end_index"],
+                "color": new_key[0],
+                "previous_color": old_key[0] if old_key else None,
+                "volume": new["volume"],
+                "prob": new["prob"],
+                "time": new["time"],
+                "is_rainy": new["is_rainy"],
+                "provider": new["provider"],
+            })
+    return changed
+
+
+@celery_app.task(bind=True, name="refresh_weather_task")
+def refresh_weather_task(self, source_task_id: str, output: str = "map") -> dict:
+    """
+    Fetches only the weather of a finished map, reusing its route, sample
+    plan and trip info. Returns the changed segments and, for output="map",
+    a new map. The refresh can itself be refreshed later.
+    """
+    meta = cache_get_json(f"rr:job:{source_task_id}")
+    if meta is None:
+        raise LookupError("Rota da tarefa original expirou. Gere o mapa novamente.")
+    route, samples = meta["route"], meta["samples"]
+
+    _update_progress(self, "weather", f"Atualizando clima em {len(samples)} pontos")
+    statuses = get_samples_weather(samples)
+    # Diffed as drawn, so interpolated sub-segments match the rendered map
+    route_points = decode_route_points(route["geometry"])
+    segment_data = build_segments(route_points, samples, statuses)
+    changed = _segment_diff(build_segments(route_points, samples, meta["statuses"]), segment_data)
+    _save_job_meta(self.request.id, route, samples, statuses)
+    result = {
+        "source_task_id": source_task_id,
+        "segment_count": len(segment_data),
+        "changed_count": len(changed),
+        "changed": changed,
+    }
+
+    if output == "map":
+        _update_progress(self, "map", "Renderizando mapa com dados de chuva")
+        route_map = render_map(route_points, segment_data, route["start"], route["end"], route["trip_info"])
+        result["map_file"] = _save_map_file(route_map)
+        _save_map_image(result["map_file"], route_points, segment_data, route["start"], route["end"])
+    return result
+
+
+@celery_app.task(name="refresh_weather_cube_task")
+def refresh_weather_cube_task() -> dict | None:
+    from weather_cube import refresh_cube
+
+    return refresh_cube()
+
+
+@celery_app.task(name="prewarm_corridors_task")
+def prewarm_corridors_task(limit: int | None = None) -> dict:
+    """
+    Refreshes geocodes, route, weather and the rendered map of the busiest
+    corridors. Provider calls run at PREWARM_PRIORITY and the run stops
+    taking corridors once PREWARM_MAX_WEATHER_CALLS samples are spent.
+    """
+    map_ttl = min(PREWARM_MAP_TTL, MAP_MAX_AGE_SECONDS)
+    report = {"warmed": 0, "skipped": 0, "weather_calls": 0}
+    with priority_cap(PREWARM_PRIORITY):
+        for key, _count in top_corridors(limit or PREWARM_TOP_N):
+            start, end, travel_mode = corridor_places(key)
+            try:
+                if isinstance(start, tuple):
+                    start_latlng, end_latlng = start, end
+                else:
+                    start_latlng, end_latlng = get_coordinates(start, end)
+                start_latlng, end_latlng = tuple(start_latlng)[:2], tuple(end_latlng)[:2]
+                estimate = estimate_job(start_latlng, end_latlng, travel_mode)
+                if estimate["rejected"] or report["weather_calls"] + estimate["samples"] > PREWARM_MAX_WEATHER_CALLS:
+                    report["skipped"] += 1
+                    continue
+
+                route_data, trip_info = get_route_data(start_latlng, end_latlng, travel_mode)
+                samples = get_sample_plan(route_data["route_points"], route_data["duration"])
+                report["weather_calls"] += len(samples)
+                statuses = get_samples_weather(samples)
+                segment_data = build_segments(route_data["route_points"], samples, statuses)
+                route_map = render_map(route_data["route_points"], segment_data, start_latlng, end_latlng, trip_info)
+                map_file = _save_map_file(route_map)
+                _save_map_image(map_file, route_data["route_points"], segment_data, start_latlng, end_latlng)
+                # Copied under each task id _serve_prewarmed hands out
+                route = _route_meta(start_latlng, end_latlng, route_data, trip_info)
+                _save_job_meta(f"prewarm:{key}", route, samples, statuses, map_ttl)
+                set_prewarmed_map(key, map_file, map_ttl)
+                report["warmed"] += 1
+            except Exception as exc:
+                print(f"Warning: Could not prewarm {key} - {exc}")
+                report["skipped"] += 1
+    return report
+
+
+@celery_app.task(bind=True, name="departure_windows_task")
+def departure_windows_task(
+    self,
+    start_location: str | None,
+    end_location: str | None,
+    travel_mode: str = "auto",
+    window_minutes: int = DEPARTURE_WINDOW_MINUTES,
+    step_minutes: int = DEPARTURE_STEP_MINUTES,
+    start_latlng: list | None = None,
+    end_latlng: list | None = None,
+    deadline: float | None = None,
+) -> dict:
+    """Ranks departure times by rain exposure from one route and one weather fetch."""
+    with request_deadline(deadline):
+        if start_latlng is None or end_latlng is None:
+            _update_progress(self, "coordinates", "Buscando coordenadas das cidades")
+            start_latlng, end_latlng = get_coordinates(start_location, end_location)
+        start_latlng, end_latlng = tuple(start_latlng)[:2], tuple(end_latlng)[:2]
+
+        _update_progress(self, "memory_check", "Estimando memoria necessaria")
+        check_job_size(estimate_job(start_latlng, end_latlng, travel_mode))
+
+        _update_progress(self, "route", "Gerando rota com OSRM")
+        route_data, trip_info = get_route_data(start_latlng, end_latlng, travel_mode)
+
+        # Past the deadline the remaining lookups are skipped and the windows
+        # they leave uncovered rank last
+        _update_progress(self, "weather", "Comparando horarios de saida")
+        offsets = list(range(0, window_minutes + 1, step_minutes))
+        windows = get_departure_windows(route_data, offsets)
+    return {
+        "start": list(start_latlng),
+        "end": list(end_latlng),
+        "trip_time": trip_info["trip_time"],
+        "distance": trip_info["distance"],
+        "route_provider": trip_info.get("route_provider"),
+        "windows": windows,
+        "best": windows[0] if windows else None,
+    }
+
+
+@celery_app.task(bind=True, name="alternatives_task")
+def alternatives_task(
+    self,
+    start_location: str | None,
+    end_location: str | None,
+    travel_mode: str = "auto",
+    start_latlng: list | None = None,
+    end_latlng: list | None = None,
+) -> dict:
+    """
+    Evaluates the main route and its alternatives for rain, sharing weather
+    lookups between overlapping routes. Renders the driest one with the
+    others in gray and returns every route's summary, ranked.
+    """
+    if start_latlng is None or end_latlng is None:
+        _update_progress(self, "coordinates", "Buscando coordenadas das cidades")
+        start_latlng, end_latlng = get_coordinates(start_location, end_location)
+    start_latlng, end_latlng = tuple(start_latlng)[:2], tuple(end_latlng)[:2]
+
+    _update_progress(self, "memory_check", "Estimando memoria necessaria")
+    # Alternatives always come from OSRM/Valhalla, never the local router
+    check_job_size(estimate_job(start_latlng, end_latlng, travel_mode, graph_mode=False))
+
+    _update_progress(self, "route", "Buscando rotas alternativas")
+    try:
+        routes, trip_info = get_route_alternatives(start_latlng, end_latlng, travel_mode)
+    except Exception as exc:
+        return {"map_file": _save_map_file(get_error_html(str(exc), start_latlng, end_latlng)), "alternatives": []}
+
+    _update_progress(self, "weather", f"Consultando clima em {len(routes)} rotas")
+    evaluated = get_alternatives_weather(routes)
+
+    _update_progress(self, "map", "Renderizando mapa com dados de chuva")
+    best = evaluated[0]
+    best_route = best["route"]
+    trip_info["trip_time"] = best_route["duration"]
+    trip_info["distance"] = best_route["distance"]
+    summaries = []
+    for rank, item in enumerate(evaluated, start=1):
+        summaries.append({
+            "rank": rank,
+            "route_index": item["route_index"],
+            "duration": round(item["route"]["duration"], 1),
+            "distance": round(item["route"]["distance"], 1),
+            "exposure": item["exposure"],
+            "rainy_minutes": item["rainy_minutes"],
+            "max_volume": item["max_volume"],
+            "coverage": item["coverage"],
+        })
+    others = [
+        {
+            "route_points": item["route"]["route_points"],
+            "label": f"Alternativa {summary['rank']}: {summary['duration']:.0f} min, {summary['rainy_minutes']} min com chuva",
+        }
+        for item, summary in zip(evaluated[1:], summaries[1:])
+    ]
+    segment_data = build_segments(best_route["route_points"], best["samples"], best["statuses"])
+    route_map = render_map(best_route["route_points"], segment_data, start_latlng, end_latlng, trip_info, others)
+
+    _update_progress(self, "saving", "Salvando mapa em disco")
+    route = _route_meta(start_latlng, end_latlng, best_route, trip_info)
+    _save_job_meta(self.request.id, route, best["samples"], best["statuses"])
+    map_file = _save_map_file(route_map)
+    _save_map_image(map_file, best_route["route_points"], segment_data, start_latlng, end_latlng)
+    return {"map_file": map_file, "alternatives": summaries}
+
+
+def _worst_segment(samples: list, statuses: list) -> dict | None:
+    worst = None
+    for sample, status in zip(samples, statuses):
+        if status and (worst is None or (status["volume"], status["prob"]) > (worst["volume"], worst["prob"])):
+            worst = {
+                "lat": sample["lat"],
+                "lon": sample["lon"],
+                "time": status["time"],
+                "volume": status["volume"],
+                "prob": status["prob"],
+                "is_rainy": status["is_rainy"],
+            }
+    return worst
+
+
+def _geocode_places(places) -> dict:
+    """{place name: (lat, lon) or the geocoding error}, geocoding each distinct name once."""
+    geocoded = {}
+    for place in places:
+        if isinstance(place, str) and place not in geocoded:
+            try:
+                geocoded[place] = tuple(geocode_location(place))[:2]
+            except Exception as exc:
+                geocoded[place] = exc
+    return geocoded
+
+
+def _fetch_routes(route_keys) -> dict:
+    """{(start, end, travel_mode): (route_data, trip_info) or the error}, fetched concurrently."""
+    route_keys = list(dict.fromkeys(route_keys))
+
+    def fetch_route(key):
+        try:
+            return get_route_data(*key)
+        except Exception as exc:
+            return exc
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as executor:
+        return dict(zip(route_keys, executor.map(fetch_route, route_keys)))
+
+
+@celery_app.task(bind=True, name="batch_task")
+def batch_task(self, trips: list, with_maps: bool = False) -> dict:
+    """
+    Evaluates many trips in one job. Every distinct place name is geocoded
+    once, distinct routes are fetched concurrently and the weather samples
+    of all trips are merged (one lookup per grid cell and hour) before
+    fetching. Returns one summary per trip, in order; a failed trip only
+    carries an error.
+    """
+    _update_progress(self, "coordinates", f"Buscando coordenadas de {len(trips)} viagens")
+    places = _geocode_places(place for trip in trips for place in (trip["start"], trip["end"]))
+
+    results = []
+    routable = []
+    for trip in trips:
+        result = {"id": trip["id"], "travel_mode": trip["travel_mode"]}
+        results.append(result)
+        start, end = (
+            places[place] if isinstance(place, str) else tuple(place)
+            for place in (trip["start"], trip["end"])
+        )
+        if isinstance(start, Exception) or isinstance(end, Exception):
+            result["error"] = str(start if isinstance(start, Exception) else end)
+            continue
+        try:
+            check_job_size(estimate_job(start, end, trip["travel_mode"]))
+        except MemoryError as exc:
+            result["error"] = str(exc)
+            continue
+        result["start"], result["end"] = list(start), list(end)
+        routable.append((result, (start, end, trip["travel_mode"])))
+
+    _update_progress(self, "route", f"Gerando {len(routable)} rotas")
+    routes = _fetch_routes(key for _, key in routable)
+
+    routed = []
+    for result, key in routable:
+        if isinstance(routes[key], Exception):
+            result["error"] = str(routes[key])
+        else:
+            routed.append((result, key, *routes[key]))
+
+    _update_progress(self, "weather", "Consultando clima de todas as viagens")
+    evaluated = evaluate_routes_weather(
+        [route_data for _, _, route_data, _ in routed],
+        workers=BATCH_CONCURRENCY,
+        chunk_size=WEATHER_CHUNK_SIZE,
+    )
+
+    if with_maps:
+        _update_progress(self, "map", f"Renderizando {len(routed)} mapas")
+    now = time.time()
+    rendered = {}
+    for (result, key, route_data, trip_info), item in zip(routed, evaluated):
+        arrival = time.gmtime(now + route_data["duration"] * 60 - 3 * 3600)
+        result.update({
+            "route_provider": trip_info.get("route_provider"),
+            "trip_time": round(route_data["duration"], 1),
+            "distance": round(route_data["distance"], 1),
+            "eta": time.strftime("%H:%M", arrival),
+            "exposure": item["exposure"],
+            "rainy_minutes": item["rainy_minutes"],
+            "max_volume": item["max_volume"],
+            "coverage": item["coverage"],
+            "worst_segment": _worst_segment(item["samples"], item["statuses"]),
+        })
+        if with_maps and key not in rendered:
+            segment_data = build_segments(route_data["route_points"], item["samples"], item["statuses"])
+            route_map = render_map(route_data["route_points"], segment_data, key[0], key[1], trip_info)
+            map_file = _save_map_file(route_map)
+            _save_map_image(map_file, route_data["route_points"], segment_data, key[0], key[1])
+            # Trips sharing a route share its map and its /refresh id
+            map_id = f"{self.request.id}:{len(rendered)}"
+            route = _route_meta(key[0], key[1], route_data, trip_info)
+            _save_job_meta(map_id, route, item["samples"], item["statuses"])
+            rendered[key] = (map_file, map_id)
+        if with_maps:
+            result["map_file"], result["map_id"] = rendered[key]
+
+    failed = sum(1 for result in results if "error" in result)
+    return {"trips": results, "count": len(results), "failed": failed}
+
+
+@celery_app.task(bind=True, name="watchlist_task")
+def watchlist_task(self) -> dict:
+    """
+    Re-evaluates every watched route (see watchlist.py) in one pass, as
+    batch_task does, for each route's next usual departure. Only routes
+    where some segment's rain class changed since the last evaluation are
+    stored and published.
+    """
+    watches = all_watches()
+    report = {"routes": len(watches), "evaluated": 0, "changed": 0, "failed": 0}
+    if not watches:
+        return report
+
+    with priority_cap(WATCHLIST_PRIORITY):
+        places = _geocode_places(place for watch in watches for place in (watch["start"], watch["end"]))
+        keyed = []
+        for watch in watches:
+            start, end = (
+                places[place] if isinstance(place, str) else tuple(place)
+                for place in (watch["start"], watch["end"])
+            )
+            if not isinstance(start, Exception) and not isinstance(end, Exception):
+                keyed.append((watch, (start, end, watch["travel_mode"])))
+
+        routes = _fetch_routes(key for _, key in keyed)
+        routed = [(watch, key, routes[key][0]) for watch, key in keyed if not isinstance(routes[key], Exception)]
+        evaluated = evaluate_routes_weather(
+            [route_data for _, _, route_data in routed],
+            workers=BATCH_CONCURRENCY,
+            chunk_size=WEATHER_CHUNK_SIZE,
+            departure_offsets=[departure_offset(watch["departure"]) for watch, _, _ in routed],
+        )
+
+    states = load_states([watch["watch_id"] for watch, _, _ in routed])
+    evaluated_at = int(time.time())
+    updates = []
+    for (watch, key, route_data), item in zip(routed, evaluated):
+        state, changed = class_changes(item["samples"], item["statuses"], states.get(watch["watch_id"]))
+        if not changed:
+            continue
+        state["evaluated_at"] = evaluated_at
+        updates.append((watch["watch_id"], state, {
+            "watch_id": watch["watch_id"],
+            "evaluated_at": evaluated_at,
+            "departure": watch["departure"],
+            "travel_mode": watch["travel_mode"],
+            "start": list(key[0]),
+            "end": list(key[1]),
+            "trip_time": round(route_data["duration"], 1),
+            "distance": round(route_data["distance"], 1),
+            "exposure": item["exposure"],
+            "rainy_minutes": item["rainy_minutes"],
+            "max_volume": item["max_volume"],
+            "coverage": item["coverage"],
+            "changed": changed,
+        }))
+
+    report.update({
+        "evaluated": len(routed),
+        "changed": publish_changes(updates),
+        "failed": len(watches) - len(routed),
+    })
+    print(f"Watchlist: {report['evaluated']}/{report['routes']} rotas avaliadas, {report['changed']} com mudancas")
+    return report
+
+
+@celery_app.task(bind=True, name="generate_map_task")
+def generate_map_task(
+    self,
+    start_location: str,
+    end_location: str,
+    travel_mode: str = "auto",
+    deadline: float | None = None,
+    profile_id: str | None = None,
+):
+    # The workflow takes over this task's id, so /progress and /result keep
+    # working with the id returned to the client.
+    job_id = self.request.id
+    # Geocoding sizes the job and then hands over to the route workflow
+    return self.replace(
+        geocode_stage.s(start_location, end_location, travel_mode=travel_mode, job_id=job_id, deadline=deadline, profile_id=profile_id)
+    )
 
 @celery_app.task(bind=True, name="generate_map_with_coordinates_task")
-def generate_map_with_coordinates_task(self, start_latlng: tuple[float], end_latlng: tuple[float], travel_mode: str = "auto") -> dict:
+def generate_map_with_coordinates_task(
+    self,
+    start_latlng: tuple[float],
+    end_latlng: tuple[float],
+    travel_mode: str = "auto",
+    deadline: float | None = None,
+    profile_id: str | None = None,
+):
     start_latlng = (start_latlng[0], start_latlng[1])
     end_latlng = (end_latlng[0], end_latlng[1])
     travel_mode = travel_mode 
     print(f"Received coordinates: start={start_latlng}, end={end_latlng}, travel_mode={travel_mode}")
-    try:
-        map_path = create_map_with_coordinates(start_latlng, end_latlng, travel_mode,  task=self)
-        return {"map_file": map_path}
-    except Exception as exc:  # pragma: no cover - Celery handles logging
-        _update_progress(self, "failed", str(exc))
-        raise
+    job_id = self.request.id
+    endpoints = _size_job(self, {"start": list(start_latlng), "end": list(end_latlng)}, travel_mode)
+    # The endpoints are known, so routing already runs on the region's shard
+    return self.replace(_route_workflow(endpoints, travel_mode, job_id, deadline, profile_id))
 
 
 def _sanitize_location(value):
@@ -171,6 +967,29 @@ def _sanitize_location(value):
     return str(escape(value)).strip()
 
 
+def _is_admin() -> bool:
+    supplied = request.headers.get("X-Admin-Token", "")
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode())
+
+
+def _serve_prewarmed(start, end, travel_mode: str):
+    """
+    Counts the request for the prewarmer and, when a prewarmed map exists,
+    answers with an already finished task so /progress and /result work as usual.
+    """
+    record_request(start, end, travel_mode)
+    map_file = get_prewarmed_map(start, end, travel_mode)
+    if map_file is None:
+        return None
+    task_id = uuid.uuid4().hex
+    meta = cache_get_json(f"rr:job:prewarm:{corridor_key(start, end, travel_mode)}")
+    if meta is not None:
+        # Lets /refresh and /result?format=image work on the prewarmed map
+        _save_job_meta(task_id, meta["route"], meta["samples"], meta["statuses"])
+    celery_app.backend.store_result(task_id, {"map_file": map_file, "cached": True}, "SUCCESS")
+    return jsonify({"task_id": task_id, "cached": True}), 202
+
+
 @app.route("/", methods=["GET"])
 def index():
     return send_file("static/index.html", mimetype="text/html")
@@ -189,7 +1008,7 @@ def generate_map_legacy():
         )
 
     try:
-        map_path = create_map(start_location, end_location)
+        map_path = create_map(start_location, end_location, deadline=new_deadline())
     except MemoryError as memory_error:
         return Response(
             f"<center><h1>{memory_error}</h1></center>",
@@ -221,28 +1040,300 @@ def request_map_generation():
     start_lon = request.args.get("start_lon")
     end_lat = request.args.get("end_lat")
     end_lon = request.args.get("end_lon")
+    # The job has this long (capped by MAX_REQUEST_DEADLINE_SECONDS) before
+    # it stops asking for weather and finishes with a partial map
+    try:
+        deadline = new_deadline(float(request.args["deadline_seconds"]) if request.args.get("deadline_seconds") else None)
+    except ValueError:
+        return jsonify({"error": "deadline_seconds deve ser um numero."}), 400
+    # profile=1 is honored for admins only; PROFILE_SAMPLE_RATE picks the rest
+    profile_requested = request.args.get("profile", "").lower() in ("true", "1", "yes") and _is_admin()
+    profile_id = new_profile_id(profile_requested)
+    job_kwargs = {"deadline": deadline, "profile_id": profile_id}
     
     if start_lat and start_lon and end_lat and end_lon:
         try:
             start_latlng = (float(start_lat), float(start_lon))
             end_latlng = (float(end_lat), float(end_lon))
-            task = generate_map_with_coordinates_task.apply_async(args=[start_latlng, end_latlng, travel_mode])
+            try:
+                # Reject oversized trips before they reach a worker
+                check_job_size(estimate_job(start_latlng, end_latlng, travel_mode))
+            except MemoryError as memory_error:
+                return jsonify({"error": str(memory_error)}), 507
+            cached = None if profile_requested else _serve_prewarmed(start_latlng, end_latlng, travel_mode)
+            if cached is not None:
+                return cached
+            task = _enqueue(
+                generate_map_with_coordinates_task,
+                args=[start_latlng, end_latlng, travel_mode], kwargs=job_kwargs
+            )
         except ValueError:  
             if not start_location or not end_location:
                 return jsonify(
                     {"error": "As cidades de origem e destino sao obrigatorias."}
                 ), 400
-            task = generate_map_task.apply_async(args=[start_location, end_location, travel_mode])
+            cached = None if profile_requested else _serve_prewarmed(start_location, end_location, travel_mode)
+            if cached is not None:
+                return cached
+            task = _enqueue(
+                generate_map_task,
+                args=[start_location, end_location, travel_mode], kwargs=job_kwargs
+            )
     else:
         if not start_location or not end_location:
             return jsonify(
                 {"error": "As cidades de origem e destino sao obrigatorias."}
             ), 400
-        task = generate_map_task.apply_async(args=[start_location, end_location, travel_mode])
+        cached = None if profile_requested else _serve_prewarmed(start_location, end_location, travel_mode)
+        if cached is not None:
+            return cached
+        task = _enqueue(
+            generate_map_task,
+            args=[start_location, end_location, travel_mode], kwargs=job_kwargs
+        )
     
+    if profile_id:
+        # Sampled profiles are only returned to the requester, so log them for admins
+        print(f"Perfil {profile_id} da tarefa {task.id} ({'pedido' if profile_requested else 'amostrado'})")
+        return jsonify({"task_id": task.id, "profile_id": profile_id}), 202
     return jsonify({"task_id": task.id}), 202
 
 
+@app.route("/departure_windows", methods=["GET"])
+def request_departure_windows():
+    """
+    Same parameters as /generate_map_v2, plus window_minutes and step_minutes.
+    The finished task's result (see /progress) lists departures ranked by rain.
+    """
+    start_location = _sanitize_location(request.args.get("start_location"))
+    end_location = _sanitize_location(request.args.get("end_location"))
+    travel_mode = _sanitize_location(request.args.get("travel_mode", "auto"))
+    try:
+        window_minutes = int(request.args.get("window_minutes", DEPARTURE_WINDOW_MINUTES))
+        step_minutes = int(request.args.get("step_minutes", DEPARTURE_STEP_MINUTES))
+    except ValueError:
+        return jsonify({"error": "window_minutes e step_minutes devem ser inteiros."}), 400
+    try:
+        deadline = new_deadline(float(request.args["deadline_seconds"]) if request.args.get("deadline_seconds") else None)
+    except ValueError:
+        return jsonify({"error": "deadline_seconds deve ser um numero."}), 400
+    if step_minutes < 15 or not 0 <= window_minutes <= MAX_DEPARTURE_WINDOW_MINUTES:
+        return jsonify(
+            {"error": f"Use step_minutes >= 15 e window_minutes entre 0 e {MAX_DEPARTURE_WINDOW_MINUTES}."}
+        ), 400
+
+    start_latlng = end_latlng = None
+    try:
+        start_latlng = [float(request.args["start_lat"]), float(request.args["start_lon"])]
+        end_latlng = [float(request.args["end_lat"]), float(request.args["end_lon"])]
+    except (KeyError, ValueError):
+        start_latlng = end_latlng = None
+        if not start_location or not end_location:
+            return jsonify(
+                {"error": "As cidades de origem e destino sao obrigatorias."}
+            ), 400
+
+    task = _enqueue(
+        departure_windows_task,
+        args=[start_location, end_location, travel_mode, window_minutes, step_minutes],
+        kwargs={"start_latlng": start_latlng, "end_latlng": end_latlng, "deadline": deadline},
+    )
+    return jsonify({"task_id": task.id}), 202
+
+
+@app.route("/alternatives", methods=["GET"])
+def request_alternatives():
+    """
+    Same parameters as /generate_map_v2. /result serves the map of the driest
+    route and /progress lists every alternative ranked by rain exposure.
+    """
+    start_location = _sanitize_location(request.args.get("start_location"))
+    end_location = _sanitize_location(request.args.get("end_location"))
+    travel_mode = _sanitize_location(request.args.get("travel_mode", "auto"))
+    try:
+        start_latlng = [float(request.args["start_lat"]), float(request.args["start_lon"])]
+        end_latlng = [float(request.args["end_lat"]), float(request.args["end_lon"])]
+    except (KeyError, ValueError):
+        start_latlng = end_latlng = None
+        if not start_location or not end_location:
+            return jsonify(
+                {"error": "As cidades de origem e destino sao obrigatorias."}
+            ), 400
+
+    task = _enqueue(
+        alternatives_task,
+        args=[start_location, end_location, travel_mode],
+        kwargs={"start_latlng": start_latlng, "end_latlng": end_latlng},
+    )
+    return jsonify({"task_id": task.id}), 202
+
+
+def _parse_batch_place(trip: dict, prefix: str):
+    """A trip endpoint as [lat, lon] when coordinates are given, else the place name."""
+    lat = trip.get(f"{prefix}_lat")
+    lon = trip.get(f"{prefix}_lon")
+    if lat is not None and lon is not None:
+        return [float(lat), float(lon)]
+    name = _sanitize_location(trip.get(f"{prefix}_location"))
+    if not name:
+        raise ValueError(f"{prefix}_location ou {prefix}_lat/{prefix}_lon obrigatorios")
+    return name
+
+
+@app.route("/batch", methods=["POST"])
+def request_batch():
+    """
+    Body: {"trips": [{"id", "start_location" | "start_lat"/"start_lon",
+    "end_location" | "end_lat"/"end_lon", "travel_mode"}, ...], "maps": false}.
+    The finished task's result (see /progress) has one summary per trip;
+    maps, when requested, are served by /batch/<task_id>/map/<trip index>.
+    """
+    body = request.get_json(silent=True) or {}
+    raw_trips = body.get("trips")
+    if not isinstance(raw_trips, list) or not raw_trips:
+        return jsonify({"error": "Envie uma lista de viagens em 'trips'."}), 400
+    if len(raw_trips) > BATCH_MAX_TRIPS:
+        return jsonify({"error": f"No maximo {BATCH_MAX_TRIPS} viagens por lote."}), 400
+
+    trips = []
+    for index, raw_trip in enumerate(raw_trips):
+        try:
+            if not isinstance(raw_trip, dict):
+                raise ValueError("viagem deve ser um objeto")
+            travel_mode = _sanitize_location(raw_trip.get("travel_mode", "auto"))
+            if travel_mode not in ("auto", "bicycle", "pedestrian"):
+                raise ValueError("travel_mode invalido")
+            trips.append({
+                "id": raw_trip.get("id", index),
+                "start": _parse_batch_place(raw_trip, "start"),
+                "end": _parse_batch_place(raw_trip, "end"),
+                "travel_mode": travel_mode,
+            })
+        except (TypeError, ValueError) as exc:
+            return jsonify({"error": f"Viagem {index}: {exc}"}), 400
+
+    with_maps = bool(body.get("maps", False))
+    # Rendering is CPU bound, so batches with maps go to the render workers
+    task = _enqueue(batch_task, args=[trips, with_maps], queue="render" if with_maps else "io")
+    return jsonify({"task_id": task.id, "count": len(trips)}), 202
+
+
+@app.route("/watchlist", methods=["POST"])
+def request_watch():
+    """
+    Body: {"start_location" | "start_lat"/"start_lon", "end_location" |
+    "end_lat"/"end_lon", "travel_mode", "departure": "HH:MM" (BRT)}.
+    The route is re-evaluated by the watchlist beat task; see GET /watchlist/<id>.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        travel_mode = _sanitize_location(body.get("travel_mode", "auto"))
+        if travel_mode not in ("auto", "bicycle", "pedestrian"):
+            raise ValueError("travel_mode invalido")
+        if not body.get("departure"):
+            raise ValueError("departure obrigatorio (HH:MM)")
+        watch_id = add_watch(
+            _parse_batch_place(body, "start"),
+            _parse_batch_place(body, "end"),
+            travel_mode,
+            body["departure"],
+        )
+    except WatchlistUnavailable as exc:
+        return jsonify({"error": str(exc)}), 503
+    except (TypeError, ValueError) as exc:
+        return jsonify({"error": str(exc)}), 400
+    return jsonify({"watch_id": watch_id}), 201
+
+
+@app.route("/watchlist/<watch_id>", methods=["GET", "DELETE"])
+def watched_route(watch_id: str):
+    """The watched route and its last published result, or DELETE to stop watching it."""
+    try:
+        if request.method == "DELETE":
+            if not remove_watch(watch_id):
+                return jsonify({"error": "Rota monitorada nao encontrada."}), 404
+            return "", 204
+        watch, last_result = get_watch(watch_id)
+    except WatchlistUnavailable as exc:
+        return jsonify({"error": str(exc)}), 503
+    if watch is None:
+        return jsonify({"error": "Rota monitorada nao encontrada."}), 404
+    return jsonify({**watch, "last_result": last_result})
+
+
+@app.route("/batch/<task_id>/map/<int:trip_index>", methods=["GET"])
+def get_batch_map(task_id: str, trip_index: int):
+    """A trip's map; format=image as in /result. The trip's map_id can be passed to /refresh."""
+    output = _map_format()
+    if output is None:
+        return jsonify({"error": "format deve ser 'html', 'image', 'webp' ou 'png'."}), 400
+
+    async_result = celery_app.AsyncResult(task_id)
+
+    if not async_result.successful():
+        return jsonify({"error": "Tarefa ainda nao finalizada ou falhou."}), 409
+
+    trips = (async_result.result or {}).get("trips", [])
+    trip = trips[trip_index] if 0 <= trip_index < len(trips) else {}
+    map_path = trip.get("map_file")
+
+    if not map_path or not os.path.isfile(map_path):
+        return jsonify({"error": "Mapa nao encontrado para esta viagem."}), 404
+
+    return _send_map(map_path, output, trip.get("map_id", ""))
+
+
+@app.route("/refresh/<task_id>", methods=["GET"])
+def request_refresh(task_id: str):
+    """
+    Weather-only refresh of a map generated by /generate_map_v2, /alternatives
+    or a prewarmed corridor (or of an earlier refresh). Batch maps are
+    refreshed by their trip's map_id. format=map (default) renders a new map, served by
+    /result; format=diff only returns the changed segment colors, see /progress.
+    """
+    output = request.args.get("format", "map")
+    if output not in ("map", "diff"):
+        return jsonify({"error": "format deve ser 'map' ou 'diff'."}), 400
+    meta = cache_get_json(f"rr:job:{task_id}")
+    if meta is None:
+        return jsonify({"error": "Rota da tarefa nao encontrada ou expirada. Gere o mapa novamente."}), 404
+
+    # Only a map render needs the CPU bound workers
+    queue = geo_queue("render" if output == "map" else "io", meta["route"]["start"], meta["route"]["end"])
+    task = _enqueue(refresh_weather_task, args=[task_id, output], queue=queue)
+    return jsonify({"task_id": task.id}), 202
+
+
+@app.route("/admin/profiles", methods=["GET"])
+def get_profiles():
+    """Saved profiles (requested and sampled), newest first."""
+    if not _is_admin():
+        return jsonify({"error": "Acesso restrito."}), 403
+    return jsonify({"profiles": list_profiles()})
+
+
+@app.route("/admin/profiles/<profile_id>", methods=["GET"])
+def get_profile(profile_id: str):
+    """Per-task reports of a profiled job: slowest functions and largest allocations."""
+    if not _is_admin():
+        return jsonify({"error": "Acesso restrito."}), 403
+    reports = load_profile(profile_id)
+    if reports is None:
+        return jsonify({"error": "Perfil nao encontrado."}), 404
+    return jsonify({"profile_id": profile_id, "tasks": reports})
+
+
+@app.route("/admin/profiles/<profile_id>/<stats_file>", methods=["GET"])
+def get_profile_stats(profile_id: str, stats_file: str):
+    """Raw cProfile stats of one task, for pstats or snakeviz."""
+    if not _is_admin():
+        return jsonify({"error": "Acesso restrito."}), 403
+    path = profile_stats_path(profile_id, stats_file)
+    if path is None:
+        return jsonify({"error": "Perfil nao encontrado."}), 404
+    return send_file(path, mimetype="application/octet-stream", as_attachment=True, download_name=stats_file)
+
+
 @app.route("/progress/<task_id>", methods=["GET"])
 def get_task_progress(task_id: str):
     async_result = celery_app.AsyncResult(task_id)
@@ -258,6 +1349,24 @@ def get_task_progress(task_id: str):
     if async_result.state == "PROGRESS":
         return jsonify({"state": async_result.state, **(async_result.info or {})})
 
+    if async_result.state == "RETRY":
+        # The render stage is waiting for free memory on a worker
+        payload = {
+            "stage": "memory_check",
+            "percent": PROGRESS_PERCENT["memory_check"],
+            "detail": "Aguardando memoria livre no servidor",
+        }
+        return jsonify({"state": "PROGRESS", **payload})
+
+    if async_result.state == "STARTED":
+        # The final render stage runs under the job id
+        payload = {
+            "stage": "map",
+            "percent": PROGRESS_PERCENT["map"],
+            "detail": "Renderizando mapa com dados de chuva",
+        }
+        return jsonify({"state": "PROGRESS", **payload})
+
     if async_result.state == "SUCCESS":
         result = async_result.result or {}
         return jsonify(
@@ -277,6 +1386,14 @@ def get_task_progress(task_id: str):
 
 @app.route("/result/<task_id>", methods=["GET"])
 def get_task_result(task_id: str):
+    """
+    The generated map. format=image (or webp/png) returns the small static
+    image instead of the HTML map, for slow connections.
+    """
+    output = _map_format()
+    if output is None:
+        return jsonify({"error": "format deve ser 'html', 'image', 'webp' ou 'png'."}), 400
+
     async_result = celery_app.AsyncResult(task_id)
 
     if not async_result.successful():
@@ -288,7 +1405,34 @@ def get_task_result(task_id: str):
     if not map_path or not os.path.isfile(map_path):
         return jsonify({"error": "Mapa nao encontrado para esta tarefa."}), 404
 
-    return send_file(map_path, mimetype="text/html")
+    return _send_map(map_path, output, task_id)
+
+
+def _map_format() -> str | None:
+    """The requested map format ("html", "webp" or "png"), or None when invalid."""
+    output = request.args.get("format", "html").lower()
+    if output == "image":
+        output = STATIC_MAP_FORMAT
+    return output if output == "html" or output in MIME_TYPES else None
+
+
+def _send_map(map_path: str, output: str, meta_id: str):
+    """Sends a finished map as HTML or as its static image, drawn from the job meta when missing."""
+    if output == "html":
+        return send_file(map_path, mimetype="text/html")
+
+    image_path = _image_path(map_path, output)
+    if not image_path.is_file():
+        # Not rendered with the map (other format, or disabled): draw it from the job's route and weather
+        meta = cache_get_json(f"rr:job:{meta_id}")
+        if meta is None:
+            return jsonify({"error": "Imagem nao disponivel para esta tarefa."}), 404
+        route_points = decode_route_points(meta["route"]["geometry"])
+        segment_data = build_segments(route_points, meta["samples"], meta["statuses"])
+        image_path.write_bytes(
+            render_static_map(route_points, segment_data, meta["route"]["start"], meta["route"]["end"], image_format=output)
+        )
+    return send_file(image_path, mimetype=MIME_TYPES[output])
 
 
 if __name__ == "__main__":
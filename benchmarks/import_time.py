@@ -0,0 +1,102 @@
+"""
+Import-time profile of the web and worker entry points.
+
+Runs each role in a fresh interpreter with `python -X importtime`, then reports
+the cold start time, the resident memory after import and the slowest imports.
+It also checks that the web role never pulls in the rendering or routing stacks.
+
+    python benchmarks/import_time.py
+    python benchmarks/import_time.py --top 25
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROLES = {
+    "web": "import app",
+    "worker": "import app; app.preload_heavy_modules()",
+    "graph": "import rainy_road; rainy_road._ox()",
+}
+
+# Modules the web role must not load at startup
+HEAVY_MODULES = ("folium", "branca", "geopy", "polyline", "osmnx", "geopandas", "networkx", "shapely", "numpy", "PIL")
+
+_REPORT = (
+    "import json, sys\n"
+    "try:\n"
+    "    import psutil\n"
+    "    rss = psutil.Process().memory_info().rss\n"
+    "except ImportError:\n"
+    "    rss = None\n"
+    "print(json.dumps({'rss': rss, 'modules': sorted(sys.modules)}))\n"
+)
+
+
+def _parse_importtime(stderr):
+    """Returns [(cumulative_us, module)] from -X importtime output."""
+    rows = []
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3:
+            continue
+        try:
+            rows.append((int(parts[1]), parts[2].rstrip()))
+        except ValueError:
+            continue
+    return rows
+
+
+def profile_role(role, statement):
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{statement}\n{_REPORT}"],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        return {"role": role, "error": proc.stderr.strip().splitlines()[-1:]}
+
+    report = json.loads(proc.stdout.strip().splitlines()[-1])
+    loaded = set(report["modules"])
+    return {
+        "role": role,
+        "seconds": elapsed,
+        "rss_mb": report["rss"] / 1024 / 1024 if report["rss"] else None,
+        "modules": len(loaded),
+        "heavy_loaded": [name for name in HEAVY_MODULES if name in loaded],
+        "imports": sorted(_parse_importtime(proc.stderr), reverse=True),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list per role")
+    parser.add_argument("--roles", default=",".join(ROLES), help="comma separated roles to profile")
+    args = parser.parse_args()
+
+    web_is_light = True
+    for role in args.roles.split(","):
+        result = profile_role(role, ROLES[role])
+        if "error" in result:
+            print(f"[{role}] failed: {result['error']}")
+            continue
+        rss = f"{result['rss_mb']:.1f} MB" if result["rss_mb"] else "n/a"
+        print(f"[{role}] {result['seconds'] * 1000:.0f} ms, RSS {rss}, {result['modules']} modules")
+        for cumulative_us, name in result["imports"][: args.top]:
+            print(f"    {cumulative_us / 1000:8.1f} ms  {name.strip()}")
+        if role == "web" and result["heavy_loaded"]:
+            web_is_light = False
+            print(f"    heavy modules loaded by web role: {', '.join(result['heavy_loaded'])}")
+
+    return 0 if web_is_light else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Route geometry decoding benchmark.
+
+Compares, on synthetic long routes, the three ways a route reaches the map
+code: OSRM GeoJSON (json.loads + flipping [lon, lat] pairs into tuples), the
+pure-Python `polyline.decode` that Valhalla shapes went through, and the
+vectorized polyline_codec.decode_polyline. Also reports the payload sizes.
+
+    python benchmarks/polyline_decode.py
+    python benchmarks/polyline_decode.py --points 20000 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from polyline_codec import decode_polyline, encode_polyline  # noqa: E402
+
+
+def synthetic_route(points, seed=0):
+    """A random walk of `points` (lat, lon) pairs with ~10 m steps."""
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(0, 0.0001, size=(points, 2))
+    return np.round(np.cumsum(steps, axis=0) + (-3.73, -38.52), 6)
+
+
+def _best_of(repeat, func):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def run(points, repeat):
+    route = synthetic_route(points)
+    geojson = json.dumps({"coordinates": [[lon, lat] for lat, lon in route.tolist()]})
+    encoded = encode_polyline(route, 6)
+
+    def parse_geojson():
+        coordinates = json.loads(geojson)["coordinates"]
+        return [(lat, lon) for lon, lat in coordinates]
+
+    results = {
+        "geojson": _best_of(repeat, parse_geojson),
+        "vectorized": _best_of(repeat, lambda: decode_polyline(encoded, 6)),
+    }
+    try:
+        import polyline
+
+        results["polyline.decode"] = _best_of(repeat, lambda: polyline.decode(encoded, 6))
+    except ImportError:
+        pass
+
+    assert np.allclose(decode_polyline(encoded, 6), route, atol=1e-6)
+    return {"geojson_bytes": len(geojson), "polyline6_bytes": len(encoded), "seconds": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark route geometry decoding")
+    parser.add_argument("--points", type=int, nargs="+", default=[2000, 20000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for points in args.points:
+        report = run(points, args.repeat)
+        print(
+            f"{points} pontos: GeoJSON {report['geojson_bytes'] / 1024:.0f} KB, "
+            f"polyline6 {report['polyline6_bytes'] / 1024:.0f} KB"
+        )
+        vectorized = report["seconds"]["vectorized"]
+        for name, seconds in report["seconds"].items():
+            print(f"  {name:<16} {seconds * 1000:8.2f} ms  ({seconds / vectorized:5.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+
+# Single-node mode (JOB_BACKEND=local) runs without Redis unless REDIS_URL is
+# set. With an empty REDIS_URL the JSON caches live in this process instead.
+if os.getenv("JOB_BACKEND", "celery").lower() == "local":
+    REDIS_URL = os.getenv("REDIS_URL", "")
+else:
+    REDIS_URL = os.getenv("REDIS_URL", os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0"))
+LOCAL_CACHE_MAX_ENTRIES = int(os.getenv("LOCAL_CACHE_MAX_ENTRIES", "20000"))
+# After a connection error Redis is skipped for this long so a dead server
+# doesn't add a socket timeout to every single provider call.
+REDIS_RETRY_SECONDS = 30
+
+_redis_client = None
+_redis_down_until = 0.0
+# key -> (expires at, JSON text), used when Redis is disabled
+_local_cache = {}
+_local_cache_lock = threading.Lock()
+
+
+def get_redis():
+    """Return the shared Redis client, or None while Redis is unavailable."""
+    global _redis_client
+    if not REDIS_URL or time.time() < _redis_down_until:
+        return None
+    if _redis_client is None:
+        try:
+            import redis
+        except ImportError:
+            return None
+        _redis_client = redis.Redis.from_url(
+            REDIS_URL, socket_timeout=2, socket_connect_timeout=2
+        )
+    return _redis_client
+
+
+def mark_redis_down(exc=None):
+    """Stop using Redis for REDIS_RETRY_SECONDS after a failed command."""
+    global _redis_down_until
+    _redis_down_until = time.time() + REDIS_RETRY_SECONDS
+    if exc is not None:
+        print(f"Warning: Redis indisponivel - {exc}")
+
+
+def _local_get(key):
+    with _local_cache_lock:
+        entry = _local_cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            del _local_cache[key]
+            return None
+        return entry[1]
+
+
+def _local_set(key, raw, ttl):
+    with _local_cache_lock:
+        _local_cache.pop(key, None)
+        if len(_local_cache) >= LOCAL_CACHE_MAX_ENTRIES:
+            now = time.time()
+            for stale_key in [k for k, (expires, _) in _local_cache.items() if expires < now]:
+                del _local_cache[stale_key]
+            # Still full: drop the oldest writes
+            for old_key in list(_local_cache)[: max(0, len(_local_cache) - LOCAL_CACHE_MAX_ENTRIES + 1)]:
+                del _local_cache[old_key]
+        _local_cache[key] = (time.time() + ttl, raw)
+
+
+def cache_get_json(key):
+    """Read a JSON value from Redis. Returns None on miss or error."""
+    if not REDIS_URL:
+        raw = _local_get(key)
+        return json.loads(raw) if raw is not None else None
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        raw = client.get(key)
+    except Exception as exc:
+        mark_redis_down(exc)
+        return None
+    if raw is None:
+        return None
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return None
+
+
+def cache_set_json(key, value, ttl):
+    """Store a JSON value in Redis with a TTL in seconds. Errors are ignored."""
+    if not REDIS_URL:
+        _local_set(key, json.dumps(value), int(ttl))
+        return
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.set(key, json.dumps(value), ex=int(ttl))
+    except Exception as exc:
+        mark_redis_down(exc)
+
+
+def cache_get_fresh(key, max_age):
+    """
+    Returns (data, is_fresh) for a value written by cache_set_stamped.
+    data is None on a miss; is_fresh is False when it is older than max_age.
+    """
+    entry = cache_get_json(key)
+    if not entry or "data" not in entry:
+        return None, False
+    age = time.time() - entry.get("ts", 0)
+    return entry["data"], age <= max_age
+
+
+def cache_set_stamped(key, data, ttl):
+    """Store data together with its fetch time, see cache_get_fresh."""
+    cache_set_json(key, {"ts": time.time(), "data": data}, ttl)
+
+
+def cache_incr(key, ttl):
+    """
+    Atomically increments a counter kept for ttl seconds from its first
+    increment. Returns the new value, or None while Redis is unavailable.
+    """
+    if not REDIS_URL:
+        with _local_cache_lock:
+            expires, raw = _local_cache.get(key, (0, "0"))
+            count = (int(raw) if expires >= time.time() else 0) + 1
+            _local_cache[key] = (expires if count > 1 else time.time() + int(ttl), str(count))
+        return count
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        count = int(client.incr(key))
+        if count == 1:
+            client.expire(key, int(ttl))
+        return count
+    except Exception as exc:
+        mark_redis_down(exc)
+        return None
@@ -0,0 +1,66 @@
+"""
+End-to-end request deadlines.
+
+The API sets an absolute deadline (epoch seconds) per request and it travels
+with the job through every stage. Code running under request_deadline()
+sizes each provider timeout to the time left with call_timeout(), and once
+the deadline passes the weather code stops asking providers and leaves the
+remaining samples unresolved, so the job still ends with a partial map.
+"""
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "45"))
+MAX_REQUEST_DEADLINE_SECONDS = float(os.getenv("MAX_REQUEST_DEADLINE_SECONDS", "120"))
+# Shortest timeout given to a provider call while there is still time left
+MIN_CALL_TIMEOUT = 1.0
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(RuntimeError):
+    """The request ran out of time before this step could start."""
+
+
+def new_deadline(seconds=None):
+    """Absolute deadline `seconds` from now (REQUEST_DEADLINE_SECONDS by default, capped)."""
+    seconds = REQUEST_DEADLINE_SECONDS if seconds is None else seconds
+    return time.time() + max(1.0, min(float(seconds), MAX_REQUEST_DEADLINE_SECONDS))
+
+
+@contextmanager
+def request_deadline(deadline):
+    """Runs the block under `deadline` (None keeps any deadline already set)."""
+    if deadline is None:
+        yield
+        return
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def time_left():
+    """Seconds until the current deadline, or None without one."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def expired():
+    left = time_left()
+    return left is not None and left <= 0
+
+
+def call_timeout(default):
+    """A provider timeout: `default`, shrunk to the time left. Raises DeadlineExceeded when none is."""
+    left = time_left()
+    if left is None:
+        return default
+    if left <= 0:
+        raise DeadlineExceeded("Tempo limite da requisicao esgotado.")
+    return max(MIN_CALL_TIMEOUT, min(default, left))
@@ -1,14 +1,13 @@
-from datetime import datetime, time, timedelta, timezone
+from datetime import datetime, timedelta, timezone
 import json
 import math
 import os
-import webbrowser
-import polyline
-import folium
+import time
 import requests
 from dotenv import load_dotenv
-from geopy.extra.rate_limiter import RateLimiter
-from geopy.geocoders import Nominatim, Photon
+from cache import cache_get_fresh, cache_get_json, cache_set_json, cache_set_stamped
+from deadline import DeadlineExceeded, call_timeout, expired, request_deadline, time_left
+from rate_budget import acquire, max_cost
 from utils import generate_destination_popup, generate_segment_popup, get_error_html, generate_origin_popup, get_rain_color
 
 load_dotenv()
@@ -18,9 +17,44 @@ VALHALLA_URL = os.getenv("VALHALLA_BASE_URL", "https://valhalla1.openstreetmap.d
 GW_API_KEY = os.getenv("GW_API_KEY")
 OM_ENABLED = os.getenv("OPEN_METEO_ENABLED", "False").lower() in ("true", "1", "yes")
 PHOTON_ENABLED = os.getenv("PHOTON_ENABLED", "False").lower() in ("true", "1", "yes")
+# Weather providers are asked in this order, each one only for the samples
+# the previous ones left undecided (missing data, or dry but with a rain
+# probability of at least WEATHER_DECISIVE_DRY_PROB %)
+WEATHER_PROVIDER_ORDER = [
+    provider.strip()
+    for provider in os.getenv("WEATHER_PROVIDER_ORDER", "google,open_meteo,openweather").split(",")
+    if provider.strip() in ("google", "open_meteo", "openweather")
+]
+WEATHER_DECISIVE_DRY_PROB = float(os.getenv("WEATHER_DECISIVE_DRY_PROB", "30"))
+# Answer samples inside the regional precipitation cube (weather_cube.py) locally
+WEATHER_CUBE_ENABLED = os.getenv("WEATHER_CUBE_ENABLED", "False").lower() in ("true", "1", "yes")
+# Route with the in-process engine over graph_store regions before OSRM
+LOCAL_ROUTING_ENABLED = os.getenv("LOCAL_ROUTING_ENABLED", "False").lower() in ("true", "1", "yes")
 
-# Simple file-based cache for geocoding results
+# Weather responses are reused for WEATHER_CACHE_TTL seconds. Older copies are
+# kept up to WEATHER_STALE_TTL and only served when a provider budget is spent.
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "900"))
+WEATHER_STALE_TTL = int(os.getenv("WEATHER_STALE_TTL", "10800"))
+# Longest a weather call waits for its provider budget to refill (capped by the request deadline)
+WEATHER_BUDGET_WAIT = float(os.getenv("WEATHER_BUDGET_WAIT", "10"))
+
+# Weather samples per route (multiplier of the default count) and the length
+# of the interpolated sub-segments drawn between them (0 colors whole spans
+# between samples). Fewer samples with a finer step keep most of the detail
+# for fewer provider calls.
+WEATHER_SAMPLE_DENSITY = float(os.getenv("WEATHER_SAMPLE_DENSITY", "1.0"))
+INTERPOLATION_STEP_KM = float(os.getenv("INTERPOLATION_STEP_KM", "5"))
+# Alternative routes requested from OSRM/Valhalla, and the grid (degrees)
+# whose samples share one weather lookup across alternatives
+ROUTE_ALTERNATIVES = int(os.getenv("ROUTE_ALTERNATIVES", "2"))
+ALTERNATIVE_CELL_DEG = float(os.getenv("ALTERNATIVE_CELL_DEG", "0.05"))
+# Routes are shared through Redis for ROUTE_CACHE_TTL seconds
+ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", "21600"))
+
+# Simple file-based cache for geocoding results, shared between containers
+# through Redis for GEOCODE_CACHE_TTL seconds
 GEOCODE_CACHE_FILE = ".geocode_cache.json"
+GEOCODE_CACHE_TTL = int(os.getenv("GEOCODE_CACHE_TTL", "2592000"))
 
 
 def _load_geocode_cache():
@@ -49,14 +83,26 @@ def get_coordinates(start_location, end_location):
     if not start_location or not end_location:
         raise ValueError("Os nomes das cidades não podem estar vazios.")
 
+    return (geocode_location(start_location), geocode_location(end_location))
+
+
+def geocode_location(location):
+    """
+    Coordinates of one place name, from the local file cache, the shared
+    Redis cache or the geocoder (with retries). Raises RuntimeError on failure.
+    """
     cache = _load_geocode_cache()
-    cache_key_start = f"geo:{start_location}"
-    cache_key_end = f"geo:{end_location}"
-    
-    if cache_key_start in cache and cache_key_end in cache:
-        start_coords = tuple(cache[cache_key_start])
-        end_coords = tuple(cache[cache_key_end])
-        return (start_coords, end_coords)
+    cache_key = f"geo:{location}"
+
+    if cache_key not in cache:
+        shared = cache_get_json(f"rr:{cache_key}")
+        if shared is not None:
+            cache[cache_key] = shared
+
+    if cache_key in cache:
+        return tuple(cache[cache_key])
+
+    from geopy.geocoders import Nominatim, Photon
 
     timeout = 10
     max_attempts = 3
@@ -65,40 +111,113 @@ def get_coordinates(start_location, end_location):
     else:
         locator = Nominatim(user_agent="rainy-road")
     
-    geocode = RateLimiter(locator.geocode, min_delay_seconds=1, max_retries=0)
-    
-    start = None
-    end = None
-    
+    budget_provider = "photon" if PHOTON_ENABLED else "nominatim"
+
+    def geocode(query, timeout):
+        # Shared across all workers, so the 1 req/s policy holds globally
+        if not acquire(budget_provider, priority="high", max_wait=timeout):
+            raise RuntimeError("Limite de requisicoes do geocodificador atingido")
+        return locator.geocode(query, timeout=timeout)
+
     for attempt in range(1, max_attempts + 1):
         try:
-            start = geocode(start_location, timeout=timeout)
-            end = geocode(end_location, timeout=timeout)
-            if start is None or end is None:
-                raise RuntimeError("Geocoding returned no results for one or both locations")
+            result = geocode(location, timeout=call_timeout(timeout))
+            if result is None:
+                raise RuntimeError(f"Geocoding returned no results for {location}")
             
             # Cache the results
-            start_coords = start.point
-            end_coords = end.point
-            cache[cache_key_start] = list(start_coords)
-            cache[cache_key_end] = list(end_coords)
+            coords = result.point
+            cache[cache_key] = list(coords)
             _save_geocode_cache(cache)
+            cache_set_json(f"rr:{cache_key}", list(coords), GEOCODE_CACHE_TTL)
             
-            return (start_coords, end_coords)
+            return coords
+        except DeadlineExceeded:
+            raise
         except Exception as exc:
-            if attempt < max_attempts:
+            left = time_left()
+            # Only retry when the request has time for the pause and another call
+            if attempt < max_attempts and (left is None or left > attempt * 1.5 + 1):
                 time.sleep(attempt * 1.5)
                 continue
             provider = "Photon" if PHOTON_ENABLED else "Nominatim"
             raise RuntimeError(f"Falha ao geocodificar as cidades ({provider}): {exc}") from exc
 
 
-def weather_at_point(lat, lng, estimated_arrival_minutes):
+def _weather_cache_key(provider, lat, lng, variant=""):
+    return f"weather:{provider}:{float(lat):.2f}:{float(lng):.2f}:{variant}"
+
+
+def _budget_wait():
+    """Seconds a weather call may wait for its budget: WEATHER_BUDGET_WAIT, shrunk to the time left."""
+    left = time_left()
+    return WEATHER_BUDGET_WAIT if left is None else max(0.0, min(WEATHER_BUDGET_WAIT, left))
+
+
+def _budgeted_get_json(provider, cache_key, url, priority="normal", timeout=10):
+    """
+    GET a weather API through the shared cache and request budget.
+    Serves a fresh cached copy when there is one. Otherwise waits for the
+    provider budget (see _budget_wait); when it stays spent, the provider
+    answers 429 or the request deadline has passed, falls back to a stale
+    copy, or returns None so the provider is skipped for this point. The
+    timeout shrinks to the time left before the deadline.
+    """
+    cached, is_fresh = cache_get_fresh(cache_key, WEATHER_CACHE_TTL)
+    if cached is not None and is_fresh:
+        return cached
+
+    if expired():
+        return cached
+
+    if not acquire(provider, priority=priority, max_wait=_budget_wait()):
+        print(f"Warning: orcamento de {provider} esgotado, usando cache")
+        return cached
+
+    try:
+        resp = requests.get(url, timeout=call_timeout(timeout))
+        resp.raise_for_status()
+        data = resp.json()
+    except (requests.RequestException, DeadlineExceeded) as exc:
+        print(f"Warning: {provider} falhou - {exc}")
+        return cached
+
+    cache_set_stamped(cache_key, data, WEATHER_STALE_TTL)
+    return data
+
+
+def _check_weather_providers():
     if not OW_API_KEY and not GW_API_KEY and not OM_ENABLED:
         raise RuntimeError(
             "No weather services configured. Define OW_API_KEY, GW_API_KEY, or set OPEN_METEO_ENABLED=True in .env"
         )
 
+
+def _fetch_google(lat, lng, estimated_arrival_minutes):
+    gw_hours = max(1, estimated_arrival_minutes // 60)
+    GW_API_URL = f"https://weather.googleapis.com/v1/forecast/hours:lookup?key={GW_API_KEY}&location.latitude={lat}&location.longitude={lng}&hours={gw_hours}"
+    cache_key = _weather_cache_key("google_weather", lat, lng, gw_hours)
+    return _budgeted_get_json("google_weather", cache_key, GW_API_URL) or {}
+
+
+def _openweather_type(estimated_arrival_minutes):
+    return "current" if estimated_arrival_minutes <= 60 else "forecast"
+
+
+def _fetch_openweather(lat, lng, estimated_arrival_minutes):
+    ow_endpoint = "weather" if _openweather_type(estimated_arrival_minutes) == "current" else "forecast"
+    OW_API_URL = f"https://api.openweathermap.org/data/2.5/{ow_endpoint}?lat={lat}&lon={lng}&appid={OW_API_KEY}&units=metric"
+    # With Google configured OpenWeather is only a fallback, so it may
+    # not eat into the budget reserved for requests that depend on it.
+    priority = "low" if GW_API_KEY else "normal"
+    cache_key = _weather_cache_key("openweather", lat, lng, ow_endpoint)
+    return _budgeted_get_json("openweather", cache_key, OW_API_URL, priority) or {}
+
+
+def weather_at_point(lat, lng, estimated_arrival_minutes):
+    """Raw answers of every configured per-point provider (Open-Meteo is fetched in batches)."""
+    _check_weather_providers()
+
     weather_results = {
         "google": {},
         "openweather": {},
@@ -107,120 +226,227 @@ def weather_at_point(lat, lng, estimated_arrival_minutes):
     }
 
     if GW_API_KEY:
-        gw_hours = max(1, estimated_arrival_minutes // 60)
-        GW_API_URL = f"https://weather.googleapis.com/v1/forecast/hours:lookup?key={GW_API_KEY}&location.latitude={lat}&location.longitude={lng}&hours={gw_hours}"
-        try:
-            resp = requests.get(GW_API_URL, timeout=10)
-            resp.raise_for_status()
-            weather_results["google"] = resp.json()
-        except requests.RequestException as exc:
-            print(f"Warning: Google Weather falhou - {exc}")
+        weather_results["google"] = _fetch_google(lat, lng, estimated_arrival_minutes)
 
     if OW_API_KEY:
-        ow_endpoint = None
-        if estimated_arrival_minutes <= 60:
-            ow_endpoint = "weather"
-            weather_results["ow_type"] = "current"
-        elif estimated_arrival_minutes > 60:
-            ow_endpoint = "forecast"
-            weather_results["ow_type"] = "forecast"
-
-        if ow_endpoint:
-            OW_API_URL = f"https://api.openweathermap.org/data/2.5/{ow_endpoint}?lat={lat}&lon={lng}&appid={OW_API_KEY}&units=metric"
-            try:
-                resp = requests.get(OW_API_URL, timeout=10)
-                resp.raise_for_status()
-                weather_results["openweather"] = resp.json()
-            except requests.RequestException as exc:
-                print(f"Warning: OpenWeather falhou - {exc}")
+        weather_results["ow_type"] = _openweather_type(estimated_arrival_minutes)
+        weather_results["openweather"] = _fetch_openweather(lat, lng, estimated_arrival_minutes)
 
     return weather_results
 
 
+def _display_time(estimated_arrival_minutes):
+    exact_arrival_utc = datetime.now(timezone.utc) + timedelta(minutes=estimated_arrival_minutes)
+    return (exact_arrival_utc - timedelta(hours=3)).strftime("%H:%M")
+
+
+def _status(is_rainy, volume, prob, estimated_arrival_minutes, provider):
+    return {"is_rainy": is_rainy, "volume": volume, "prob": prob, "time": _display_time(estimated_arrival_minutes), "provider": provider}
+
+
+def _google_status(google_data, estimated_arrival_minutes):
+    """Status from a Google hourly forecast, or None without usable data."""
+    forecasts = (google_data or {}).get("forecastHours", [])
+    if not forecasts:
+        return None
+    target_index = max(0, min(int(estimated_arrival_minutes // 60 - 1), len(forecasts) - 1)) if estimated_arrival_minutes > 0 else 0
+    target_forecast = forecasts[target_index]
+
+    precip_prob = target_forecast.get("precipitation", {}).get("probability", {}).get("percent", 0)
+    rain_mm = target_forecast.get("precipitation", {}).get("qpf", {}).get("quantity", 0)
+    return _status(precip_prob >= 50 and rain_mm > 0.2, rain_mm, precip_prob, estimated_arrival_minutes, "Google")
+
+
+def _open_meteo_status(om_data, estimated_arrival_minutes):
+    """Status from Open-Meteo hourly arrays, or None when the hour isn't covered."""
+    if not om_data or "hourly" not in om_data:
+        return None
+    hourly = om_data["hourly"]
+    times = hourly.get("time", [])
+    probs = hourly.get("precipitation_probability", [])
+    precips = hourly.get("precipitation", [])
+
+    # Rounding for API lookup (Strictly UTC)
+    lookup_time = datetime.now(timezone.utc) + timedelta(minutes=estimated_arrival_minutes)
+    if lookup_time.minute >= 30:
+        lookup_time += timedelta(hours=1)
+    arrival_time_str = lookup_time.strftime("%Y-%m-%dT%H:00")
+
+    try:
+        target_index = times.index(arrival_time_str)
+    except ValueError:
+        return None
+    precip_prob = probs[target_index]
+    rain_mm = precips[target_index]
+    if precip_prob is None or rain_mm is None:
+        return None
+    return _status(precip_prob >= 50 and rain_mm > 0.2, rain_mm, precip_prob, estimated_arrival_minutes, "Open Meteo")
+
+
+def _openweather_status(ow_data, ow_type, estimated_arrival_minutes):
+    """Status from OpenWeather current weather or 3 h forecast, or None without data."""
+    if not ow_data:
+        return None
+    rainy_ow_conditions = {"Rain", "Snow", "Thunderstorm"}
+
+    if ow_type == "current":
+        weather_array = ow_data.get("weather", [])
+        if not weather_array:
+            return None
+        if weather_array[0].get("main") in rainy_ow_conditions:
+            # Dummy high values since OW doesn't give us exact prob/vol here
+            return _status(True, 2.5, 90, estimated_arrival_minutes, "OpenWeather")
+        return _status(False, 0.0, 0, estimated_arrival_minutes, "OpenWeather")
+
+    forecast_list = ow_data.get("list", [])
+    if not forecast_list:
+        return None
+    target_index = int(min(estimated_arrival_minutes // 180, len(forecast_list) - 1))
+    weather_array = forecast_list[target_index].get("weather", [])
+    pop = forecast_list[target_index].get("pop", 0.9) * 100
+    rain_mm = forecast_list[target_index].get("rain", {}).get("3h", 0)
+    is_rainy = bool(weather_array) and weather_array[0].get("main") in rainy_ow_conditions
+    return _status(is_rainy, rain_mm if is_rainy else 0.0, pop if is_rainy else 0, estimated_arrival_minutes, "OpenWeather")
+
+
 def _get_weather_status(weather_data, estimated_arrival_minutes):
     """
     Returns a dict: {"is_rainy": bool, "volume": float, "prob": int, "time": str}
+    from the raw answers of every provider. The first rainy answer in
+    WEATHER_PROVIDER_ORDER wins, otherwise the first dry one.
     """
-    google_data = weather_data.get("google", {})
-    ow_data = weather_data.get("openweather", {})
-    om_data = weather_data.get("open_meteo", {})
-    ow_type = weather_data.get("ow_type")
+    answers = {
+        "google": lambda: _google_status(weather_data.get("google"), estimated_arrival_minutes),
+        "open_meteo": lambda: _open_meteo_status(weather_data.get("open_meteo"), estimated_arrival_minutes),
+        "openweather": lambda: _openweather_status(
+            weather_data.get("openweather"), weather_data.get("ow_type"), estimated_arrival_minutes
+        ),
+    }
+    statuses = [status for status in (answers[provider]() for provider in WEATHER_PROVIDER_ORDER) if status]
+    return _pick_status(statuses, estimated_arrival_minutes)
 
-    exact_arrival_utc = datetime.now(timezone.utc) + timedelta(minutes=estimated_arrival_minutes)
-    local_display_time = (exact_arrival_utc - timedelta(hours=3)).strftime("%H:%M")
 
+def _pick_status(statuses, estimated_arrival_minutes):
+    for status in statuses:
+        if status["is_rainy"]:
+            return status
+    if statuses:
+        return statuses[0]
     # Default safe return
-    no_rain = {"is_rainy": False, "volume": 0.0, "prob": 0, "time": local_display_time, "provider": "N/A"}
-
-    # 1. Google check
-    if google_data and "forecastHours" in google_data:
-        forecasts = google_data.get("forecastHours", [])
-        if forecasts:
-            target_index = max(0, min(int(estimated_arrival_minutes // 60 - 1), len(forecasts) - 1)) if estimated_arrival_minutes > 0 else 0
-            target_forecast = forecasts[target_index]
-
-            precip_prob = target_forecast.get("precipitation", {}).get("probability", {}).get("percent", 0)
-            rain_mm = target_forecast.get("precipitation", {}).get("qpf", {}).get("quantity", 0)
-
-            if precip_prob >= 50 and rain_mm > 0.2:
-                return {"is_rainy": True, "volume": rain_mm, "prob": precip_prob, "time": local_display_time, "provider": "Google"}
-            else:
-                no_rain = {"is_rainy": False, "volume": rain_mm, "prob": precip_prob, "time": local_display_time, "provider": "Google"}
-            if not ow_data and not om_data:
-                return no_rain
-
-    # 2. Open-Meteo check
-    if om_data and "hourly" in om_data:
-        hourly = om_data["hourly"]
-        times = hourly.get("time", [])
-        probs = hourly.get("precipitation_probability", [])
-        precips = hourly.get("precipitation", [])
-
-        # Rounding for API lookup (Strictly UTC)
-        lookup_time = exact_arrival_utc
-        if lookup_time.minute >= 30:
-            lookup_time += timedelta(hours=1)
-        arrival_time_str = lookup_time.strftime("%Y-%m-%dT%H:00")
+    return _status(False, 0.0, 0, estimated_arrival_minutes, "N/A")
+
+
+def _unresolved_status(estimated_arrival_minutes):
+    """Placeholder for a sample no provider answered (deadline, budget or failures)."""
+    return {**_status(False, 0.0, 0, estimated_arrival_minutes, "N/A"), "unresolved": True}
+
+
+def _is_decisive(status):
+    """Rain, or a dry forecast confident enough that no other provider is asked."""
+    return status["is_rainy"] or status["prob"] < WEATHER_DECISIVE_DRY_PROB
+
+
+def _cascade_google(points, arrivals):
+    statuses = []
+    for point, point_arrivals in zip(points, arrivals):
+        # One forecast long enough for the point's latest arrival
+        google_data = _fetch_google(point["lat"], point["lon"], max(point_arrivals))
+        statuses.append([_google_status(google_data, minutes) for minutes in point_arrivals])
+    return statuses
+
+
+def _cascade_open_meteo(points, arrivals):
+    lats = ",".join(str(point["lat"]) for point in points)
+    longs = ",".join(str(point["lon"]) for point in points)
+    om_data = get_open_meteo_batch_weather(lats, longs)
+    return [
+        [_open_meteo_status(data, minutes) for minutes in point_arrivals]
+        for data, point_arrivals in zip(om_data, arrivals)
+    ]
 
-        try:
-            target_index = times.index(arrival_time_str)
-            precip_prob = probs[target_index]
-            rain_mm = precips[target_index]
-            #print(f"Debug: Open-Meteo lookup - Time: {arrival_time_str}, Prob: {precip_prob}%, Precip: {rain_mm}mm")
-            if precip_prob >= 50 and rain_mm > 0.2:
-                return {"is_rainy": True, "volume": rain_mm, "prob": precip_prob, "time": local_display_time, "provider": "Open Meteo"}
-            else:
-                no_rain =  {"is_rainy": False, "volume": rain_mm, "prob": precip_prob, "time": local_display_time, "provider": "Open Meteo"}
-        except ValueError:
-            pass
-
-    # 3. OpenWeather Check (Fallback)
-    if ow_data:
-        rainy_ow_conditions = {"Rain", "Snow", "Thunderstorm"}
-        
-        if ow_type == "current":
-            weather_array = ow_data.get("weather", [])
-            for item in weather_array:
-                if item.get("main") in rainy_ow_conditions:
-                    # Dummy high values since OW doesn't give us exact prob/vol here
-                    return {"is_rainy": True, "volume": 2.5, "prob": 90, "time": local_display_time, "provider": "OpenWeather"}
-                else:
-                    return no_rain
-
-        elif ow_type == "forecast":
-            forecast_list = ow_data.get("list", [])
-            if forecast_list:
-                target_index = int(min(estimated_arrival_minutes // 180, len(forecast_list) - 1))
-                weather_array = forecast_list[target_index].get("weather", [])
-                pop = forecast_list[target_index].get("pop", 0.9) * 100 
-                rain_mm = forecast_list[target_index].get("rain", {}).get("3h", 0) 
-                for item in weather_array:
-                    if item.get("main") in rainy_ow_conditions: 
-                        return {"is_rainy": True, "volume": rain_mm, "prob": pop, "time": local_display_time, "provider": "OpenWeather"}
-                    else:
-                        return no_rain
-
-    return no_rain
+
+def _cascade_openweather(points, arrivals):
+    statuses = []
+    for point, point_arrivals in zip(points, arrivals):
+        # Current weather and the 3 h forecast are separate endpoints, each fetched once
+        ow_data = {}
+        for minutes in point_arrivals:
+            ow_type = _openweather_type(minutes)
+            if ow_type not in ow_data:
+                ow_data[ow_type] = _fetch_openweather(point["lat"], point["lon"], minutes)
+        statuses.append([
+            _openweather_status(ow_data[_openweather_type(minutes)], _openweather_type(minutes), minutes)
+            for minutes in point_arrivals
+        ])
+    return statuses
+
+
+# Provider name -> (is configured, fetch statuses for points and their arrival times)
+WEATHER_PROVIDERS = {
+    "google": (lambda: bool(GW_API_KEY), _cascade_google),
+    "open_meteo": (lambda: OM_ENABLED, _cascade_open_meteo),
+    "openweather": (lambda: bool(OW_API_KEY), _cascade_openweather),
+}
+
+
+def get_cascade_statuses(samples):
+    """
+    Queries providers in WEATHER_PROVIDER_ORDER, each one only for the
+    samples still without a decisive answer. Undecided samples take the first
+    rainy answer they got, otherwise the first dry one. When the request
+    deadline passes the cascade stops. Samples without any answer (deadline,
+    spent budget or failed calls) are marked unresolved rather than dry.
+    """
+    series = get_cascade_series(samples, [[sample["arrival_minutes"]] for sample in samples])
+    return [point_statuses[0] for point_statuses in series]
+
+
+def get_cascade_series(points, arrivals):
+    """
+    get_cascade_statuses for several arrival times (minutes from now) per
+    point. Each provider is fetched at most once per point, covering its
+    latest arrival still undecided, and every arrival is read from that same
+    forecast. Returns, per point, one status per arrival in the same order.
+    """
+    _check_weather_providers()
+    statuses = [[None] * len(point_arrivals) for point_arrivals in arrivals]
+    answers = [[[] for _ in point_arrivals] for point_arrivals in arrivals]
+    # point -> positions of its arrivals still without a decisive answer
+    pending = {i: list(range(len(point_arrivals))) for i, point_arrivals in enumerate(arrivals) if point_arrivals}
+    cut_short = False
+    for provider in WEATHER_PROVIDER_ORDER:
+        is_configured, fetch_statuses = WEATHER_PROVIDERS[provider]
+        if not pending or not is_configured():
+            continue
+        if expired():
+            cut_short = True
+            break
+        asked = list(pending)
+        fetched = fetch_statuses([points[i] for i in asked], [[arrivals[i][j] for j in pending[i]] for i in asked])
+        still_pending = {}
+        for i, point_statuses in zip(asked, fetched):
+            for j, status in zip(pending[i], point_statuses):
+                if status is not None and _is_decisive(status):
+                    statuses[i][j] = status
+                    continue
+                if status is not None:
+                    answers[i][j].append(status)
+                still_pending.setdefault(i, []).append(j)
+        pending = still_pending
+
+    # An arrival without answers was never really asked (deadline, budget) or
+    # every call failed, so it has no weather rather than a dry one
+    cut_short = cut_short or expired()
+    for i, positions in pending.items():
+        for j in positions:
+            minutes = arrivals[i][j]
+            statuses[i][j] = _pick_status(answers[i][j], minutes) if answers[i][j] else _unresolved_status(minutes)
+    total = sum(len(point_arrivals) for point_arrivals in arrivals)
+    unresolved = sum(1 for point_statuses in statuses for status in point_statuses if status.get("unresolved"))
+    if unresolved:
+        reason = "prazo da requisicao esgotado" if cut_short else "sem resposta dos provedores"
+        print(f"Warning: {unresolved} de {total} pontos sem clima ({reason})")
+    return statuses
 
 
 def get_lats_longs_from_route(sample_indexes, route_points):
@@ -230,88 +456,309 @@ def get_lats_longs_from_route(sample_indexes, route_points):
 
 
 def get_open_meteo_batch_weather(lats, lons):
-    om_url = f"https://api.open-meteo.com/v1/forecast?latitude={lats}&longitude={lons}&hourly=precipitation_probability,precipitation,rain&forecast_days=2"
-    try:
-        om_resp = requests.get(om_url, timeout=10)
-        om_resp.raise_for_status()
-        data = om_resp.json()
-        return [data] if isinstance(data, dict) else data
-    except requests.RequestException as exc:
-        print(f"Warning: Bulk Open-Meteo request failed - {exc}")
+    """
+    Fetches Open-Meteo hourly data for comma separated lats/lons, one entry per
+    point. Points with a fresh cached forecast are left out of the request.
+    """
+    points = list(zip(lats.split(","), lons.split(",")))
+    results = [None] * len(points)
+    stale = {}
+    missing = []
+    for i, (lat, lon) in enumerate(points):
+        cached, is_fresh = cache_get_fresh(_weather_cache_key("open_meteo", lat, lon), WEATHER_CACHE_TTL)
+        if cached is not None and is_fresh:
+            results[i] = cached
+            continue
+        missing.append(i)
+        if cached is not None:
+            stale[i] = cached
+
+    # Each request is charged one token per point, so batches larger than
+    # the usable bucket are split
+    batch_size = max_cost("open_meteo") or len(missing) or 1
+    for offset in range(0, len(missing), batch_size):
+        batch = missing[offset : offset + batch_size]
+        if expired():
+            print("Warning: prazo da requisicao esgotado, Open-Meteo usando cache")
+            break
+        if not acquire("open_meteo", cost=len(batch), max_wait=_budget_wait()):
+            print("Warning: orcamento de open_meteo esgotado, usando cache")
+            break
+        batch_lats = ",".join(points[i][0] for i in batch)
+        batch_lons = ",".join(points[i][1] for i in batch)
+        om_url = f"https://api.open-meteo.com/v1/forecast?latitude={batch_lats}&longitude={batch_lons}&hourly=precipitation_probability,precipitation,rain&forecast_days=2"
+        try:
+            om_resp = requests.get(om_url, timeout=call_timeout(10))
+            om_resp.raise_for_status()
+            data = om_resp.json()
+            data = [data] if isinstance(data, dict) else data
+            for i, point_data in zip(batch, data):
+                results[i] = point_data
+                cache_set_stamped(_weather_cache_key("open_meteo", *points[i]), point_data, WEATHER_STALE_TTL)
+        except (requests.RequestException, DeadlineExceeded) as exc:
+            print(f"Warning: Bulk Open-Meteo request failed - {exc}")
+
+    return [results[i] or stale.get(i) or {} for i in range(len(points))]
+
+
+
+
+def get_sample_count(route_len):
+    """Number of weather samples for a route with route_len points."""
+    sample_count = int((math.sqrt(route_len) / max(math.log10(route_len), 1)) * WEATHER_SAMPLE_DENSITY + 2)
+    return max(2, min(sample_count, route_len))
+
+
+def get_sample_plan(route_points, duration):
+    """
+    Picks the route points to fetch weather for.
+    Returns a list of {"index", "lat", "lon", "arrival_minutes"} dicts.
+    """
+    route_len = len(route_points)
+    if route_len < 2:
         return []
 
+    sample_count = get_sample_count(route_len)
+    leap = max(1, route_len // sample_count)
+    sample_indexes = list(range(leap, route_len, leap))
+
+    if sample_indexes[-1] != route_len - 1:
+        sample_indexes.append(route_len - 1)
 
+    samples = []
+    for index in sample_indexes:
+        lat, lon = route_points[index]
+        route_fraction = index / route_len
+        samples.append({
+            "index": index,
+            "lat": lat,
+            "lon": lon,
+            "arrival_minutes": route_fraction * duration,
+        })
+    return samples
 
 
-def get_map(route_data, start_latlng, end_latlng, trip_info=None):
+def get_cube_statuses(samples):
     """
-    Generates a Folium map with weather data along the route.
-    Expects route_data dictionary with 'route_points' and 'duration'.
-    trip_info is an optional dict with route metadata.
+    Weather statuses interpolated from the regional precipitation cube, with
+    no outbound call. Samples outside the cube's area or hours get None.
+    """
+    from weather_cube import sample_cube
+
+    now = datetime.now(timezone.utc)
+    arrivals = [now + timedelta(minutes=sample["arrival_minutes"]) for sample in samples]
+    precips, probs = sample_cube(
+        [sample["lat"] for sample in samples],
+        [sample["lon"] for sample in samples],
+        [arrival.timestamp() for arrival in arrivals],
+    )
+
+    statuses = []
+    for arrival, rain_mm, precip_prob in zip(arrivals, precips, probs):
+        if math.isnan(rain_mm) or math.isnan(precip_prob):
+            statuses.append(None)
+            continue
+        rain_mm = round(float(rain_mm), 2)
+        precip_prob = int(round(float(precip_prob)))
+        statuses.append({
+            "is_rainy": precip_prob >= 50 and rain_mm > 0.2,
+            "volume": rain_mm,
+            "prob": precip_prob,
+            "time": (arrival - timedelta(hours=3)).strftime("%H:%M"),
+            "provider": "Open Meteo (regional)",
+        })
+    return statuses
+
+
+def get_samples_weather(samples):
+    """Fetches weather for each sample and returns one status dict per sample."""
+    if not samples:
+        return []
+
+    statuses = [None] * len(samples)
+    if WEATHER_CUBE_ENABLED:
+        statuses = get_cube_statuses(samples)
+    # Only samples outside the regional cube go to the live providers
+    live_indexes = [i for i, status in enumerate(statuses) if status is None]
+    live_samples = [samples[i] for i in live_indexes]
+    if not live_samples:
+        return statuses
+
+    for index, status in zip(live_indexes, get_cascade_statuses(live_samples)):
+        statuses[index] = status
+    return statuses
+
+
+def get_unresolved_statuses(samples):
+    """Statuses of samples given up on without asking any provider."""
+    return [_unresolved_status(sample["arrival_minutes"]) for sample in samples]
+
+
+def get_samples_series(points, arrivals):
+    """
+    get_samples_weather for several arrival times (minutes from now) per
+    point: the regional cube answers what it covers and the rest goes through
+    get_cascade_series, so each provider is fetched at most once per point.
+    Returns, per point, one status per arrival in the same order.
+    """
+    statuses = [[None] * len(point_arrivals) for point_arrivals in arrivals]
+    if WEATHER_CUBE_ENABLED:
+        pairs = [(i, j) for i, point_arrivals in enumerate(arrivals) for j in range(len(point_arrivals))]
+        cube_statuses = get_cube_statuses([{**points[i], "arrival_minutes": arrivals[i][j]} for i, j in pairs])
+        for (i, j), status in zip(pairs, cube_statuses):
+            statuses[i][j] = status
+    # point -> positions of its arrivals outside the cube
+    live = {i: [j for j, status in enumerate(point_statuses) if status is None] for i, point_statuses in enumerate(statuses)}
+    live = {i: positions for i, positions in live.items() if positions}
+    if not live:
+        return statuses
+
+    series = get_cascade_series([points[i] for i in live], [[arrivals[i][j] for j in positions] for i, positions in live.items()])
+    for (i, positions), point_statuses in zip(live.items(), series):
+        for j, status in zip(positions, point_statuses):
+            statuses[i][j] = status
+    return statuses
+
+
+def rain_exposure(samples, statuses, route_len, duration):
+    """
+    Scores a trip's rain exposure. Each sample stands for the stretch of
+    route since the previous sample; exposure adds up minutes in that stretch
+    x forecast mm x probability. Returns a summary dict.
+    """
+    exposure = 0.0
+    rainy_minutes = 0.0
+    max_volume = 0.0
+    covered = 0
+    previous_index = 0
+    for sample, status in zip(samples, statuses):
+        minutes = (sample["index"] - previous_index) / max(route_len, 1) * duration
+        previous_index = sample["index"]
+        if not status or status["provider"] == "N/A":
+            continue
+        covered += 1
+        volume = float(status["volume"] or 0)
+        exposure += minutes * volume * float(status["prob"] or 0) / 100
+        max_volume = max(max_volume, volume)
+        if status["is_rainy"]:
+            rainy_minutes += minutes
+    return {
+        "exposure": round(exposure, 2),
+        "rainy_minutes": round(rainy_minutes),
+        "max_volume": round(max_volume, 2),
+        "coverage": round(covered / len(samples), 2) if samples else 0.0,
+    }
+
+
+def get_departure_windows(route_data, offsets_minutes):
+    """
+    Evaluates leaving now + each offset (minutes) with a single weather fetch
+    (get_samples_series): each provider is asked once per sample, covering the
+    latest departure it still needs, and every offset only shifts the
+    arrival-time lookups. Returns the windows ranked from the driest; windows
+    the forecasts don't fully cover rank last.
     """
-    # Extract standardized data
     route_points = route_data["route_points"]
     duration = route_data["duration"]
-    
-    route_len = len(route_points)
-    
-    rainy_segments = []
+    samples = get_sample_plan(route_points, duration)
+    if not samples:
+        return []
+
+    # One status per sample and departure
+    series = get_samples_series(
+        samples, [[sample["arrival_minutes"] + offset for offset in offsets_minutes] for sample in samples]
+    )
+
+    now = datetime.now(timezone.utc)
+    windows = []
+    for position, offset in enumerate(offsets_minutes):
+        statuses = [point_statuses[position] for point_statuses in series]
+        departure = now + timedelta(minutes=offset)
+        windows.append({
+            "offset_minutes": offset,
+            "departure": (departure - timedelta(hours=3)).strftime("%H:%M"),
+            "arrival": (departure + timedelta(minutes=duration) - timedelta(hours=3)).strftime("%H:%M"),
+            **rain_exposure(samples, statuses, len(route_points), duration),
+        })
+
+    windows.sort(key=lambda window: (window["coverage"] < 1, window["exposure"], window["rainy_minutes"], window["offset_minutes"]))
+    for rank, window in enumerate(windows, start=1):
+        window["rank"] = rank
+    return windows
+
+
+def build_segments(route_points, samples, statuses):
+    """
+    Splits the route into colored segments, each covering route_points
+    start_index..end_index. With INTERPOLATION_STEP_KM set, weather is
+    interpolated between samples into sub-segments of about that length;
+    otherwise each segment ends at a sample and carries its status.
+    Spans of samples left unresolved (no provider answer) are marked with
+    "unresolved" and drawn apart by render_map.
+    """
+    if INTERPOLATION_STEP_KM > 0:
+        from weather_interpolation import interpolate_segments
+
+        return interpolate_segments(route_points, samples, statuses, INTERPOLATION_STEP_KM)
+
     segment_data = []
-    
-    if route_len >= 2:
-        sample_count = int((math.sqrt(route_len) / max(math.log10(route_len), 1)) + 2)
-        sample_count = max(2, min(sample_count, route_len))
-        leap = max(1, route_len // sample_count)
-        sample_indexes = list(range(leap, route_len, leap))
-        
-        if sample_indexes[-1] != route_len - 1:
-            sample_indexes.append(route_len - 1)
-            
-        open_meteo_weather_data = []
-        lats, longs = get_lats_longs_from_route(sample_indexes, route_points)
-        
-        mid_lat, mid_lon = (route_points[0][0] + route_points[-1][0]) / 2, (route_points[0][1] + route_points[-1][1]) / 2
-        
-        if OM_ENABLED:
-            open_meteo_weather_data = get_open_meteo_batch_weather(lats, longs)
+    previous_index = 0
+    for sample, status in zip(samples, statuses):
+        index = sample["index"]
+        if status:
+            segment_data.append({
+                "coords": route_points[previous_index : index + 1],
+                "start_index": previous_index,
+                "end_index": index,
+                "volume": status["volume"],
+                "prob": status["prob"],
+                "time": status["time"],
+                "provider": status["provider"],
+                "is_rainy": status["is_rainy"],
+                "unresolved": status.get("unresolved", False),
+            })
+        previous_index = index
+    return segment_data
 
-        previous_index = 0
-        for i, index in enumerate(sample_indexes):
-            lat, lon = route_points[index]
-            
-            route_fraction = index / route_len
-            estimated_arrival_minutes = route_fraction * duration
-            
-            node_weather = weather_at_point(lat, lon, estimated_arrival_minutes)
-            
-            if open_meteo_weather_data and i < len(open_meteo_weather_data):
-                node_weather["open_meteo"] = open_meteo_weather_data[i]
-                
-            # Get the detailed storm status
-            status = _get_weather_status(node_weather, estimated_arrival_minutes)
-            
-            if status:
-                if status["is_rainy"] == True:
-                    rainy_segments.append({
-                        "coords": route_points[previous_index : index + 1],
-                        "volume": status["volume"],
-                        "prob": status["prob"],
-                        "time": status["time"],
-                        "provider": status["provider"]
-                    })
-                segment_data.append({ 
-                        "coords": route_points[previous_index : index + 1],
-                        "volume": status["volume"],
-                        "prob": status["prob"],
-                        "time": status["time"],
-                        "provider": status["provider"]
-                    })
-                
-            previous_index = index
 
+UNRESOLVED_COLOR = "#9e9e9e"
+UNRESOLVED_TOOLTIP = "Clima nao consultado: prazo da requisicao ou limite dos provedores esgotado neste trecho"
+
+
+def render_map(route_points, segment_data, start_latlng, end_latlng, trip_info=None, alternative_routes=None):
+    """
+    Draws the weather colored segments and the endpoint markers with Folium.
+    alternative_routes is an optional list of {"route_points", "label"} drawn
+    in gray underneath the main route.
+    """
+    import folium
+
+    first, last = (route_points[0], route_points[-1]) if len(route_points) else (start_latlng, end_latlng)
+    mid_lat, mid_lon = (first[0] + last[0]) / 2, (first[1] + last[1]) / 2
     route_map = folium.Map(location=[mid_lat, mid_lon], zoom_start=9, tiles="CartoDB positron")
+
+    for alternative in alternative_routes or []:
+        folium.PolyLine(
+            alternative["route_points"],
+            color="#7f8c8d",
+            weight=6,
+            opacity=0.6,
+            dash_array="8 8",
+            tooltip=folium.Tooltip(alternative["label"])
+        ).add_to(route_map)
     
     for segment in segment_data:
+        if segment.get("unresolved"):
+            # No weather in time for this stretch: dashed gray, not a false "dry"
+            folium.PolyLine(
+                segment["coords"],
+                color=UNRESOLVED_COLOR,
+                weight=7,
+                opacity=0.8,
+                dash_array="4 10",
+                tooltip=folium.Tooltip(UNRESOLVED_TOOLTIP)
+            ).add_to(route_map)
+            continue
         volume_mm = segment["volume"]
         segment_color = get_rain_color(volume_mm)
         segment_popup = generate_segment_popup(segment)
@@ -348,23 +795,44 @@ def get_map(route_data, start_latlng, end_latlng, trip_info=None):
     folium.Marker([end_latlng[0], end_latlng[1]], popup=dest_popup_html).add_to(route_map)
     
     # Auto-zoom to fit all route points
-    if route_points:
-        min_lat = min(p[0] for p in route_points)
-        max_lat = max(p[0] for p in route_points)
-        min_lon = min(p[1] for p in route_points)
-        max_lon = max(p[1] for p in route_points)
+    all_points = list(route_points)
+    for alternative in alternative_routes or []:
+        all_points.extend(alternative["route_points"])
+    if all_points:
+        min_lat = min(p[0] for p in all_points)
+        max_lat = max(p[0] for p in all_points)
+        min_lon = min(p[1] for p in all_points)
+        max_lon = max(p[1] for p in all_points)
         route_map.fit_bounds([(min_lat, min_lon), (max_lat, max_lon)])
     
     return route_map
 
-def get_osrm_route_json(start_latlng, end_latlng):
+
+def get_map(route_data, start_latlng, end_latlng, trip_info=None, deadline=None):
+    """
+    Generates a Folium map with weather data along the route.
+    Expects route_data dictionary with 'route_points' and 'duration'.
+    trip_info is an optional dict with route metadata. With a deadline
+    (epoch seconds) weather lookups stop when it passes and the map is
+    drawn with the remaining segments marked unresolved.
+    """
+    route_points = route_data["route_points"]
+    samples = get_sample_plan(route_points, route_data["duration"])
+    with request_deadline(deadline):
+        statuses = get_samples_weather(samples)
+    segment_data = build_segments(route_points, samples, statuses)
+    return render_map(route_points, segment_data, start_latlng, end_latlng, trip_info)
+
+def get_osrm_route_json(start_latlng, end_latlng, alternatives=0):
     start_lon, start_lat = start_latlng[1], start_latlng[0]
     end_lon, end_lat = end_latlng[1], end_latlng[0]
 
-    url = f"{OSRM_URL}/route/v1/driving/{start_lon},{start_lat};{end_lon},{end_lat}?overview=full&geometries=geojson"
+    url = f"{OSRM_URL}/route/v1/driving/{start_lon},{start_lat};{end_lon},{end_lat}?overview=full&geometries=polyline6"
+    if alternatives:
+        url += f"&alternatives={alternatives}"
 
     try:
-        response = requests.get(url, timeout=10)
+        response = requests.get(url, timeout=call_timeout(10))
         response.raise_for_status()
         data = response.json()
     except requests.RequestException as exc:
@@ -375,7 +843,7 @@ def get_osrm_route_json(start_latlng, end_latlng):
     
     return data
 
-def get_valhalla_route_json(start_latlng, end_latlng, mode="auto"):
+def get_valhalla_route_json(start_latlng, end_latlng, mode="auto", alternates=0):
     start_lon, start_lat = start_latlng[1], start_latlng[0]
     end_lon, end_lat = end_latlng[1], end_latlng[0]
 
@@ -391,8 +859,10 @@ def get_valhalla_route_json(start_latlng, end_latlng, mode="auto"):
             "units": "kilometers"        
             }
         }
+    if alternates:
+        payload["alternates"] = alternates
     try:
-        response = requests.post(url, json=payload, timeout=12)
+        response = requests.post(url, json=payload, timeout=call_timeout(12))
         response.raise_for_status()
         data = response.json()
     except requests.RequestException as exc:
@@ -403,23 +873,25 @@ def get_valhalla_route_json(start_latlng, end_latlng, mode="auto"):
     
     return data
 
-def get_osrm_route_data(data):
+def get_osrm_route_data(data, route_index=0):
     """
     Extracts route points and duration from an OSRM response.
-    Expects OSRM to be called with geometries=geojson.
+    Expects OSRM to be called with geometries=polyline6.
     """
-    route_geometry = data["routes"][0]["geometry"]
-    coordinates = route_geometry.get("coordinates", [])
+    from polyline_codec import decode_polyline
+
+    route = data["routes"][route_index]
+    coordinates = decode_polyline(route["geometry"], 6)
     
     if len(coordinates) < 2:
         raise RuntimeError("OSRM retornou rota invalida.")
 
-    # OSRM GeoJSON returns [lon, lat], we flip it to (lat, lon)
-    route_points = [(lat, lon) for lon, lat in coordinates]
+    # Polylines are already (lat, lon)
+    route_points = list(map(tuple, coordinates.tolist()))
     
     # OSRM duration is in seconds, convert to minutes
-    duration = data["routes"][0]["legs"][0]["duration"] / 60 
-    distance = data["routes"][0]["legs"][0]["distance"] / 1000 
+    duration = route["legs"][0]["duration"] / 60 
+    distance = route["legs"][0]["distance"] / 1000 
     
     return {
         "route_points": route_points,
@@ -435,8 +907,10 @@ def get_valhalla_route_data(data):
         # Valhalla returns an encoded polyline string in the shape parameter
         shape = data["trip"]["legs"][0]["shape"]
         
+        from polyline_codec import decode_polyline
+
         # Valhalla uses a polyline precision of 6
-        route_points = polyline.decode(shape, 6) 
+        route_points = list(map(tuple, decode_polyline(shape, 6).tolist()))
         
         if len(route_points) < 2:
             raise RuntimeError("Valhalla retornou rota invalida.")
@@ -452,38 +926,220 @@ def get_valhalla_route_data(data):
     except KeyError:
         raise RuntimeError("Falha ao analisar os dados do Valhalla.")
    
-def get_route_map(start_latlng, end_latlng, mode="auto"):
+def get_route_alternatives(start_latlng, end_latlng, mode="auto", count=None):
+    """
+    The main route plus up to `count` alternatives (OSRM `alternatives`,
+    Valhalla `alternates`). Returns (list of route_data, trip_info).
+    """
+    if mode not in ["auto", "bicycle", "pedestrian"]:
+        raise ValueError("Modo de transporte inválido. Use 'auto', 'bicycle' ou 'pedestrian'.")
+    count = ROUTE_ALTERNATIVES if count is None else count
+    trip_info = {
+        "start": start_latlng,
+        "end": end_latlng,
+        "geolocation": "Photon" if PHOTON_ENABLED else "Nominatim",
+    }
     try:
-        trip_info = {}
+        if mode != "auto":
+            raise ValueError("Mode only available in valhalla, using the fallback provider")
+        osrm_json = get_osrm_route_json(start_latlng, end_latlng, alternatives=count)
+        routes = [get_osrm_route_data(osrm_json, i) for i in range(len(osrm_json["routes"]))]
+        trip_info["route_provider"] = "OSRM"
+    except Exception as exc:
+        print(f" OSRM falhou: {exc}. Tentando Valhalla como fallback.")
+        try:
+            valhalla_json = get_valhalla_route_json(start_latlng, end_latlng, mode, alternates=count)
+            trips = [valhalla_json] + valhalla_json.get("alternates", [])
+            routes = [get_valhalla_route_data(trip) for trip in trips]
+            trip_info["route_provider"] = "Valhalla"
+        except Exception as fallback_exc:
+            raise RuntimeError(f"Valhalla: {fallback_exc} \n\nOSRM: {exc}") from fallback_exc
+    routes = routes[: count + 1]
+    trip_info["trip_time"] = routes[0]["duration"]
+    trip_info["distance"] = routes[0]["distance"]
+    return routes, trip_info
+
+
+def _weather_cell(sample):
+    """Grid cell a sample's forecast is shared in."""
+    return (round(sample["lat"] / ALTERNATIVE_CELL_DEG), round(sample["lon"] / ALTERNATIVE_CELL_DEG))
+
+
+def _cell_center(cell):
+    """The point a cell's forecast is fetched at, so every sample in it hits the same cache entries."""
+    return {"lat": round(cell[0] * ALTERNATIVE_CELL_DEG, 6), "lon": round(cell[1] * ALTERNATIVE_CELL_DEG, 6)}
+
+
+def evaluate_routes_weather(routes, workers=1, chunk_size=8, departure_offsets=None):
+    """
+    Samples every route and fetches weather once per grid cell, at the
+    cell's center, so overlapping routes share their lookups. Each sample is
+    then read at its own arrival time from the cell's hourly forecast
+    (get_samples_series). With workers > 1 the cells are fetched in chunks on
+    a thread pool. departure_offsets optionally delays each route's departure
+    by that many minutes. Returns, per route and in the same order,
+    {"route_index", "route", "samples", "statuses"} plus the rain_exposure
+    summary.
+    """
+    plans = [get_sample_plan(route["route_points"], route["duration"]) for route in routes]
+    if departure_offsets is not None:
+        plans = [
+            [{**sample, "arrival_minutes": sample["arrival_minutes"] + offset} for sample in samples]
+            for samples, offset in zip(plans, departure_offsets)
+        ]
+    # cell -> {arrival minutes -> position in the cell's arrivals}
+    cell_arrivals = {}
+    for samples in plans:
+        for sample in samples:
+            arrivals = cell_arrivals.setdefault(_weather_cell(sample), {})
+            arrivals.setdefault(sample["arrival_minutes"], len(arrivals))
+    cells = list(cell_arrivals)
+    points = [_cell_center(cell) for cell in cells]
+    arrivals = [list(cell_arrivals[cell]) for cell in cells]
+    if workers > 1 and len(cells) > chunk_size:
+        import contextvars
+        from concurrent.futures import ThreadPoolExecutor
+
+        bounds = range(0, len(cells), chunk_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Each chunk runs in a copy of the caller's context, so priority
+            # caps and request deadlines apply on the pool threads too
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, get_samples_series, points[i : i + chunk_size], arrivals[i : i + chunk_size]
+                )
+                for i in bounds
+            ]
+            series = [point_statuses for future in futures for point_statuses in future.result()]
+    else:
+        series = get_samples_series(points, arrivals)
+    cell_statuses = dict(zip(cells, series))
+
+    evaluated = []
+    for route_index, (route, samples) in enumerate(zip(routes, plans)):
+        statuses = []
+        for sample in samples:
+            cell = _weather_cell(sample)
+            statuses.append(cell_statuses[cell][cell_arrivals[cell][sample["arrival_minutes"]]])
+        evaluated.append({
+            "route_index": route_index,
+            "route": route,
+            "samples": samples,
+            "statuses": statuses,
+            **rain_exposure(samples, statuses, len(route["route_points"]), route["duration"]),
+        })
+    return evaluated
+
+
+def get_alternatives_weather(routes):
+    """evaluate_routes_weather for one trip's alternatives, ranked from the driest route."""
+    evaluated = evaluate_routes_weather(routes)
+    evaluated.sort(key=lambda item: (item["coverage"] < 1, item["exposure"], item["rainy_minutes"], item["route"]["duration"]))
+    return evaluated
+
+
+def encode_route_points(route_points):
+    """Route points as a polyline6 string, for caches and task payloads."""
+    from polyline_codec import encode_polyline
+
+    return encode_polyline(route_points, 6)
+
+
+def decode_route_points(geometry):
+    """Inverse of encode_route_points: a list of (lat, lon) tuples."""
+    from polyline_codec import decode_polyline
+
+    return list(map(tuple, decode_polyline(geometry, 6).tolist()))
+
+
+def _route_cache_key(start_latlng, end_latlng, mode):
+    return f"rr:route:{mode}:{float(start_latlng[0]):.4f},{float(start_latlng[1]):.4f}:{float(end_latlng[0]):.4f},{float(end_latlng[1]):.4f}"
+
+
+def get_route_data(start_latlng, end_latlng, mode="auto"):
+    """
+    Routes with OSRM, falling back to Valhalla. Results are shared through
+    Redis for ROUTE_CACHE_TTL seconds.
+    Returns (route_data, trip_info); raises RuntimeError when both fail.
+    """
+    if mode not in ["auto", "bicycle", "pedestrian"]:
+        raise ValueError("Modo de transporte inválido. Use 'auto', 'bicycle' ou 'pedestrian'.")
+    cache_key = _route_cache_key(start_latlng, end_latlng, mode)
+    cached = cache_get_json(cache_key)
+    if cached is not None:
+        route_data, trip_info = cached["route_data"], cached["trip_info"]
+        route_data["route_points"] = decode_route_points(route_data.pop("geometry"))
         trip_info["start"] = start_latlng
         trip_info["end"] = end_latlng
-        trip_info["geolocation"] = "Photon" if PHOTON_ENABLED else "Nominatim"
-        if mode not in ["auto", "bicycle", "pedestrian"]:
-            return("Modo de transporte inválido. Use 'auto', 'bicycle' ou 'pedestrian'.")
+        return route_data, trip_info
+
+    route_data, trip_info = _fetch_route_data(start_latlng, end_latlng, mode)
+    shared_trip_info = {**trip_info, "start": list(start_latlng)[:2], "end": list(end_latlng)[:2]}
+    shared_route_data = {key: value for key, value in route_data.items() if key != "route_points"}
+    shared_route_data["geometry"] = encode_route_points(route_data["route_points"])
+    cache_set_json(cache_key, {"route_data": shared_route_data, "trip_info": shared_trip_info}, ROUTE_CACHE_TTL)
+    return route_data, trip_info
+
+
+def _fetch_route_data(start_latlng, end_latlng, mode):
+    trip_info = {}
+    trip_info["start"] = start_latlng
+    trip_info["end"] = end_latlng
+    trip_info["geolocation"] = "Photon" if PHOTON_ENABLED else "Nominatim"
+    if LOCAL_ROUTING_ENABLED and mode == "auto":
+        try:
+            from routing_engine import get_local_route
+
+            route_data = get_local_route(start_latlng, end_latlng)
+        except Exception as exc:
+            print(f" Roteamento local falhou: {exc}. Tentando OSRM.")
+            route_data = None
+        if route_data is not None:
+            trip_info["route_provider"] = "Local"
+            trip_info["trip_time"] = route_data["duration"]
+            trip_info["distance"] = route_data["distance"]
+            return route_data, trip_info
+    try:
         if mode != "auto":
             raise ValueError("Mode only available in valhalla, using the fallback provider")
         osrm_json = get_osrm_route_json(start_latlng, end_latlng)
         route_data = get_osrm_route_data(osrm_json)
         trip_info["route_provider"] = "OSRM"
-        trip_info["trip_time"] = route_data["duration"]
-        trip_info["distance"] = route_data["distance"] 
-        map = get_map(route_data, start_latlng, end_latlng, trip_info)
-        return map
     except Exception as exc:
         print(f" OSRM falhou: {exc}. Tentando Valhalla como fallback.")   
         try:
             valhalla_json = get_valhalla_route_json(start_latlng, end_latlng, mode)
             route_data = get_valhalla_route_data(valhalla_json)
             trip_info["route_provider"] = "Valhalla"
-            trip_info["trip_time"] = route_data["duration"]
-            trip_info["distance"] = route_data["distance"]
-            map = get_map(route_data, start_latlng, end_latlng, trip_info)
-            return map
         except Exception as fallback_exc:
-            error_html = get_error_html(f"Valhalla: {fallback_exc} \n\nOSRM: {exc}", start_latlng, end_latlng)
-            return error_html
+            raise RuntimeError(f"Valhalla: {fallback_exc} \n\nOSRM: {exc}") from fallback_exc
+    trip_info["trip_time"] = route_data["duration"]
+    trip_info["distance"] = route_data["distance"]
+    return route_data, trip_info
+
+
+def get_route_map(start_latlng, end_latlng, mode="auto", deadline=None):
+    if mode not in ["auto", "bicycle", "pedestrian"]:
+        return("Modo de transporte inválido. Use 'auto', 'bicycle' ou 'pedestrian'.")
+    try:
+        with request_deadline(deadline):
+            route_data, trip_info = get_route_data(start_latlng, end_latlng, mode)
+        return get_map(route_data, start_latlng, end_latlng, trip_info, deadline)
+    except Exception as exc:
+        return get_error_html(str(exc), start_latlng, end_latlng)
+
+def preload_heavy_modules():
+    """
+    Imports the geocoding and rendering stacks up front. Only worker processes
+    call this; the web process never renders a map and skips them.
+    """
+    import folium  # noqa: F401
+    import polyline_codec  # noqa: F401
+    from geopy.geocoders import Nominatim, Photon  # noqa: F401
+
 
 if __name__ == "__main__":
+    import webbrowser
     
     
     start_latlng = (-3.761389, -40.344722) 
@@ -0,0 +1,86 @@
+"""
+Geohash-aware task routing.
+
+With GEO_ROUTING_ENABLED, tasks for a region go to the same worker shard:
+the geohash of the route midpoint (the point render_map centers the map on)
+is placed on a consistent hash ring of GEO_ROUTING_SHARDS, and the task is
+sent to "<queue>.<shard>" instead of "<queue>". Each shard's workers keep
+their in-process caches and memory-mapped regional data (graph_store,
+weather cube) hot for their share of the map. Adding a shard only moves
+the cells that land on its ring points, about 1/N of them.
+"""
+import bisect
+import hashlib
+import os
+
+GEO_ROUTING_ENABLED = os.getenv("GEO_ROUTING_ENABLED", "False").lower() in ("true", "1", "yes")
+# Shard names; each shard's workers consume "<queue>.<shard>"
+GEO_ROUTING_SHARDS = [shard.strip() for shard in os.getenv("GEO_ROUTING_SHARDS", "").split(",") if shard.strip()]
+# Base queues that are sharded (the heavy queue has a single worker)
+GEO_ROUTED_QUEUES = {queue.strip() for queue in os.getenv("GEO_ROUTED_QUEUES", "io,render").split(",") if queue.strip()}
+# 3 characters is a ~156 x 156 km cell, about one graph_store region
+GEO_ROUTING_PRECISION = int(os.getenv("GEO_ROUTING_PRECISION", "3"))
+# Points per shard on the ring; more points spread the cells more evenly
+GEO_ROUTING_VNODES = int(os.getenv("GEO_ROUTING_VNODES", "64"))
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(lat, lon, precision=GEO_ROUTING_PRECISION):
+    """Standard base32 geohash of a point."""
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring with GEO_ROUTING_VNODES virtual points per shard."""
+
+    def __init__(self, shards, vnodes=GEO_ROUTING_VNODES):
+        points = sorted((_hash(f"{shard}#{i}"), shard) for shard in shards for i in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key):
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[index]
+
+
+_ring = HashRing(GEO_ROUTING_SHARDS)
+
+
+def midpoint(start_latlng, end_latlng):
+    """Midpoint of the trip's endpoints, where render_map centers the map."""
+    return (float(start_latlng[0]) + float(end_latlng[0])) / 2, (float(start_latlng[1]) + float(end_latlng[1])) / 2
+
+
+def geo_queue(queue, start_latlng, end_latlng):
+    """The shard of `queue` serving the trip's region, or `queue` itself when not sharded."""
+    if not GEO_ROUTING_ENABLED or queue not in GEO_ROUTED_QUEUES:
+        return queue
+    shard = _ring.shard_for(geohash(*midpoint(start_latlng, end_latlng)))
+    return f"{queue}.{shard}" if shard else queue
@@ -0,0 +1,275 @@
+"""
+Regional road graph store.
+
+A region's OSM drive network is downloaded and preprocessed once into compact
+CSR arrays (node coordinates, edge targets, travel times, lengths) saved as
+.npy files. Workers open them with mmap_mode="r", so every process shares the
+same read-only pages and no request downloads or builds a networkx graph.
+
+Build a region with:
+
+    python graph_store.py build ceara --bbox -2.7 -7.9 -37.2 -41.5
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from spatial_index import build_index, query_index
+
+GRAPH_STORE_DIR = os.getenv("GRAPH_STORE_DIR", "graph_store")
+STORE_FORMAT_VERSION = 2
+
+# Array files of a region and their dtypes
+STORE_ARRAYS = {
+    "node_ids": np.int64,
+    "node_lat": np.float32,
+    "node_lon": np.float32,
+    "indptr": np.int64,
+    "targets": np.int32,
+    "travel_time": np.float32,
+    "length": np.float32,
+    # Reverse CSR (incoming edges) for backward searches
+    "rev_indptr": np.int64,
+    "rev_sources": np.int32,
+    "rev_travel_time": np.float32,
+}
+
+# BallTree over the nodes, persisted next to the arrays
+NODE_INDEX_FILE = "node_index.joblib"
+
+# Per-process cache of opened regions, the arrays themselves are mmapped
+_loaded_regions = {}
+
+
+def graph_to_csr(graph):
+    """
+    Converts an osmnx graph (with length and travel_time edge attributes)
+    into the store's arrays. Parallel edges keep the fastest one.
+    """
+    nodes = list(graph.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    node_count = len(nodes)
+
+    fastest = {}
+    for u, v, data in graph.edges(data=True):
+        travel_time = data.get("travel_time")
+        if travel_time is None or u == v:
+            continue
+        key = (node_index[u], node_index[v])
+        if key not in fastest or travel_time < fastest[key][0]:
+            fastest[key] = (travel_time, data.get("length", 0.0))
+
+    sources = np.fromiter((key[0] for key in fastest), dtype=np.int64, count=len(fastest))
+    targets = np.fromiter((key[1] for key in fastest), dtype=np.int32, count=len(fastest))
+    travel_time = np.fromiter((value[0] for value in fastest.values()), dtype=np.float32, count=len(fastest))
+    length = np.fromiter((value[1] for value in fastest.values()), dtype=np.float32, count=len(fastest))
+
+    # Zero weights would break the routing heuristic's speed bound
+    travel_time = np.maximum(travel_time, 0.01)
+
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=node_count), out=indptr[1:])
+
+    rev_order = np.lexsort((sources, targets))
+    rev_indptr = np.zeros(node_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(targets, minlength=node_count), out=rev_indptr[1:])
+
+    return {
+        "node_ids": np.asarray(nodes, dtype=np.int64),
+        "node_lat": np.array([graph.nodes[n]["y"] for n in nodes], dtype=np.float32),
+        "node_lon": np.array([graph.nodes[n]["x"] for n in nodes], dtype=np.float32),
+        "indptr": indptr,
+        "targets": targets[order],
+        "travel_time": travel_time[order],
+        "length": length[order],
+        "rev_indptr": rev_indptr,
+        "rev_sources": sources[rev_order],
+        "rev_travel_time": travel_time[rev_order],
+    }
+
+
+def save_region(name, arrays, bbox):
+    """
+    Writes a region atomically: arrays go to a temporary directory that then
+    replaces the old region, so readers never see a half written store.
+    """
+    region_dir = os.path.join(GRAPH_STORE_DIR, name)
+    tmp_dir = f"{region_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    for array_name, dtype in STORE_ARRAYS.items():
+        np.save(os.path.join(tmp_dir, f"{array_name}.npy"), np.ascontiguousarray(arrays[array_name], dtype=dtype))
+
+    north, south, east, west = bbox
+    meta = {
+        "name": name,
+        "version": STORE_FORMAT_VERSION,
+        "bbox": {"north": north, "south": south, "east": east, "west": west},
+        "node_count": int(len(arrays["node_ids"])),
+        "edge_count": int(len(arrays["targets"])),
+        "built_at": int(time.time()),
+    }
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    import joblib
+
+    joblib.dump(build_index(arrays["node_lat"], arrays["node_lon"]), os.path.join(tmp_dir, NODE_INDEX_FILE))
+
+    old_dir = f"{region_dir}.old-{os.getpid()}"
+    if os.path.exists(region_dir):
+        os.replace(region_dir, old_dir)
+    os.replace(tmp_dir, region_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    _loaded_regions.pop(name, None)
+    return meta
+
+
+def build_region(name, north, south, east, west, simple_filter=False):
+    """Downloads a region from Overpass once and stores it as CSR arrays."""
+    from rainy_road import get_bbox_graph
+
+    graph = get_bbox_graph((north, east), (south, west), True, simple_filter)
+    arrays = graph_to_csr(graph)
+    return save_region(name, arrays, (north, south, east, west))
+
+
+def load_region(name):
+    """Opens a region read-only. Arrays are memory mapped, not read into RAM."""
+    region = _loaded_regions.get(name)
+    if region is not None:
+        return region
+
+    region_dir = os.path.join(GRAPH_STORE_DIR, name)
+    with open(os.path.join(region_dir, "meta.json")) as f:
+        meta = json.load(f)
+    if meta.get("version") != STORE_FORMAT_VERSION:
+        raise RuntimeError(f"Regiao {name} foi gerada com outro formato, gere novamente.")
+
+    region = {"name": name, "meta": meta, "dir": region_dir}
+    for array_name in STORE_ARRAYS:
+        mapped = np.load(os.path.join(region_dir, f"{array_name}.npy"), mmap_mode="r")
+        # Plain ndarray views over the same mapping; indexing a np.memmap
+        # subclass is several times slower in the routing loops.
+        region[array_name] = np.asarray(mapped)
+    _loaded_regions[name] = region
+    return region
+
+
+def list_regions():
+    """Returns the meta dicts of every region in GRAPH_STORE_DIR."""
+    if not os.path.isdir(GRAPH_STORE_DIR):
+        return []
+    regions = []
+    for entry in sorted(os.listdir(GRAPH_STORE_DIR)):
+        meta_path = os.path.join(GRAPH_STORE_DIR, entry, "meta.json")
+        if "." in entry or not os.path.isfile(meta_path):
+            continue
+        try:
+            with open(meta_path) as f:
+                regions.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return regions
+
+
+def _bbox_contains(bbox, latlng):
+    return bbox["south"] <= latlng[0] <= bbox["north"] and bbox["west"] <= latlng[1] <= bbox["east"]
+
+
+def find_region(start_latlng, end_latlng):
+    """Returns the smallest stored region covering both points, or None."""
+    best = None
+    best_area = None
+    for meta in list_regions():
+        bbox = meta["bbox"]
+        if not (_bbox_contains(bbox, start_latlng) and _bbox_contains(bbox, end_latlng)):
+            continue
+        area = (bbox["north"] - bbox["south"]) * (bbox["east"] - bbox["west"])
+        if best is None or area < best_area:
+            best, best_area = meta["name"], area
+    return load_region(best) if best else None
+
+
+def get_node_index(region):
+    """
+    BallTree over the region's nodes. Loaded from the region directory, or
+    built once and saved there when the region predates the index.
+    """
+    tree = region.get("node_index")
+    if tree is not None:
+        return tree
+
+    import joblib
+
+    index_path = os.path.join(region["dir"], NODE_INDEX_FILE)
+    try:
+        tree = joblib.load(index_path)
+    except Exception:
+        tree = build_index(region["node_lat"], region["node_lon"])
+        try:
+            joblib.dump(tree, index_path)
+        except OSError as exc:
+            # Workers may mount the store read-only
+            print(f"Warning: Could not save node index for {region['name']} - {exc}")
+    region["node_index"] = tree
+    return tree
+
+
+def snap_points(region, latlngs):
+    """Node indexes nearest to each (lat, lon) point, in one vectorized query."""
+    positions, _ = query_index(get_node_index(region), latlngs)
+    return positions
+
+
+def nearest_node(region, lat, lon):
+    """Index of the region node closest to (lat, lon)."""
+    return int(snap_points(region, [(lat, lon)])[0])
+
+
+def path_summary(region, path):
+    """Builds the route_points/duration/distance dict used by the map code."""
+    path = np.asarray(path, dtype=np.int64)
+    duration = 0.0
+    distance = 0.0
+    for u, v in zip(path[:-1], path[1:]):
+        start, end = region["indptr"][u], region["indptr"][u + 1]
+        edge = start + int(np.searchsorted(region["targets"][start:end], v))
+        duration += float(region["travel_time"][edge])
+        distance += float(region["length"][edge])
+
+    route_points = np.column_stack((region["node_lat"][path], region["node_lon"][path])).astype(float)
+    return {
+        "route_points": [tuple(point) for point in route_points],
+        "duration": duration / 60,
+        "distance": distance / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the regional road graph store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="download and preprocess a region")
+    build.add_argument("name")
+    build.add_argument("--bbox", nargs=4, type=float, required=True, metavar=("NORTH", "SOUTH", "EAST", "WEST"))
+    build.add_argument("--simple", action="store_true", help="only motorway/trunk/primary roads")
+
+    subparsers.add_parser("list", help="list stored regions")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        meta = build_region(args.name, *args.bbox, simple_filter=args.simple)
+        print(f"Regiao {meta['name']}: {meta['node_count']} nos, {meta['edge_count']} arestas")
+    else:
+        for meta in list_regions():
+            print(f"{meta['name']}: {meta['bbox']} ({meta['node_count']} nos, {meta['edge_count']} arestas)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Single-node job backend (JOB_BACKEND=local).
+
+Runs the same Celery tasks in the web process instead of on workers: jobs
+go to a thread pool and execute eagerly, keeping their progress and results
+in Celery's in-memory result backend. /generate_map_v2, /progress and
+/result work unchanged with no broker, no Redis and no worker containers.
+State lives in one process, so the web server must run a single process
+(threads are fine).
+"""
+import os
+import traceback
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_BACKEND = os.getenv("JOB_BACKEND", "celery").lower()
+LOCAL_JOB_WORKERS = int(os.getenv("LOCAL_JOB_WORKERS", "2"))
+
+
+def is_local_backend():
+    return JOB_BACKEND == "local"
+
+
+def local_celery_config():
+    """Celery settings that make tasks run in-process and keep results in memory."""
+    return {
+        "broker_url": "memory://",
+        "result_backend": "cache+memory://",
+        "task_always_eager": True,
+        # Eager chains would store every stage's result under the job id;
+        # LocalJobQueue stores only the final one (progress still goes
+        # through update_state)
+        "task_store_eager_result": False,
+        "task_eager_propagates": False,
+        "beat_schedule": {},
+    }
+
+
+class LocalJobQueue:
+    """Thread pool running Celery tasks eagerly under a task id known up front."""
+
+    def __init__(self, workers=LOCAL_JOB_WORKERS):
+        self.workers = max(1, workers)
+        self._executor = None
+        # Results are stored by _run, so reading them back under eager mode is fine
+        warnings.filterwarnings("ignore", message="Results are not stored in backend", category=RuntimeWarning)
+
+    def submit(self, task, args=None, kwargs=None):
+        """Queues task(*args, **kwargs) and returns its AsyncResult right away."""
+        if self._executor is None:
+            # Created on the first job so startup stays instant
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="rr-job")
+        task_id = str(uuid.uuid4())
+        self._executor.submit(self._run, task, list(args or []), dict(kwargs or {}), task_id)
+        return task.AsyncResult(task_id)
+
+    @staticmethod
+    def _run(task, args, kwargs, task_id):
+        try:
+            result = task.apply(args=args, kwargs=kwargs, task_id=task_id)
+            if result.successful():
+                task.backend.store_result(task_id, result.result, "SUCCESS")
+            else:
+                task.backend.mark_as_failure(task_id, result.result, traceback=result.traceback)
+        except Exception as exc:
+            traceback.print_exc()
+            task.backend.mark_as_failure(task_id, exc)
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -0,0 +1,147 @@
+"""
+Request frequency tracking and prewarming of popular corridors.
+
+Every map request bumps a per-day Redis counter for its normalized
+origin/destination/mode. Before peak hours a beat task takes the top
+PREWARM_TOP_N corridors of the last PREWARM_WINDOW_DAYS days and refreshes
+their geocodes, route, weather and rendered map, so those requests are
+answered from cache. Prewarm calls run at PREWARM_PRIORITY (see
+rate_budget.priority_cap) and stop after PREWARM_MAX_WEATHER_CALLS samples.
+"""
+import json
+import os
+import time
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+from cache import cache_get_json, cache_set_json, get_redis, mark_redis_down
+
+PREWARM_ENABLED = os.getenv("PREWARM_ENABLED", "False").lower() in ("true", "1", "yes")
+PREWARM_TOP_N = int(os.getenv("PREWARM_TOP_N", "50"))
+PREWARM_WINDOW_DAYS = int(os.getenv("PREWARM_WINDOW_DAYS", "7"))
+# Comma separated UTC hours, run before the morning and evening peaks (BRT)
+PREWARM_HOURS = os.getenv("PREWARM_HOURS", "9,19")
+PREWARM_PRIORITY = os.getenv("PREWARM_PRIORITY", "low")
+PREWARM_MAX_WEATHER_CALLS = int(os.getenv("PREWARM_MAX_WEATHER_CALLS", "500"))
+# Prewarmed maps are served for this long (capped by MAP_MAX_AGE_SECONDS)
+PREWARM_MAP_TTL = int(os.getenv("PREWARM_MAP_TTL", "3600"))
+
+_COUNTER_PREFIX = "rr:corridors"
+
+
+def _normalize_place(value):
+    text = unicodedata.normalize("NFKD", str(value)).encode("ascii", "ignore").decode("ascii").casefold()
+    return ", ".join(" ".join(part.split()) for part in text.split(","))
+
+
+def corridor_key(start, end, travel_mode="auto"):
+    """
+    Normalized corridor id. Places are names (accents, case and spacing
+    removed) or (lat, lon) pairs, stored as "@lat,lon" with 3 decimals.
+    """
+    def place(value):
+        if isinstance(value, (list, tuple)):
+            return f"@{float(value[0]):.3f},{float(value[1]):.3f}"
+        return _normalize_place(value)
+
+    return f"{travel_mode}|{place(start)}|{place(end)}"
+
+
+def parse_corridor(key):
+    """Inverse of corridor_key: (start, end, travel_mode)."""
+    travel_mode, start, end = key.split("|", 2)
+
+    def place(value):
+        if value.startswith("@"):
+            lat, lon = value[1:].split(",")
+            return (float(lat), float(lon))
+        return value
+
+    return place(start), place(end), travel_mode
+
+
+def _day_key(day):
+    return f"{_COUNTER_PREFIX}:{day.strftime('%Y%m%d')}"
+
+
+def _names_key(day):
+    # Places as users typed them, so the prewarmer geocodes (and warms the
+    # geo: cache keys of) the same strings live requests look up
+    return f"{_day_key(day)}:names"
+
+
+def record_request(start, end, travel_mode="auto"):
+    """Counts one request for the corridor. Never fails the request."""
+    client = get_redis()
+    if client is None:
+        return
+    today = datetime.now(timezone.utc)
+    counter = _day_key(today)
+    key = corridor_key(start, end, travel_mode)
+    try:
+        pipe = client.pipeline()
+        pipe.zincrby(counter, 1, key)
+        pipe.expire(counter, (PREWARM_WINDOW_DAYS + 1) * 86400)
+        if isinstance(start, str) or isinstance(end, str):
+            pipe.hset(_names_key(today), key, json.dumps([start, end]))
+            pipe.expire(_names_key(today), (PREWARM_WINDOW_DAYS + 1) * 86400)
+        pipe.execute()
+    except Exception as exc:
+        mark_redis_down(exc)
+
+
+def corridor_places(key):
+    """
+    (start, end, travel_mode) of a corridor with place names as last
+    requested, falling back to the normalized names of parse_corridor.
+    """
+    start, end, travel_mode = parse_corridor(key)
+    client = get_redis()
+    if client is None or not (isinstance(start, str) or isinstance(end, str)):
+        return start, end, travel_mode
+    today = datetime.now(timezone.utc)
+    try:
+        pipe = client.pipeline()
+        for offset in range(PREWARM_WINDOW_DAYS):
+            pipe.hget(_names_key(today - timedelta(days=offset)), key)
+        recorded = next((raw for raw in pipe.execute() if raw is not None), None)
+    except Exception as exc:
+        mark_redis_down(exc)
+        return start, end, travel_mode
+    if recorded is None:
+        return start, end, travel_mode
+    raw_start, raw_end = json.loads(recorded)
+    return (
+        raw_start if isinstance(raw_start, str) else start,
+        raw_end if isinstance(raw_end, str) else end,
+        travel_mode,
+    )
+
+
+def top_corridors(limit=PREWARM_TOP_N):
+    """[(corridor key, count)] for the busiest corridors of the window."""
+    client = get_redis()
+    if client is None:
+        return []
+    today = datetime.now(timezone.utc)
+    days = [_day_key(today - timedelta(days=offset)) for offset in range(PREWARM_WINDOW_DAYS)]
+    try:
+        client.zunionstore(f"{_COUNTER_PREFIX}:top", days)
+        client.expire(f"{_COUNTER_PREFIX}:top", 3600)
+        top = client.zrevrange(f"{_COUNTER_PREFIX}:top", 0, limit - 1, withscores=True)
+    except Exception as exc:
+        mark_redis_down(exc)
+        return []
+    return [(member.decode() if isinstance(member, bytes) else member, int(score)) for member, score in top]
+
+
+def get_prewarmed_map(start, end, travel_mode="auto"):
+    """Path of a still valid prewarmed map for the corridor, or None."""
+    entry = cache_get_json(f"rr:map:{corridor_key(start, end, travel_mode)}")
+    if not entry or not os.path.isfile(entry.get("map_file", "")):
+        return None
+    return entry["map_file"]
+
+
+def set_prewarmed_map(key, map_file, ttl):
+    cache_set_json(f"rr:map:{key}", {"map_file": map_file, "built_at": int(time.time())}, ttl)
@@ -0,0 +1,212 @@
+"""
+On-demand profiling of map generation tasks.
+
+A job is profiled when the request asks for it (admin only) or for a
+PROFILE_SAMPLE_RATE fraction of jobs. Its tasks then carry a profile_id and
+run under cProfile and tracemalloc; each one saves a .prof file (for
+pstats/snakeviz) and a JSON report with its slowest functions and largest
+allocations under PROFILE_DIR/<profile_id>/, read back by /admin/profiles.
+Tasks without a profile_id run untouched.
+
+Profiling state is per thread, so concurrent jobs (local thread pool,
+threaded workers) are each profiled. tracemalloc is process-wide: one
+profile at a time traces memory, and its allocations can include other
+jobs running in the same process meanwhile.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import shutil
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Under the maps directory by default, which every container already shares
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getenv("GENERATED_MAPS_DIR", "generated_maps"), "profiles"))
+PROFILE_MAX_AGE_SECONDS = int(os.getenv("PROFILE_MAX_AGE_SECONDS", "86400"))
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+# Frames kept per allocation traceback; more is slower and uses more memory
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "5"))
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+# cProfile allows one active profiler per thread, so nested tasks (eager
+# mode, chords run in-process) are covered by the outer profile
+_thread_state = threading.local()
+# Held by the profile currently tracing memory
+_tracemalloc_lock = threading.Lock()
+
+
+def new_profile_id(requested=False):
+    """A profile id when the job should be profiled (asked for, or sampled), else None."""
+    if requested or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE):
+        return uuid.uuid4().hex
+    return None
+
+
+def is_valid_profile_id(profile_id):
+    return bool(profile_id) and bool(_PROFILE_ID.match(profile_id))
+
+
+def _top_functions(profiler, limit):
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    rows = []
+    for (filename, line, name), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "total_seconds": round(total, 4),
+            "cumulative_seconds": round(cumulative, 4),
+        })
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:limit]
+
+
+def _top_allocations(snapshot, limit):
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+def cleanup_old_profiles():
+    """Deletes profile directories older than PROFILE_MAX_AGE_SECONDS."""
+    root = Path(PROFILE_DIR)
+    if not root.exists():
+        return 0
+    deleted = 0
+    for profile_dir in root.iterdir():
+        try:
+            if time.time() - profile_dir.stat().st_mtime > PROFILE_MAX_AGE_SECONDS:
+                shutil.rmtree(profile_dir)
+                deleted += 1
+        except OSError:
+            continue
+    return deleted
+
+
+@contextmanager
+def profiled(profile_id, name, task_id=""):
+    """Profiles the block and saves its report as `name` under profile_id."""
+    if getattr(_thread_state, "active", False) or not is_valid_profile_id(profile_id):
+        yield
+        return
+
+    # Another thread's profile may own tracemalloc; this one then only has CPU data
+    traces_memory = _tracemalloc_lock.acquire(blocking=False)
+    started_tracing = traces_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+    if traces_memory:
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    _thread_state.active = True
+    started = time.perf_counter()
+    started_cpu = time.thread_time()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _thread_state.active = False
+        wall_seconds = time.perf_counter() - started
+        cpu_seconds = time.thread_time() - started_cpu
+        peak, snapshot = None, None
+        if traces_memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracing:
+                tracemalloc.stop()
+            _tracemalloc_lock.release()
+        try:
+            _save_profile(profile_id, name, task_id, profiler, snapshot, wall_seconds, cpu_seconds, peak)
+        except Exception as exc:
+            # Profiling must never fail the task it observes
+            print(f"Warning: perfil {profile_id} nao salvo - {exc}")
+
+
+def _save_profile(profile_id, name, task_id, profiler, snapshot, wall_seconds, cpu_seconds, peak):
+    cleanup_old_profiles()
+    output_dir = Path(PROFILE_DIR) / profile_id
+    output_dir.mkdir(parents=True, exist_ok=True)
+    stem = f"{name}-{task_id}" if task_id else name
+    profiler.dump_stats(output_dir / f"{stem}.prof")
+    report = {
+        "profile_id": profile_id,
+        "task": name,
+        "task_id": task_id,
+        "created_at": int(time.time()),
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        # None when a concurrent profile was tracing memory
+        "peak_memory_mb": round(peak / 1024 / 1024, 1) if peak is not None else None,
+        "top_functions": _top_functions(profiler, PROFILE_TOP_N),
+        "top_allocations": _top_allocations(snapshot, PROFILE_TOP_N) if snapshot is not None else [],
+        "stats_file": f"{stem}.prof",
+    }
+    with open(output_dir / f"{stem}.json", "w", encoding="utf-8") as f:
+        json.dump(report, f)
+
+
+def load_profile(profile_id):
+    """Reports of every profiled task of the job, oldest first, or None if unknown."""
+    if not is_valid_profile_id(profile_id):
+        return None
+    profile_dir = Path(PROFILE_DIR) / profile_id
+    if not profile_dir.is_dir():
+        return None
+    reports = []
+    for report_file in profile_dir.glob("*.json"):
+        try:
+            with open(report_file, encoding="utf-8") as f:
+                reports.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    reports.sort(key=lambda report: report["created_at"])
+    return reports
+
+
+def list_profiles(limit=100):
+    """Summaries of the saved profiles, newest first: id, time, tasks and total wall seconds."""
+    root = Path(PROFILE_DIR)
+    if not root.is_dir():
+        return []
+    profiles = []
+    for profile_dir in root.iterdir():
+        if not is_valid_profile_id(profile_dir.name):
+            continue
+        reports = load_profile(profile_dir.name) or []
+        if not reports:
+            continue
+        profiles.append({
+            "profile_id": profile_dir.name,
+            "created_at": reports[0]["created_at"],
+            "task_ids": sorted({report["task_id"] for report in reports if report["task_id"]}),
+            "tasks": [report["task"] for report in reports],
+            "wall_seconds": round(sum(report["wall_seconds"] for report in reports), 3),
+        })
+    profiles.sort(key=lambda profile: profile["created_at"], reverse=True)
+    return profiles[:limit]
+
+
+def profile_stats_path(profile_id, stats_file):
+    """Path of one task's .prof file, or None when it doesn't exist."""
+    if not is_valid_profile_id(profile_id) or Path(stats_file).name != stats_file or not stats_file.endswith(".prof"):
+        return None
+    path = Path(PROFILE_DIR) / profile_id / stats_file
+    return path if path.is_file() else None
@@ -1,14 +1,8 @@
 import math
 import os
 import time
-import webbrowser
 
-import folium
-import osmnx as ox
 import requests
-import xyzservices.providers as xyz
-from geopy.extra.rate_limiter import RateLimiter
-from geopy.geocoders import Nominatim
 
 START_LOCATION = "Sobral, CE"
 END_LOCATION = "Fortaleza, CE"
@@ -17,11 +11,29 @@ OW_API_KEY = os.getenv("OW_API_KEY")  # OpenWeather API key
 MODE = "drive"  # bike, walk
 OPTIMIZER = "travel_time"  # lenght, travel_time
 
-ox.settings.overpass_endpoint = "https://maps.mail.ru/osm/tools/overpass/api"  # Comment this line to use the default overpass server
-ox.settings.overpass_rate_limit = (
-    False  # Set to True when using the default overpass server
+# Corridor loading: full detail only near the endpoints, backbone in between
+ENDPOINT_RADIUS_KM = float(os.getenv("ENDPOINT_RADIUS_KM", "8"))
+CORRIDOR_WIDTH_KM = float(os.getenv("CORRIDOR_WIDTH_KM", "20"))
+BACKBONE_FILTER = (
+    '["highway"~"motorway|motorway_link|trunk|trunk_link|primary|primary_link"]'
 )
 
+_ox_module = None
+
+
+def _ox():
+    """Imports osmnx on first use, it pulls in geopandas, shapely and networkx."""
+    global _ox_module
+    if _ox_module is None:
+        import osmnx as ox
+
+        ox.settings.overpass_endpoint = "https://maps.mail.ru/osm/tools/overpass/api"  # Comment this line to use the default overpass server
+        ox.settings.overpass_rate_limit = (
+            False  # Set to True when using the default overpass server
+        )
+        _ox_module = ox
+    return _ox_module
+
 
 def degrees_to_radians(degrees):
     return degrees * math.pi / 180
@@ -43,6 +55,9 @@ def distance_of_coordinates_in_km(coord1, coord2):
 
 
 def get_coordinates(start_location, end_location):
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import Nominatim
+
     locator = Nominatim(user_agent="rainy-road")
     start_location = (start_location or "").strip()
     end_location = (end_location or "").strip()
@@ -74,6 +89,8 @@ def get_coordinates(start_location, end_location):
 
 
 def get_coordinates2(start_location, end_location):
+    from geopy.geocoders import Nominatim
+
     locator = Nominatim(user_agent="rainy-road")
     start_location = (start_location or "").strip()
     end_location = (end_location or "").strip()
@@ -91,6 +108,7 @@ def get_coordinates2(start_location, end_location):
 
 
 def get_bbox_graph(start_latlng, end_latlng, use_cf, simple_filter):
+    ox = _ox()
     ox.settings.log_console = True
     ox.settings.use_cache = True
     north = max(start_latlng[0], end_latlng[0])
@@ -145,6 +163,7 @@ def get_bbox_graph(start_latlng, end_latlng, use_cf, simple_filter):
 
 
 def get_radius_graph(start_latlng, end_latlng):
+    ox = _ox()
     ox.settings.log_console = False
     ox.settings.use_cache = True
     middle_latlng = (
@@ -170,12 +189,105 @@ def get_radius_graph(start_latlng, end_latlng):
     return graph
 
 
+def get_corridor_polygon(start_latlng, end_latlng, width_km):
+    """
+    Polygon (lon/lat) of a band width_km wide around the straight line between
+    the two points. Longitudes are scaled by cos(latitude) before buffering
+    so the band has the same width in km in both directions.
+    """
+    from shapely import affinity
+    from shapely.geometry import LineString
+
+    mid_lat = (start_latlng[0] + end_latlng[0]) / 2
+    lon_scale = math.cos(degrees_to_radians(mid_lat))
+    line = LineString(
+        [(start_latlng[1] * lon_scale, start_latlng[0]), (end_latlng[1] * lon_scale, end_latlng[0])]
+    )
+    band = line.buffer((width_km / 2) / 111.32)
+    return affinity.scale(band, xfact=1 / lon_scale, yfact=1, origin=(0, 0))
+
+
+def get_corridor_graph(
+    start_latlng,
+    end_latlng,
+    endpoint_radius_km=ENDPOINT_RADIUS_KM,
+    corridor_width_km=CORRIDOR_WIDTH_KM,
+):
+    """
+    Loads full detail drive networks only within endpoint_radius_km of each
+    endpoint, plus a motorway/trunk/primary backbone inside a corridor around
+    the straight line between them, joined into one routable graph (shared
+    OSM node ids connect the pieces). Download size and memory grow with the
+    corridor width instead of the bounding box area.
+
+    The pieces are loaded unsimplified and the composed graph is simplified
+    once: simplifying each piece on its own drops the nodes where a local
+    street meets the backbone from one side only, leaving the pieces apart.
+    Raises ValueError when the endpoints still aren't connected.
+    """
+    import networkx as nx
+
+    from spatial_index import snap_to_graph
+
+    ox = _ox()
+    ox.settings.log_console = False
+    ox.settings.use_cache = True
+    radius = endpoint_radius_km * 1000
+    start_graph = ox.graph_from_point(
+        start_latlng[:2], dist=radius, network_type=MODE, simplify=False
+    )
+    end_graph = ox.graph_from_point(
+        end_latlng[:2], dist=radius, network_type=MODE, simplify=False
+    )
+    corridor = get_corridor_polygon(start_latlng, end_latlng, corridor_width_km)
+    backbone = ox.graph_from_polygon(
+        corridor,
+        network_type=None,
+        simplify=False,
+        custom_filter=BACKBONE_FILTER,
+        truncate_by_edge=True,
+    )
+    graph = ox.simplify_graph(nx.compose_all([start_graph, backbone, end_graph]))
+
+    orig_node, dest_node = snap_to_graph(graph, [start_latlng[:2], end_latlng[:2]])
+    if not nx.has_path(graph, orig_node, dest_node):
+        raise ValueError("Corredor sem ligacao entre origem e destino")
+
+    ox.distance.add_edge_lengths(graph, edges=None)
+    speeds = {
+        "primary": 100,
+        "secondary": 80,
+        "motorway": 100,
+        "trunk": 100,
+        "residential": 40,
+        "tertiary": 40,
+        "unclassified": 30,
+    }  # Add speeds to roads based on their type
+    graph = ox.add_edge_speeds(graph, hwy_speeds=speeds)
+    graph = ox.add_edge_travel_times(graph)
+    return graph
+
+
 def get_shortest_route(graph, start_latlng, end_latlng):
-    orig_node = ox.nearest_nodes(graph, start_latlng[1], start_latlng[0])
-    dest_node = ox.nearest_nodes(graph, end_latlng[1], end_latlng[0])
+    from spatial_index import snap_to_graph
+
+    ox = _ox()
+    # The node index is built once per graph, not on every lookup
+    orig_node, dest_node = snap_to_graph(graph, [start_latlng[:2], end_latlng[:2]])
     return ox.shortest_path(graph, orig_node, dest_node, weight=OPTIMIZER)
 
 
+def get_stored_route(start_latlng, end_latlng):
+    """
+    Routes over a preprocessed region from graph_store, with no download and
+    no networkx graph. Returns None when no stored region covers both points,
+    otherwise a dict with route_points, duration (min) and distance (km).
+    """
+    from routing_engine import get_local_route
+
+    return get_local_route(start_latlng, end_latlng)
+
+
 def weather_at_point(lat, lng):
     if not OW_API_KEY:
         raise RuntimeError(
@@ -196,6 +308,7 @@ def weather_at_point(lat, lng):
 
 
 def get_map(graph, shortest_route):
+    ox = _ox()
 
     lenght_in_nodes = len(shortest_route)
     number_of_samples = int(
@@ -233,6 +346,8 @@ def get_map(graph, shortest_route):
     )
 
     # Uncomment to add weather tiles over the map. Consumes a lot of api requests
+    # import folium
+    # import xyzservices.providers as xyz
     # tiles = xyz.OpenWeatherMap.Precipitation(apiKey=OW_API_KEY)
 
     if rainroad:
@@ -244,16 +359,32 @@ def get_map(graph, shortest_route):
 
 
 if __name__ == "__main__":
+    import webbrowser
+
     start_latlng, end_latlng = get_coordinates(START_LOCATION, END_LOCATION)
+    route_data = get_stored_route(start_latlng, end_latlng)
+    if route_data is not None:
+        from faster_rainy_road import get_map as get_route_weather_map
+
+        get_route_weather_map(route_data, start_latlng, end_latlng).save("map.html")
+        webbrowser.open("map.html")
+        raise SystemExit(0)
+    shortest_route = None
     try:
-        graph = get_bbox_graph(start_latlng, end_latlng, True, False)
+        graph = get_corridor_graph(start_latlng, end_latlng)
+        shortest_route = get_shortest_route(graph, start_latlng, end_latlng)
     except Exception as e:
         print(e)
+    if shortest_route is None:
         try:
-            graph = get_radius_graph(start_latlng, end_latlng)
+            graph = get_bbox_graph(start_latlng, end_latlng, True, False)
         except Exception as e:
             print(e)
-    shortest_route = get_shortest_route(graph, start_latlng, end_latlng)
+            try:
+                graph = get_radius_graph(start_latlng, end_latlng)
+            except Exception as e:
+                print(e)
+        shortest_route = get_shortest_route(graph, start_latlng, end_latlng)
     try:
         shortest_route_map = get_map(graph, shortest_route)
     except Exception as e:
@@ -0,0 +1,211 @@
+"""
+Request budgets for the external providers, shared by every web and Celery
+process through Redis.
+
+Each provider has a token bucket (burst size + refill rate) and an optional
+daily quota. Callers ask for tokens with a priority; lower priorities must
+leave part of the budget untouched so live traffic isn't starved by optional
+or background calls. When Redis is down each process falls back to its own
+in-memory bucket.
+"""
+import contextvars
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from cache import get_redis, mark_redis_down
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    if value in (None, ""):
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        return default
+
+
+def _budget(prefix, per_minute, burst, daily):
+    return {
+        "rate": _env_float(f"{prefix}_RATE_PER_MINUTE", per_minute) / 60.0,
+        "burst": _env_float(f"{prefix}_BURST", burst),
+        "daily": _env_float(f"{prefix}_DAILY_QUOTA", daily),
+    }
+
+
+# rate is tokens per second, burst is the bucket size and daily is the
+# per-day quota (0 disables it). Defaults follow the free tiers / usage policies.
+PROVIDER_BUDGETS = {
+    "nominatim": _budget("NOMINATIM", 60, 1, 0),
+    "photon": _budget("PHOTON", 60, 1, 0),
+    "google_weather": _budget("GW", 60, 10, 1000),
+    "openweather": _budget("OW", 60, 10, 1000),
+    "open_meteo": _budget("OPEN_METEO", 600, 100, 10000),
+}
+
+# Fraction of the bucket (and of the daily quota) a request of each priority
+# must leave behind, rounded down to whole requests.
+PRIORITY_RESERVE = {
+    "high": 0.0,
+    "normal": 0.1,
+    "low": 0.5,
+}
+
+# Background jobs lower every request they make to at most this priority
+_priority_cap = contextvars.ContextVar("priority_cap", default=None)
+
+# Returns {granted, seconds_to_wait}. A wait of -1 means the daily quota is
+# exhausted for this priority and waiting won't help.
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local reserve = tonumber(ARGV[4])
+local daily_limit = tonumber(ARGV[5])
+local daily_reserve = tonumber(ARGV[6])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+local granted = 1
+local wait = 0
+if daily_limit > 0 then
+  local used = tonumber(redis.call('GET', KEYS[2]) or '0')
+  if used + cost > daily_limit - daily_reserve then
+    granted = 0
+    wait = -1
+  end
+end
+if granted == 1 and tokens - cost < reserve then
+  granted = 0
+  wait = (reserve + cost - tokens) / rate
+end
+if granted == 1 then
+  tokens = tokens - cost
+  if daily_limit > 0 then
+    redis.call('INCRBY', KEYS[2], cost)
+    redis.call('EXPIRE', KEYS[2], 90000)
+  end
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], 86400)
+return {granted, tostring(wait)}
+"""
+
+_script = None
+_local_buckets = {}
+_local_lock = threading.Lock()
+
+
+def _local_take(provider, budget, cost, reserve, daily_reserve):
+    """In-process version of the Redis script, used while Redis is down."""
+    day = datetime.now(timezone.utc).strftime("%Y%m%d")
+    with _local_lock:
+        now = time.monotonic()
+        state = _local_buckets.setdefault(
+            provider, {"tokens": budget["burst"], "ts": now, "day": day, "used": 0}
+        )
+        if state["day"] != day:
+            state["day"], state["used"] = day, 0
+        tokens = min(budget["burst"], state["tokens"] + (now - state["ts"]) * budget["rate"])
+        state["tokens"], state["ts"] = tokens, now
+        if budget["daily"] and state["used"] + cost > budget["daily"] - daily_reserve:
+            return False, -1.0
+        if tokens - cost < reserve:
+            return False, (reserve + cost - tokens) / budget["rate"]
+        state["tokens"] = tokens - cost
+        state["used"] += cost
+        return True, 0.0
+
+
+def _reserve(budget, priority):
+    fraction = PRIORITY_RESERVE.get(priority, PRIORITY_RESERVE["normal"])
+    return math.floor(budget["burst"] * fraction), math.floor(budget["daily"] * fraction)
+
+
+def _take(provider, budget, cost, priority):
+    global _script
+    reserve, daily_reserve = _reserve(budget, priority)
+
+    client = get_redis()
+    if client is not None:
+        try:
+            if _script is None:
+                _script = client.register_script(_TOKEN_BUCKET_SCRIPT)
+            day = datetime.now(timezone.utc).strftime("%Y%m%d")
+            granted, wait = _script(
+                keys=[f"rr:budget:{provider}", f"rr:budget:{provider}:day:{day}"],
+                args=[budget["burst"], budget["rate"], cost, reserve, budget["daily"], daily_reserve],
+            )
+            return bool(int(granted)), float(wait)
+        except Exception as exc:
+            mark_redis_down(exc)
+    return _local_take(provider, budget, cost, reserve, daily_reserve)
+
+
+@contextmanager
+def priority_cap(priority):
+    """
+    Caps the priority of every acquire() made inside the block, so background
+    work going through the live code paths can't use live traffic's reserve.
+    """
+    token = _priority_cap.set(priority)
+    try:
+        yield
+    finally:
+        _priority_cap.reset(token)
+
+
+def _capped_priority(priority):
+    cap = _priority_cap.get()
+    if cap is None:
+        return priority
+    reserve = PRIORITY_RESERVE.get(priority, PRIORITY_RESERVE["normal"])
+    cap_reserve = PRIORITY_RESERVE.get(cap, PRIORITY_RESERVE["normal"])
+    return cap if cap_reserve > reserve else priority
+
+
+def max_cost(provider, priority="normal"):
+    """
+    Largest cost a single acquire() can be granted at this priority (the
+    bucket minus the priority's reserve), or None for unbudgeted providers.
+    Batched calls are split into requests of at most this size.
+    """
+    budget = PROVIDER_BUDGETS.get(provider)
+    if budget is None or budget["rate"] <= 0:
+        return None
+    reserve, _ = _reserve(budget, _capped_priority(priority))
+    return max(1, int(budget["burst"] - reserve))
+
+
+def acquire(provider, priority="normal", cost=1, max_wait=0.0):
+    """
+    Take `cost` request tokens from the provider's shared budget.
+    Blocks up to max_wait seconds for the bucket to refill. Returns False when
+    the budget can't cover the request, in which case the caller should use
+    cached data or skip the provider. A cost above max_cost() never fits
+    and is refused at once.
+    """
+    budget = PROVIDER_BUDGETS.get(provider)
+    if budget is None or budget["rate"] <= 0:
+        return True
+    if cost > max_cost(provider, priority):
+        return False
+    priority = _capped_priority(priority)
+
+    deadline = time.monotonic() + max_wait
+    while True:
+        granted, wait = _take(provider, budget, cost, priority)
+        if granted:
+            return True
+        if wait < 0 or time.monotonic() + wait > deadline:
+            return False
+        time.sleep(wait)
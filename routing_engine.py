@@ -0,0 +1,127 @@
+"""
+In-process routing over graph_store regions.
+
+Bidirectional A* on the CSR arrays, with a haversine / top speed lower bound
+as the heuristic. Both searches use the averaged potential
+p(v) = (h_to_dest(v) - h_from_orig(v)) / 2, which keeps them consistent with
+each other so the search can stop as soon as the two frontiers' best keys
+add up to the best path found.
+"""
+import heapq
+import math
+
+import numpy as np
+
+import graph_store
+
+EARTH_RADIUS_M = 6371000.0
+
+
+def _max_speed(region):
+    """Fastest edge speed in m/s, which keeps the heuristic admissible."""
+    max_speed = region.get("max_speed")
+    if max_speed is None:
+        speeds = np.asarray(region["length"], dtype=np.float64) / np.asarray(region["travel_time"], dtype=np.float64)
+        max_speed = float(speeds.max()) if len(speeds) else 1.0
+        region["max_speed"] = max(max_speed, 1.0)
+    return region["max_speed"]
+
+
+def bidirectional_astar(region, orig, dest):
+    """
+    Fastest path between two node indexes of a region.
+    Returns the list of node indexes, or None when dest is unreachable.
+    """
+    if orig == dest:
+        return [orig]
+
+    node_lat = region["node_lat"]
+    node_lon = region["node_lon"]
+    # Seconds per radian of great-circle distance at top speed, halved for
+    # the averaged potential
+    scale = EARTH_RADIUS_M / _max_speed(region)
+    orig_lat, orig_lon = math.radians(node_lat[orig]), math.radians(node_lon[orig])
+    dest_lat, dest_lon = math.radians(node_lat[dest]), math.radians(node_lon[dest])
+    cos_orig, cos_dest = math.cos(orig_lat), math.cos(dest_lat)
+    sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+
+    potentials = {}
+
+    def potential(node):
+        value = potentials.get(node)
+        if value is None:
+            lat, lon = math.radians(node_lat[node]), math.radians(node_lon[node])
+            cos_lat = cos(lat)
+            to_dest = sin((dest_lat - lat) / 2) ** 2 + cos_lat * cos_dest * sin((dest_lon - lon) / 2) ** 2
+            from_orig = sin((lat - orig_lat) / 2) ** 2 + cos_lat * cos_orig * sin((lon - orig_lon) / 2) ** 2
+            value = scale * (asin(sqrt(min(1.0, to_dest))) - asin(sqrt(min(1.0, from_orig))))
+            potentials[node] = value
+        return value
+
+    # Index 0 is the forward search from orig, 1 the backward one from dest
+    graphs = (
+        (region["indptr"], region["targets"], region["travel_time"]),
+        (region["rev_indptr"], region["rev_sources"], region["rev_travel_time"]),
+    )
+    signs = (1.0, -1.0)
+    dist = ({orig: 0.0}, {dest: 0.0})
+    parent = ({orig: -1}, {dest: -1})
+    settled = (set(), set())
+    heaps = ([(potential(orig), orig)], [(-potential(dest), dest)])
+
+    best = math.inf
+    meeting = -1
+    while heaps[0] and heaps[1]:
+        if heaps[0][0][0] + heaps[1][0][0] >= best:
+            break
+        side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+        _, node = heapq.heappop(heaps[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+
+        indptr, neighbors, weights = graphs[side]
+        start, end = int(indptr[node]), int(indptr[node + 1])
+        side_dist = dist[side]
+        other_dist = dist[1 - side]
+        node_dist = side_dist[node]
+        for neighbor, weight in zip(neighbors[start:end].tolist(), weights[start:end].tolist()):
+            new_dist = node_dist + weight
+            if new_dist < side_dist.get(neighbor, math.inf):
+                side_dist[neighbor] = new_dist
+                parent[side][neighbor] = node
+                heapq.heappush(heaps[side], (new_dist + signs[side] * potential(neighbor), neighbor))
+            if neighbor in other_dist and side_dist[neighbor] + other_dist[neighbor] < best:
+                best = side_dist[neighbor] + other_dist[neighbor]
+                meeting = neighbor
+
+    if meeting < 0:
+        return None
+
+    path = []
+    node = meeting
+    while node != -1:
+        path.append(node)
+        node = parent[0][node]
+    path.reverse()
+    node = parent[1][meeting]
+    while node != -1:
+        path.append(node)
+        node = parent[1][node]
+    return path
+
+
+def get_local_route(start_latlng, end_latlng):
+    """
+    Routes between two points over the stored region that covers them.
+    Returns the same route_points/duration/distance dict as the OSRM and
+    Valhalla parsers, or None when no stored region covers both points.
+    """
+    region = graph_store.find_region(start_latlng, end_latlng)
+    if region is None:
+        return None
+    orig_node, dest_node = graph_store.snap_points(region, [start_latlng[:2], end_latlng[:2]]).tolist()
+    path = bidirectional_astar(region, orig_node, dest_node)
+    if path is None:
+        raise RuntimeError("Nao existe rota entre os pontos na regiao armazenada.")
+    return graph_store.path_summary(region, path)
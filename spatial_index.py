@@ -0,0 +1,50 @@
+"""
+Nearest-node snapping with a BallTree over node coordinates.
+
+The tree is built once per graph (cached per networkx graph object, and
+persisted next to graph_store regions) instead of being rebuilt by every
+ox.nearest_nodes call, and many points can be snapped in one vectorized query.
+"""
+import weakref
+
+import numpy as np
+
+# networkx graph -> (node ids, tree), dropped together with the graph
+_graph_indexes = weakref.WeakKeyDictionary()
+
+
+def build_index(lats, lons):
+    """BallTree with the haversine metric over (lat, lon) in degrees."""
+    from sklearn.neighbors import BallTree
+
+    coords = np.radians(np.column_stack((np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))))
+    return BallTree(coords, metric="haversine")
+
+
+def query_index(tree, latlngs):
+    """
+    Snaps many (lat, lon) points in one query.
+    Returns (positions, distances_m) as arrays, one entry per point.
+    """
+    points = np.radians(np.asarray(latlngs, dtype=np.float64).reshape(-1, 2)[:, :2])
+    distances, positions = tree.query(points, k=1)
+    return positions[:, 0], distances[:, 0] * 6371000.0
+
+
+def graph_node_index(graph):
+    """Returns (node_ids, tree) for an osmnx graph, building it on first use."""
+    cached = _graph_indexes.get(graph)
+    if cached is None:
+        node_ids = np.fromiter(graph.nodes, dtype=np.int64, count=graph.number_of_nodes())
+        lats = [graph.nodes[node]["y"] for node in node_ids.tolist()]
+        lons = [graph.nodes[node]["x"] for node in node_ids.tolist()]
+        cached = (node_ids, build_index(lats, lons))
+        _graph_indexes[graph] = cached
+    return cached
+
+
+def snap_to_graph(graph, latlngs):
+    """OSM node ids of the graph nodes nearest to each (lat, lon) point."""
+    node_ids, tree = graph_node_index(graph)
+    positions, _ = query_index(tree, latlngs)
+    return node_ids[positions].tolist()
@@ -0,0 +1,195 @@
+"""
+Low-bandwidth static map images.
+
+Draws the same segment data as faster_rainy_road.render_map into a small
+WebP/PNG sized for phone screens: rain colored route, endpoint markers and
+a color legend, with no JavaScript, CSS or tile requests on the client. The
+background comes from basemap tiles cached in STATIC_MAP_TILE_DIR
+(z/x/y.png, optionally filled from STATIC_MAP_TILE_URL) and falls back to a
+plain background when tiles are missing.
+"""
+import io
+import math
+import os
+
+import requests
+
+from utils import get_rain_color
+
+STATIC_MAP_ENABLED = os.getenv("STATIC_MAP_ENABLED", "True").lower() in ("true", "1", "yes")
+STATIC_MAP_FORMAT = os.getenv("STATIC_MAP_FORMAT", "webp").lower()
+STATIC_MAP_WIDTH = int(os.getenv("STATIC_MAP_WIDTH", "480"))
+STATIC_MAP_HEIGHT = int(os.getenv("STATIC_MAP_HEIGHT", "640"))
+STATIC_MAP_QUALITY = int(os.getenv("STATIC_MAP_QUALITY", "60"))
+STATIC_MAP_TILE_DIR = os.getenv("STATIC_MAP_TILE_DIR", "tiles")
+# e.g. https://a.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png; empty never downloads
+STATIC_MAP_TILE_URL = os.getenv("STATIC_MAP_TILE_URL", "")
+STATIC_MAP_ATTRIBUTION = os.getenv("STATIC_MAP_ATTRIBUTION", "(c) OpenStreetMap (c) CARTO")
+
+TILE_SIZE = 256
+MAX_ZOOM = 16
+PADDING = 36
+BACKGROUND = (242, 239, 233)
+UNRESOLVED_COLOR = "#9e9e9e"
+# Upper bounds of the get_rain_color classes, in mm/h
+LEGEND_STEPS = [(0.2, "0.2"), (0.5, "0.5"), (1.5, "1.5"), (3.0, "3"), (99.0, "+")]
+
+MIME_TYPES = {"webp": "image/webp", "png": "image/png"}
+
+
+def _world_pixels(points, zoom):
+    """Web Mercator pixel coordinates of (lat, lon) points at a (fractional) zoom."""
+    import numpy as np
+
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    scale = TILE_SIZE * 2.0 ** zoom
+    lat = np.radians(np.clip(points[:, 0], -85.05112878, 85.05112878))
+    x = (points[:, 1] + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / math.pi) / 2.0 * scale
+    return np.column_stack((x, y))
+
+
+def _fit_zoom(points, width, height):
+    """Largest zoom at which the points fit inside the image minus padding."""
+    import numpy as np
+
+    pixels = _world_pixels(points, 0)
+    span_x = max(np.ptp(pixels[:, 0]), 1e-9)
+    span_y = max(np.ptp(pixels[:, 1]), 1e-9)
+    zoom = math.log2(min((width - 2 * PADDING) / span_x, (height - 2 * PADDING) / span_y))
+    return max(0.0, min(zoom, MAX_ZOOM))
+
+
+def _load_tile(z, x, y):
+    from PIL import Image
+
+    path = os.path.join(STATIC_MAP_TILE_DIR, str(z), str(x), f"{y}.png")
+    if not os.path.isfile(path):
+        if not STATIC_MAP_TILE_URL:
+            return None
+        try:
+            response = requests.get(STATIC_MAP_TILE_URL.format(z=z, x=x, y=y), timeout=5, headers={"User-Agent": "rainy-road"})
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            print(f"Warning: tile {z}/{x}/{y} indisponivel - {exc}")
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(response.content)
+    try:
+        return Image.open(path).convert("RGB")
+    except OSError:
+        return None
+
+
+def _draw_basemap(image, zoom, origin):
+    """Pastes the cached tiles covering the image. Returns False if any is missing."""
+    n = 2 ** zoom
+    first_x, first_y = int(origin[0] // TILE_SIZE), int(origin[1] // TILE_SIZE)
+    last_x = int((origin[0] + image.width) // TILE_SIZE)
+    last_y = int((origin[1] + image.height) // TILE_SIZE)
+    tiles = []
+    for tile_x in range(first_x, last_x + 1):
+        for tile_y in range(max(0, first_y), min(n - 1, last_y) + 1):
+            tile = _load_tile(zoom, tile_x % n, tile_y)
+            if tile is None:
+                return False
+            tiles.append((tile, tile_x, tile_y))
+    for tile, tile_x, tile_y in tiles:
+        image.paste(tile, (int(tile_x * TILE_SIZE - origin[0]), int(tile_y * TILE_SIZE - origin[1])))
+    return True
+
+
+def _screen_line(pixels):
+    """Pixel path as a flat list with consecutive duplicates (same pixel) removed."""
+    import numpy as np
+
+    rounded = np.round(pixels).astype(np.int64)
+    if len(rounded) > 1:
+        keep = np.concatenate(([True], np.any(np.diff(rounded, axis=0) != 0, axis=1)))
+        keep[-1] = True
+        rounded = rounded[keep]
+    return [tuple(point) for point in rounded.tolist()]
+
+
+def _draw_marker(draw, center, color):
+    x, y = center
+    draw.ellipse((x - 9, y - 9, x + 9, y + 9), fill="white")
+    draw.ellipse((x - 6, y - 6, x + 6, y + 6), fill=color)
+
+
+def _draw_legend(draw, width, height):
+    box_width = 26
+    left = width - len(LEGEND_STEPS) * box_width - 10
+    top = height - 40
+    draw.rectangle((left - 6, top - 6, width - 4, height - 4), fill="white")
+    draw.text((left, top - 2), "mm/h", fill="black")
+    for i, (volume, label) in enumerate(LEGEND_STEPS):
+        x = left + i * box_width
+        draw.rectangle((x, top + 10, x + box_width - 2, top + 18), fill=get_rain_color(volume))
+        draw.text((x, top + 20), label, fill="black")
+
+
+def render_static_map(route_points, segment_data, start_latlng, end_latlng, width=None, height=None, image_format=None):
+    """
+    Encoded image (bytes) of the route. segment_data is what
+    faster_rainy_road.build_segments returns for render_map.
+    """
+    # numpy and PIL are imported here so the web process stays lean
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    width = width or STATIC_MAP_WIDTH
+    height = height or STATIC_MAP_HEIGHT
+    image_format = (image_format or STATIC_MAP_FORMAT).lower()
+
+    route = np.asarray(route_points, dtype=np.float64).reshape(-1, 2)
+    endpoints = np.array([start_latlng[:2], end_latlng[:2]], dtype=np.float64)
+    bounds = np.vstack((route, endpoints)) if len(route) else endpoints
+
+    image = Image.new("RGB", (width, height), BACKGROUND)
+    zoom = _fit_zoom(bounds, width, height)
+    # Tiles only exist for whole zoom levels
+    tile_zoom = int(math.floor(zoom))
+    pixels = _world_pixels(bounds, tile_zoom)
+    center = (pixels.min(axis=0) + pixels.max(axis=0)) / 2
+    origin = center - (width / 2, height / 2)
+    has_tiles = (STATIC_MAP_TILE_URL or os.path.isdir(os.path.join(STATIC_MAP_TILE_DIR, str(tile_zoom)))) and _draw_basemap(
+        image, tile_zoom, origin
+    )
+    if not has_tiles:
+        # Plain background: use the exact zoom so the route fills the image
+        image.paste(BACKGROUND, (0, 0, width, height))
+        tile_zoom = zoom
+        pixels = _world_pixels(bounds, zoom)
+        origin = (pixels.min(axis=0) + pixels.max(axis=0)) / 2 - (width / 2, height / 2)
+
+    def to_screen(points):
+        return _world_pixels(points, tile_zoom) - origin
+
+    draw = ImageDraw.Draw(image)
+    lines = [(_screen_line(to_screen(segment["coords"])), segment) for segment in segment_data if len(segment["coords"]) > 1]
+    # White casing under the whole route keeps the colors readable on any background
+    for line, _ in lines:
+        if len(line) > 1:
+            draw.line(line, fill="white", width=9, joint="curve")
+    for line, segment in lines:
+        if len(line) < 2:
+            continue
+        color = UNRESOLVED_COLOR if segment.get("unresolved") else get_rain_color(segment["volume"])
+        draw.line(line, fill=color, width=5, joint="curve")
+
+    start_point, end_point = (tuple(point) for point in np.round(to_screen(endpoints)).astype(int).tolist())
+    _draw_marker(draw, start_point, "#2a81cb")
+    _draw_marker(draw, end_point, "#cb2b3e")
+    _draw_legend(draw, width, height)
+    if has_tiles:
+        draw.text((6, height - 14), STATIC_MAP_ATTRIBUTION, fill=(90, 90, 90))
+
+    output = io.BytesIO()
+    if image_format == "png":
+        # A small palette keeps PNGs in the same size range as WebP
+        image.quantize(colors=64).save(output, format="PNG", optimize=True)
+    else:
+        image.save(output, format="WEBP", quality=STATIC_MAP_QUALITY, method=6)
+    return output.getvalue()
@@ -0,0 +1,59 @@
+import random
+
+import numpy as np
+import polyline
+import pytest
+
+from polyline_codec import decode_polyline, encode_polyline
+
+PRECISIONS = (5, 6)
+
+
+def _random_route(rng, count, lat_range=(-85.0, 85.0), lon_range=(-180.0, 180.0)):
+    return [(rng.uniform(*lat_range), rng.uniform(*lon_range)) for _ in range(count)]
+
+
+def _routes():
+    rng = random.Random(42)
+    return {
+        "single point": [(-3.7319, -38.5267)],
+        "fortaleza sobral": [(-3.7319, -38.5267), (-3.6880, -40.3497), (-3.6881, -40.3498)],
+        "negative coordinates": _random_route(rng, 200, (-60.0, -0.001), (-179.0, -0.001)),
+        "crossing zero": [(-0.000004, -0.000004), (0.0, 0.0), (0.000004, 0.000004), (-1e-6, 1e-6)],
+        "antimeridian": [(-16.5, 179.99999), (-16.6, -179.99999), (-16.7, 179.5), (-16.8, -180.0), (-16.9, 180.0)],
+        "random": _random_route(rng, 500),
+    }
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+@pytest.mark.parametrize("name", list(_routes()))
+def test_encode_matches_polyline(name, precision):
+    route = _routes()[name]
+    assert encode_polyline(route, precision) == polyline.encode(route, precision)
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+@pytest.mark.parametrize("name", list(_routes()))
+def test_decode_matches_polyline(name, precision):
+    encoded = polyline.encode(_routes()[name], precision)
+    expected = np.asarray(polyline.decode(encoded, precision), dtype=np.float64)
+    np.testing.assert_allclose(decode_polyline(encoded, precision), expected, rtol=0, atol=0.5 / 10**precision)
+
+
+@pytest.mark.parametrize("precision", PRECISIONS)
+@pytest.mark.parametrize("name", list(_routes()))
+def test_round_trip(name, precision):
+    route = np.asarray(_routes()[name])
+    decoded = decode_polyline(encode_polyline(route, precision), precision)
+    np.testing.assert_allclose(decoded, route, rtol=0, atol=0.5 / 10**precision + 1e-12)
+
+
+def test_empty():
+    assert encode_polyline([], 6) == ""
+    assert decode_polyline("", 6).shape == (0, 2)
+
+
+def test_odd_value_count_is_rejected():
+    # A lone latitude, with no longitude to pair it with
+    with pytest.raises(ValueError):
+        decode_polyline(polyline.encode([(1.0, 0.0)], 6)[:-1], 6)
@@ -0,0 +1,85 @@
+import math
+import random
+
+import networkx as nx
+import pytest
+
+from graph_store import graph_to_csr
+from routing_engine import EARTH_RADIUS_M, bidirectional_astar
+
+
+def _haversine_m(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def _random_graph(seed, node_count=60, edge_count=180):
+    """
+    A small osmnx-like MultiDiGraph around Fortaleza. Edges are never shorter
+    than the straight line between their nodes, as on real roads, and some
+    are one-way or parallel.
+    """
+    rng = random.Random(seed)
+    graph = nx.MultiDiGraph()
+    for node in range(node_count):
+        graph.add_node(1000 + node, y=-3.7 + rng.uniform(-0.1, 0.1), x=-38.5 + rng.uniform(-0.1, 0.1))
+    nodes = list(graph.nodes)
+    for _ in range(edge_count):
+        u, v = rng.sample(nodes, 2)
+        straight = _haversine_m(graph.nodes[u]["y"], graph.nodes[u]["x"], graph.nodes[v]["y"], graph.nodes[v]["x"])
+        length = straight * rng.uniform(1.0, 1.6)
+        speed = rng.choice((8.3, 11.1, 22.2, 27.8))  # 30 to 100 km/h
+        graph.add_edge(u, v, length=length, travel_time=length / speed)
+        if rng.random() < 0.6:
+            graph.add_edge(v, u, length=length, travel_time=length / speed)
+    return graph
+
+
+def _csr_digraph(region):
+    """The region's edges as a networkx DiGraph with the same float32 weights."""
+    digraph = nx.DiGraph()
+    digraph.add_nodes_from(range(len(region["node_ids"])))
+    for u in range(len(region["node_ids"])):
+        for edge in range(int(region["indptr"][u]), int(region["indptr"][u + 1])):
+            digraph.add_edge(u, int(region["targets"][edge]), weight=float(region["travel_time"][edge]))
+    return digraph
+
+
+def _path_cost(digraph, path):
+    assert all(digraph.has_edge(u, v) for u, v in zip(path[:-1], path[1:]))
+    return sum(digraph[u][v]["weight"] for u, v in zip(path[:-1], path[1:]))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_astar_matches_networkx(seed):
+    region = graph_to_csr(_random_graph(seed))
+    digraph = _csr_digraph(region)
+    rng = random.Random(seed)
+    node_count = len(region["node_ids"])
+    for _ in range(25):
+        orig, dest = rng.randrange(node_count), rng.randrange(node_count)
+        path = bidirectional_astar(region, orig, dest)
+        if not nx.has_path(digraph, orig, dest):
+            assert path is None
+            continue
+        assert path[0] == orig and path[-1] == dest
+        expected = nx.shortest_path_length(digraph, orig, dest, weight="weight")
+        assert _path_cost(digraph, path) == pytest.approx(expected, rel=1e-6, abs=1e-6)
+
+
+def test_same_node():
+    region = graph_to_csr(_random_graph(0))
+    assert bidirectional_astar(region, 3, 3) == [3]
+
+
+def test_parallel_edges_keep_the_fastest():
+    graph = nx.MultiDiGraph()
+    graph.add_node(1, y=-3.70, x=-38.50)
+    graph.add_node(2, y=-3.71, x=-38.50)
+    graph.add_edge(1, 2, length=1500.0, travel_time=150.0)
+    graph.add_edge(1, 2, length=1200.0, travel_time=60.0)
+    region = graph_to_csr(graph)
+    assert bidirectional_astar(region, 0, 1) == [0, 1]
+    assert float(region["travel_time"][0]) == 60.0
+    assert bidirectional_astar(region, 1, 0) is None
@@ -0,0 +1,209 @@
+"""
+Watched commuter routes.
+
+Users register a route (origin, destination, mode and usual departure time,
+BRT) and a beat task re-evaluates every watched route in one pass: places
+and routes are deduplicated and come from the geocode/route caches, and the
+weather samples of all routes are merged so each grid cell is fetched once
+and read at every arrival time that falls in it
+(faster_rainy_road.evaluate_routes_weather). Each route keeps the rain class
+(get_rain_color) of its segments from the last evaluation; a new result is
+stored and published on WATCHLIST_CHANNEL only when some segment's class
+changes, so unchanged routes cost no writes.
+"""
+import json
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from cache import get_redis, mark_redis_down
+from utils import get_rain_color
+
+WATCHLIST_ENABLED = os.getenv("WATCHLIST_ENABLED", "False").lower() in ("true", "1", "yes")
+WATCHLIST_INTERVAL_MINUTES = int(os.getenv("WATCHLIST_INTERVAL_MINUTES", "30"))
+WATCHLIST_MAX_ROUTES = int(os.getenv("WATCHLIST_MAX_ROUTES", "10000"))
+WATCHLIST_PRIORITY = os.getenv("WATCHLIST_PRIORITY", "low")
+# Redis pub/sub channel receiving one JSON message per changed route
+WATCHLIST_CHANNEL = os.getenv("WATCHLIST_CHANNEL", "rr:watchlist:changes")
+
+_ROUTES_KEY = "rr:watch:routes"
+_STATE_KEY = "rr:watch:state"
+_RESULT_KEY = "rr:watch:result"
+BRT = timezone(timedelta(hours=-3))
+
+
+class WatchlistUnavailable(RuntimeError):
+    """Redis, where watched routes live, can't be reached."""
+
+
+def _client():
+    client = get_redis()
+    if client is None:
+        raise WatchlistUnavailable("Lista de rotas indisponivel no momento.")
+    return client
+
+
+def _loads(raw):
+    return json.loads(raw.decode() if isinstance(raw, bytes) else raw) if raw is not None else None
+
+
+def parse_departure(value):
+    """'HH:MM' (BRT) normalized, or ValueError."""
+    try:
+        hour, minute = (int(part) for part in str(value).strip().split(":"))
+    except ValueError:
+        raise ValueError("departure deve estar no formato HH:MM") from None
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError("departure deve estar no formato HH:MM")
+    return f"{hour:02d}:{minute:02d}"
+
+
+def departure_offset(departure, now=None):
+    """Minutes from now until the next `departure` (BRT), today or tomorrow."""
+    now = (now or datetime.now(timezone.utc)).astimezone(BRT)
+    hour, minute = (int(part) for part in departure.split(":"))
+    leave = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if leave < now:
+        leave += timedelta(days=1)
+    return (leave - now).total_seconds() / 60
+
+
+def add_watch(start, end, travel_mode, departure):
+    """Registers a route and returns its id. Raises ValueError when the list is full."""
+    client = _client()
+    watch = {
+        "watch_id": uuid.uuid4().hex,
+        "start": start,
+        "end": end,
+        "travel_mode": travel_mode,
+        "departure": parse_departure(departure),
+        "created_at": int(time.time()),
+    }
+    try:
+        if client.hlen(_ROUTES_KEY) >= WATCHLIST_MAX_ROUTES:
+            raise ValueError(f"No maximo {WATCHLIST_MAX_ROUTES} rotas monitoradas.")
+        client.hset(_ROUTES_KEY, watch["watch_id"], json.dumps(watch))
+    except ValueError:
+        raise
+    except Exception as exc:
+        mark_redis_down(exc)
+        raise WatchlistUnavailable("Lista de rotas indisponivel no momento.") from exc
+    return watch["watch_id"]
+
+
+def get_watch(watch_id):
+    """(watch, last published result) or (None, None) when unknown."""
+    client = _client()
+    try:
+        pipe = client.pipeline()
+        pipe.hget(_ROUTES_KEY, watch_id)
+        pipe.hget(_RESULT_KEY, watch_id)
+        watch, result = pipe.execute()
+    except Exception as exc:
+        mark_redis_down(exc)
+        raise WatchlistUnavailable("Lista de rotas indisponivel no momento.") from exc
+    return _loads(watch), _loads(result)
+
+
+def remove_watch(watch_id):
+    """Forgets the route and its state. Returns False when it wasn't watched."""
+    client = _client()
+    try:
+        pipe = client.pipeline()
+        pipe.hdel(_ROUTES_KEY, watch_id)
+        pipe.hdel(_STATE_KEY, watch_id)
+        pipe.hdel(_RESULT_KEY, watch_id)
+        removed = pipe.execute()[0]
+    except Exception as exc:
+        mark_redis_down(exc)
+        raise WatchlistUnavailable("Lista de rotas indisponivel no momento.") from exc
+    return bool(removed)
+
+
+def all_watches():
+    """Every watched route, or [] while Redis is unavailable."""
+    client = get_redis()
+    if client is None:
+        return []
+    try:
+        raw = client.hvals(_ROUTES_KEY)
+    except Exception as exc:
+        mark_redis_down(exc)
+        return []
+    return [_loads(value) for value in raw]
+
+
+def load_states(watch_ids):
+    """{watch_id: state of the last evaluation} for the given routes."""
+    client = get_redis()
+    if client is None or not watch_ids:
+        return {}
+    try:
+        raw = client.hmget(_STATE_KEY, watch_ids)
+    except Exception as exc:
+        mark_redis_down(exc)
+        return {}
+    return {watch_id: _loads(value) for watch_id, value in zip(watch_ids, raw) if value is not None}
+
+
+def _has_answer(status):
+    # "N/A" is the placeholder dry status of a sample no provider answered
+    return bool(status) and not status.get("unresolved") and status.get("provider") != "N/A"
+
+
+def rain_classes(statuses):
+    """Rain class (color) per sample; None where the sample has no answer."""
+    return [get_rain_color(status["volume"]) if _has_answer(status) else None for status in statuses]
+
+
+def class_changes(samples, statuses, state):
+    """
+    Compares an evaluation with the route's stored state. Returns the new
+    classes and the sample segments (from the previous sample's index to
+    this one's) whose class changed. Samples without an answer keep their previous class, and
+    a different sample plan (the route changed) compares against nothing.
+    """
+    indexes = [sample["index"] for sample in samples]
+    previous = state["classes"] if state and state.get("indexes") == indexes else [None] * len(samples)
+    classes = []
+    changed = []
+    previous_index = 0
+    for segment, (sample, status, old, new) in enumerate(zip(samples, statuses, previous, rain_classes(statuses))):
+        classes.append(new or old)
+        if new and new != old:
+            changed.append({
+                "segment": segment,
+                "start_index": previous_index,
+                "end_index": sample["index"],
+                "color": new,
+                "previous_color": old,
+                "volume": status["volume"],
+                "prob": status["prob"],
+                "time": status["time"],
+                "is_rainy": status["is_rainy"],
+            })
+        previous_index = sample["index"]
+    return {"indexes": indexes, "classes": classes}, changed
+
+
+def publish_changes(updates):
+    """
+    Stores the new state and result of each changed route and publishes the
+    results, all in one pipeline. updates: [(watch_id, state, result)].
+    """
+    client = get_redis()
+    if client is None or not updates:
+        return 0
+    try:
+        pipe = client.pipeline(transaction=False)
+        for watch_id, state, result in updates:
+            message = json.dumps(result)
+            pipe.hset(_STATE_KEY, watch_id, json.dumps(state))
+            pipe.hset(_RESULT_KEY, watch_id, message)
+            pipe.publish(WATCHLIST_CHANNEL, message)
+        pipe.execute()
+    except Exception as exc:
+        mark_redis_down(exc)
+        return 0
+    return len(updates)
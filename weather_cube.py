@@ -0,0 +1,230 @@
+"""
+Regional precipitation cube.
+
+A Celery beat job periodically fetches Open-Meteo hourly precipitation and
+precipitation probability for every point of a regular grid and stores them
+as lat x lon x hour float32 arrays. Workers memory-map the arrays and answer
+weather samples inside the grid with bilinear (space) and linear (time)
+interpolation, without any outbound call.
+"""
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import requests
+
+from cache import get_redis, mark_redis_down
+from rate_budget import acquire, max_cost
+
+WEATHER_CUBE_DIR = os.getenv("WEATHER_CUBE_DIR", "weather_cube")
+# south,north,west,east in degrees; defaults to the Brazilian Northeast
+WEATHER_CUBE_BBOX = os.getenv("WEATHER_CUBE_BBOX", "-18.5,-1.0,-48.5,-34.5")
+WEATHER_CUBE_STEP = float(os.getenv("WEATHER_CUBE_STEP", "0.5"))
+WEATHER_CUBE_REFRESH_MINUTES = int(os.getenv("WEATHER_CUBE_REFRESH_MINUTES", "180"))
+# Open-Meteo locations per request
+WEATHER_CUBE_BATCH = 100
+
+# Each refresh writes a new version directory inside WEATHER_CUBE_DIR and
+# then atomically points CURRENT_FILE at it. The directory itself is never
+# renamed, so it can be a bind mount shared by every container.
+CURRENT_FILE = "CURRENT"
+# Versions kept besides the current one, for workers still reading them
+KEEP_OLD_VERSIONS = 1
+
+_cube = None
+_cube_version = None
+
+
+def get_grid():
+    """Returns (lats, lons) of the configured grid as 1-D arrays."""
+    south, north, west, east = (float(value) for value in WEATHER_CUBE_BBOX.split(","))
+    lats = np.arange(south, north + WEATHER_CUBE_STEP / 2, WEATHER_CUBE_STEP)
+    lons = np.arange(west, east + WEATHER_CUBE_STEP / 2, WEATHER_CUBE_STEP)
+    return lats, lons
+
+
+def _fetch_batch(lats, lons):
+    lat_param = ",".join(f"{lat:.4f}" for lat in lats)
+    lon_param = ",".join(f"{lon:.4f}" for lon in lons)
+    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat_param}&longitude={lon_param}&hourly=precipitation_probability,precipitation&forecast_days=2&timezone=GMT"
+    resp = requests.get(url, timeout=30)
+    resp.raise_for_status()
+    data = resp.json()
+    return [data] if isinstance(data, dict) else data
+
+
+def _hour_epoch(time_str):
+    return datetime.strptime(time_str, "%Y-%m-%dT%H:%M").replace(tzinfo=timezone.utc).timestamp()
+
+
+def build_cube():
+    """
+    Fetches the whole grid and writes a new cube. Returns its meta dict, or
+    None when the Open-Meteo budget can't cover a full refresh (the previous
+    cube is then kept).
+    """
+    lats, lons = get_grid()
+    grid_lats, grid_lons = np.meshgrid(lats, lons, indexing="ij")
+    flat_lats, flat_lons = grid_lats.ravel(), grid_lons.ravel()
+
+    precip = None
+    prob = None
+    start_epoch = None
+    # Each point costs one token, and a batch can't exceed the usable bucket
+    batch_size = min(WEATHER_CUBE_BATCH, max_cost("open_meteo", "low") or WEATHER_CUBE_BATCH)
+    for offset in range(0, len(flat_lats), batch_size):
+        batch_lats = flat_lats[offset : offset + batch_size]
+        batch_lons = flat_lons[offset : offset + batch_size]
+        # Background refreshes must leave the live traffic's share untouched
+        if not acquire("open_meteo", priority="low", cost=len(batch_lats), max_wait=60):
+            print("Warning: orcamento de open_meteo insuficiente para atualizar o cubo regional")
+            return None
+        for i, point in enumerate(_fetch_batch(batch_lats, batch_lons)):
+            hourly = point.get("hourly", {})
+            times = hourly.get("time", [])
+            if precip is None:
+                start_epoch = _hour_epoch(times[0])
+                precip = np.full((len(flat_lats), len(times)), np.nan, dtype=np.float32)
+                prob = np.full((len(flat_lats), len(times)), np.nan, dtype=np.float32)
+            hours = min(len(times), precip.shape[1])
+            precip[offset + i, :hours] = np.array(hourly.get("precipitation", [])[:hours], dtype=np.float32)
+            prob[offset + i, :hours] = np.array(hourly.get("precipitation_probability", [])[:hours], dtype=np.float32)
+
+    shape = (len(lats), len(lons), precip.shape[1])
+    meta = {
+        "south": float(lats[0]),
+        "west": float(lons[0]),
+        "step": WEATHER_CUBE_STEP,
+        "shape": list(shape),
+        "start_epoch": start_epoch,
+        "built_at": int(time.time()),
+    }
+    _save_cube(precip.reshape(shape), prob.reshape(shape), meta)
+    return meta
+
+
+def _current_version():
+    """Name of the version directory CURRENT_FILE points at, or None."""
+    try:
+        with open(os.path.join(WEATHER_CUBE_DIR, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _save_cube(precip, prob, meta):
+    """Writes a new version directory and atomically points CURRENT_FILE at it."""
+    version = f"v{time.time_ns()}-{os.getpid()}"
+    version_dir = os.path.join(WEATHER_CUBE_DIR, version)
+    os.makedirs(version_dir, exist_ok=True)
+    np.save(os.path.join(version_dir, "precipitation.npy"), precip)
+    np.save(os.path.join(version_dir, "probability.npy"), prob)
+    with open(os.path.join(version_dir, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+    # A rename inside the same directory is atomic, even on a bind mount
+    pointer_tmp = os.path.join(WEATHER_CUBE_DIR, f".{CURRENT_FILE}.tmp-{os.getpid()}")
+    with open(pointer_tmp, "w") as f:
+        f.write(version)
+    os.replace(pointer_tmp, os.path.join(WEATHER_CUBE_DIR, CURRENT_FILE))
+    _remove_old_versions(version)
+
+
+def _remove_old_versions(current):
+    versions = sorted(
+        (entry for entry in os.scandir(WEATHER_CUBE_DIR) if entry.is_dir() and entry.name.startswith("v")),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    old = [entry for entry in versions if entry.name != current][KEEP_OLD_VERSIONS:]
+    for entry in old:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def refresh_cube():
+    """Rebuilds the cube unless another worker is already doing it."""
+    client = get_redis()
+    lock_seconds = WEATHER_CUBE_REFRESH_MINUTES * 60
+    if client is not None:
+        try:
+            if not client.set("rr:weather_cube:lock", os.getpid(), nx=True, ex=lock_seconds):
+                return None
+        except Exception as exc:
+            mark_redis_down(exc)
+    try:
+        return build_cube()
+    finally:
+        if client is not None:
+            try:
+                client.delete("rr:weather_cube:lock")
+            except Exception as exc:
+                mark_redis_down(exc)
+
+
+def load_cube():
+    """The current cube (mmapped), reopened when a refresh replaced it. None if absent."""
+    global _cube, _cube_version
+    version = _current_version()
+    if version is None:
+        return None
+    if _cube is None or version != _cube_version:
+        version_dir = os.path.join(WEATHER_CUBE_DIR, version)
+        try:
+            with open(os.path.join(version_dir, "meta.json")) as f:
+                meta = json.load(f)
+            _cube = {
+                "meta": meta,
+                "precipitation": np.load(os.path.join(version_dir, "precipitation.npy"), mmap_mode="r"),
+                "probability": np.load(os.path.join(version_dir, "probability.npy"), mmap_mode="r"),
+            }
+            _cube_version = version
+        except (OSError, ValueError) as exc:
+            print(f"Warning: Could not load weather cube - {exc}")
+            return None
+    return _cube
+
+
+def sample_cube(lats, lons, arrival_epochs):
+    """
+    Interpolates (precipitation mm, probability %) at each point and time.
+    Returns two float arrays; entries outside the cube's area or hours are NaN.
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    precip = np.full(lats.shape, np.nan)
+    prob = np.full(lats.shape, np.nan)
+    cube = load_cube()
+    if cube is None or not len(lats):
+        return precip, prob
+
+    meta = cube["meta"]
+    nlat, nlon, nhours = meta["shape"]
+    fi = (lats - meta["south"]) / meta["step"]
+    fj = (np.asarray(lons, dtype=np.float64) - meta["west"]) / meta["step"]
+    ft = (np.asarray(arrival_epochs, dtype=np.float64) - meta["start_epoch"]) / 3600
+    inside = (fi >= 0) & (fi <= nlat - 1) & (fj >= 0) & (fj <= nlon - 1) & (ft >= 0) & (ft <= nhours - 1)
+    if not inside.any():
+        return precip, prob
+
+    fi, fj, ft = fi[inside], fj[inside], ft[inside]
+    i0 = np.minimum(fi.astype(np.int64), nlat - 2) if nlat > 1 else np.zeros(len(fi), dtype=np.int64)
+    j0 = np.minimum(fj.astype(np.int64), nlon - 2) if nlon > 1 else np.zeros(len(fj), dtype=np.int64)
+    t0 = np.minimum(ft.astype(np.int64), nhours - 2) if nhours > 1 else np.zeros(len(ft), dtype=np.int64)
+    di, dj, dt = fi - i0, fj - j0, ft - t0
+    i1 = np.minimum(i0 + 1, nlat - 1)
+    j1 = np.minimum(j0 + 1, nlon - 1)
+    t1 = np.minimum(t0 + 1, nhours - 1)
+
+    for values, out in ((cube["precipitation"], precip), (cube["probability"], prob)):
+        result = np.zeros(len(fi))
+        for ti, tw in ((t0, 1 - dt), (t1, dt)):
+            result += tw * (
+                (1 - di) * (1 - dj) * values[i0, j0, ti]
+                + (1 - di) * dj * values[i0, j1, ti]
+                + di * (1 - dj) * values[i1, j0, ti]
+                + di * dj * values[i1, j1, ti]
+            )
+        out[inside] = result
+    return precip, prob
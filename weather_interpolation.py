@@ -0,0 +1,93 @@
+"""
+Along-route interpolation between weather samples.
+
+Each sample is a point forecast. Instead of painting the whole span up to a
+sample with that sample's status, precipitation and probability are
+interpolated linearly along the route distance between neighboring samples,
+and the route is cut into sub-segments of about INTERPOLATION_STEP_KM, each
+colored by its own interpolated intensity. No extra provider calls are made.
+"""
+import math
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+
+
+def cumulative_km(route_points):
+    """Distance along the route at each point, in km (vectorized haversine)."""
+    points = np.radians(np.asarray(route_points, dtype=np.float64).reshape(-1, 2))
+    if len(points) < 2:
+        return np.zeros(len(points))
+    lat, lon = points[:, 0], points[:, 1]
+    a = np.sin(np.diff(lat) / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(np.diff(lon) / 2) ** 2
+    steps = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.concatenate(([0.0], np.cumsum(steps)))
+
+
+def interpolate_segments(route_points, samples, statuses, step_km):
+    """
+    Sub-segments of about step_km with interpolated weather, in the same
+    format as faster_rainy_road.build_segments. Cuts always fall on the
+    sample points, and samples without a status are left out. Unresolved
+    samples (no weather before the request deadline) are not interpolated
+    from; sub-segments closest to one are marked "unresolved". A sub-segment
+    is rainy when either sample around it is, as the provider decided it;
+    the blended volume and probability only set its intensity.
+    """
+    known = [(sample, status) for sample, status in zip(samples, statuses) if status]
+    if not known or len(route_points) < 2:
+        return []
+
+    distance = cumulative_km(route_points)
+    sample_indexes = np.array([sample["index"] for sample, _ in known])
+    sample_km = distance[sample_indexes]
+    resolved = np.array([not status.get("unresolved") for _, status in known])
+    volumes = np.array([float(status["volume"] or 0) for _, status in known])
+    probs = np.array([float(status["prob"] or 0) for _, status in known])
+    rainy = np.array([bool(status.get("is_rainy")) for _, status in known])
+    arrivals = np.array([sample["arrival_minutes"] for sample, _ in known])
+
+    # Cut every step_km and at every sample
+    bins = np.floor(distance / step_km).astype(np.int64)
+    cuts = np.union1d(np.flatnonzero(np.diff(bins)) + 1, sample_indexes)
+    cuts = np.union1d(cuts, [0, len(route_points) - 1])
+
+    starts, ends = cuts[:-1], cuts[1:]
+    middle_km = (distance[starts] + distance[ends]) / 2
+    if resolved.any():
+        segment_volumes = np.interp(middle_km, sample_km[resolved], volumes[resolved])
+        segment_probs = np.interp(middle_km, sample_km[resolved], probs[resolved])
+        # The resolved samples just before and after each sub-segment
+        after = np.searchsorted(sample_km[resolved], middle_km).clip(0, resolved.sum() - 1)
+        before = (after - 1).clip(0)
+        segment_rainy = rainy[resolved][before] | rainy[resolved][after]
+    else:
+        segment_volumes = segment_probs = np.zeros(len(middle_km))
+        segment_rainy = np.zeros(len(middle_km), dtype=bool)
+    segment_arrivals = np.interp(middle_km, sample_km, arrivals)
+    nearest = np.abs(middle_km[:, None] - sample_km[None, :]).argmin(axis=1)
+
+    now = datetime.now(timezone.utc)
+    segment_data = []
+    for start, end, volume, prob, is_rainy, arrival, sample_position in zip(
+        starts.tolist(), ends.tolist(), segment_volumes.tolist(), segment_probs.tolist(),
+        segment_rainy.tolist(), segment_arrivals.tolist(), nearest.tolist(),
+    ):
+        provider = known[sample_position][1]["provider"]
+        unresolved = not resolved[sample_position]
+        volume = 0.0 if unresolved else round(volume, 2)
+        prob = 0 if unresolved else int(math.floor(prob + 0.5))
+        segment_data.append({
+            "coords": route_points[start : end + 1],
+            "start_index": start,
+            "end_index": end,
+            "volume": volume,
+            "prob": prob,
+            "time": (now + timedelta(minutes=arrival) - timedelta(hours=3)).strftime("%H:%M"),
+            "provider": provider,
+            "is_rainy": is_rainy and not unresolved,
+            "unresolved": bool(unresolved),
+        })
+    return segment_data